@@ -2,11 +2,19 @@
 # Date: 3/29/2022
 # Task: Graph (Actual - Expected) vs. Time using a line of best fit between t_0 and t_f
 
+import argparse
 import os
-from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
+from functools import partial
+from wainamics.rendering import get_template, set_lines, add_render_arguments, render_settings_from_args
+from wainamics.figures import parse_other, build_baseline_figure
+from wainamics.report import run_reported
+from wainamics.loader import file_date
+from wainamics.baseline import BaselineModel, add_baseline_arguments, baseline_from_args
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments
+from wainamics.scan import add_scan_arguments, runs_from_args
+from wainamics.manifest import add_manifest_arguments, manifest_from_args
+from wainamics.profiling import profiled, add_profile_arguments, profile_from_args
 
 # Change STARTING_ROW for when to begin parsing data. This is to account for any initial data
 STARTING_ROW = 5
@@ -27,124 +35,66 @@ def calculate_time(time_col):
         sum += SECONDS_PER_SAMPLE
     return time
 
-def parse_other(df_other):
-    """ Returns a string of Additional Notes and everything after. """
-    additional_notes = ""
-    found = False
-    for cell in df_other:   
-        if "Additional Notes" in cell:
-            found = True
-        if found:
-            additional_notes += cell + "\n"
-    return additional_notes
-
-def generate_baseline_eq(ch_col):
-    """ Generate a line of best fit equation of a given channel from [t_0, t_f). """
-    sample_initial = int(T_0 / SECONDS_PER_SAMPLE)
-    sample_final = int(T_F / SECONDS_PER_SAMPLE)
-    desired_data = ch_col[sample_initial:sample_final]
-    return np.polyfit(np.arange(T_0, T_F, SECONDS_PER_SAMPLE), desired_data, 1)
-
-def generate_plot(date, file_name):
+@profiled("render")
+def generate_plot(run, render=None, baseline=None):
     """ Generate the plot with the date of creation and file name. """
-    if not ".xlsx" in file_name or "~$" in file_name:
-        return
-
-    df = pd.read_excel(file_name, sheet_name='Optics')
+    file_name = run.file_name
+    df = run.optics
     
     time = calculate_time(df.iloc[:, 0])
-
-    # Begin plotting
-    plt.figure(figsize=(15,10))
+    traces = run.traces()[STARTING_ROW:]
+    template = get_template(build_baseline_figure, run.channel_count())
 
     # Plotting raw data
-    plt.subplot(2, 2, 1)
-    plt.title("Raw")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
+    set_lines(template.raw, time[STARTING_ROW:], traces.T)
 
-    plt.plot(time[STARTING_ROW:], df.iloc[STARTING_ROW:,1], label='Channel 1')
-    plt.plot(time[STARTING_ROW:], df.iloc[STARTING_ROW:,2], label='Channel 2')
-    plt.plot(time[STARTING_ROW:], df.iloc[STARTING_ROW:,3], label='Channel 3')
+    # Plotting normalized data
+    set_lines(template.normalized, time[STARTING_ROW:], (traces / traces[0]).T)
 
-    plt.legend()
+    # Format plot with Baseline Subtraction, the line of best fit unless another baseline model is chosen
+    baseline_sub, labels = (baseline or BaselineModel()).subtract(traces, time[STARTING_ROW:], T_0, T_F, SECONDS_PER_SAMPLE)
 
-    # Plotting normalized data
-    ax1 = plt.subplot(2, 2, 2)
-    plt.title("Normalized")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU Gain")
-    plt.xticks([0, 1200, 2400, 3600])
-    ax1.set_ylim(bottom=1, top=6)
-    plt.yticks([1, 2, 3, 4, 5, 6])
-    plt.grid(True)
-
-    norm_ch1 = df.iloc[STARTING_ROW:,1].astype(float) / df.iloc[STARTING_ROW,1]
-    norm_ch2 = df.iloc[STARTING_ROW:,2].astype(float) / df.iloc[STARTING_ROW,2]
-    norm_ch3 = df.iloc[STARTING_ROW:,3].astype(float) / df.iloc[STARTING_ROW,3]
-
-    plt.plot(time[STARTING_ROW:], norm_ch1, label='Channel 1')
-    plt.plot(time[STARTING_ROW:], norm_ch2, label='Channel 2')
-    plt.plot(time[STARTING_ROW:], norm_ch3, label='Channel 3')
-
-    plt.legend()
-
-    # Format plot with Baseline Subtraction
-    ax2 = plt.subplot(2, 2, 3)
-    plt.title("Baseline Subtraction")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Actual - Expected RFU")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    ch1_m, ch1_b = generate_baseline_eq(df.iloc[STARTING_ROW:,1])
-    ch2_m, ch2_b = generate_baseline_eq(df.iloc[STARTING_ROW:,2])
-    ch3_m, ch3_b = generate_baseline_eq(df.iloc[STARTING_ROW:,3])
-
-    ch1_eq = lambda x: ch1_m * x + ch1_b
-    ch2_eq = lambda x: ch2_m * x + ch2_b
-    ch3_eq = lambda x: ch3_m * x + ch3_b
-
-    ch1_exp = [ch1_eq(x) for x in time[STARTING_ROW:]]
-    ch2_exp = [ch2_eq(x) for x in time[STARTING_ROW:]]
-    ch3_exp = [ch3_eq(x) for x in time[STARTING_ROW:]]
-
-    ch1_baseline_sub = np.subtract(df.iloc[STARTING_ROW:,1], ch1_exp)
-    ch2_baseline_sub = np.subtract(df.iloc[STARTING_ROW:,2], ch2_exp)
-    ch3_baseline_sub = np.subtract(df.iloc[STARTING_ROW:,3], ch3_exp)
-
-    ch1_exp_form = "Channel 1: y = " + str(round(ch1_m, 4)) + "x + " + str(round(ch1_b, 4))
-    ch2_exp_form = "Channel 1: y = " + str(round(ch2_m, 4)) + "x + " + str(round(ch2_b, 4))
-    ch3_exp_form = "Channel 1: y = " + str(round(ch3_m, 4)) + "x + " + str(round(ch3_b, 4))
-
-    plt.plot(time[STARTING_ROW:], ch1_baseline_sub, label=ch1_exp_form)
-    plt.plot(time[STARTING_ROW:], ch2_baseline_sub, label=ch2_exp_form)
-    plt.plot(time[STARTING_ROW:], ch3_baseline_sub, label=ch3_exp_form)
-
-    plt.legend()
+    set_lines(template.baseline_sub, time[STARTING_ROW:], baseline_sub.T, labels)
 
     # Format plot with date and Additional Notes
-    ax3 = plt.subplot(2, 2, 4)
-    ax3.set_axis_off()
-    df_other = pd.read_excel(file_name, sheet_name='Others')
-    additional_notes = parse_other(df_other.iloc[:,0])
-    plt.suptitle(file_name + "\n" + str(date), fontsize = 14)
-    plt.text(0, 0, additional_notes)
-
-    png_name = file_name[:len(file_name)-5]
-    plt.savefig(png_name + '.png', dpi = 300)
-    # plt.show()
+    additional_notes = parse_other(run.others)
+    template.title.set_text(file_name + "\n" + str(run.date))
+    template.notes.set_text(additional_notes)
+
+    png_name = os.path.splitext(file_name)[0]
+    template.export(png_name + '.png', render, file_name)
+
+def output_names(file_name):
+    """ Returns the files generate_plot writes for file_name. """
+    return [os.path.splitext(file_name)[0] + '.png']
+
+def process_file(file_name, cache=None, render=None, baseline=None):
+    """ Load and plot a single run. Runs inside a worker process when --workers is used. """
+    generate_plot(load_cached_run(file_name, file_date(file_name), cache), render, baseline)
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Plot the baseline subtraction of every .xlsx file in the current directory to a PNG")
+    add_scan_arguments(parser)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_manifest_arguments(parser)
+    add_profile_arguments(parser)
+    add_render_arguments(parser)
+    add_baseline_arguments(parser)
+    return parser.parse_args()
 
 def main():
     """ Loops through every .xlsx file in current directory and create tables to write to OUTPUT_FILENAME. """
-    current_dir = os.getcwd()
-    files = os.listdir(current_dir)
-
-    for file_name in files:
-        date = datetime.fromtimestamp(os.stat(file_name).st_ctime)
-        generate_plot(date, file_name)
+    args = parse_args()
+    profile_from_args(args)
+    render = render_settings_from_args(args)
+    baseline = baseline_from_args(args)
+    manifest = manifest_from_args(args, "Baseline Subtraction Script",
+                                  {"STARTING_ROW": STARTING_ROW, "SECONDS_PER_SAMPLE": SECONDS_PER_SAMPLE,
+                                   "T_0": T_0, "T_F": T_F, "BASELINE": baseline.parameters(), "render": render.parameters()})
+    files = runs_from_args(args)
+    run_reported(render, partial(process_file, cache=cache_from_args(args), render=render, baseline=baseline), files, args.workers, manifest, output_names)
 
 if __name__ == '__main__':
     main()
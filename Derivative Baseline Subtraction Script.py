@@ -2,13 +2,23 @@
 # Date: 3/30/2022
 # Task: Graph (Actual - Expected) vs. Time using a line of best fit between t_0 and t_f. Includes derivative graphs.
 
+import argparse
 import os
 from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
+from functools import partial
 import numpy as np
-from scipy.signal import butter, lfilter
-from scipy.signal import freqs
+from wainamics.loader import file_date
+from wainamics.baseline import BaselineModel, equation_labels, add_baseline_arguments, baseline_from_args
+from wainamics.rendering import get_template, set_lines, add_render_arguments, render_settings_from_args
+from wainamics.figures import parse_other, build_derivative_figure
+from wainamics.report import run_reported
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments
+from wainamics.scan import add_scan_arguments, runs_from_args
+from wainamics.manifest import add_manifest_arguments, manifest_from_args
+from wainamics.profiling import profiled, add_profile_arguments, profile_from_args
+from wainamics.live import follow
+from wainamics.filters import DEFAULT_FILTERS, apply_filters, add_filter_arguments, filters_from_args
 
 # Change STARTING_ROW for when to begin parsing data. This is to account for any initial data
 STARTING_ROW = 5
@@ -20,6 +30,9 @@ SECONDS_PER_SAMPLE = 10
 T_0 = 60 * 5
 T_F = 60 * 15
 
+# Number of samples averaged when smoothing the derivative
+WINDOW_SIZE = 50
+
 def calculate_time(time_col):
     """ Calculate the interval in seconds between each sample. Change SECONDS_PER_SAMPLE based on sampling rate. """
     time = []
@@ -29,160 +42,135 @@ def calculate_time(time_col):
         sum += SECONDS_PER_SAMPLE
     return time
 
-def parse_other(df_other):
-    """ Returns a string of Additional Notes and everything after. """
-    additional_notes = ""
-    found = False
-    for cell in df_other:   
-        if "Additional Notes" in cell:
-            found = True
-        if found:
-            additional_notes += cell + "\n"
-    return additional_notes
-
-def generate_baseline_eq(ch_col):
-    """ Generate a line of best fit equation of a given channel from [t_0, t_f). """
-    sample_initial = int(T_0 / SECONDS_PER_SAMPLE)
-    sample_final = int(T_F / SECONDS_PER_SAMPLE)
-    desired_data = ch_col[sample_initial:sample_final]
-    return np.polyfit(np.arange(T_0, T_F, SECONDS_PER_SAMPLE), desired_data, 1)
-
-def smooth(y, box_pts):
-    """ Smoothes out data using a moving average filter given box_pts. """
-    box = np.ones(box_pts)/box_pts
-    y_smooth = np.convolve(y, box, mode='same')
-    return y_smooth
-
-def generate_plot(date, file_name):
-    """ Generate the plot with the date of creation and file name. """
-    if not ".xlsx" in file_name or "~$" in file_name:
-        return
-
-    df = pd.read_excel(file_name, sheet_name='Optics')
-    
-    time = calculate_time(df.iloc[:, 0])
-
-    # Begin plotting
-    plt.figure(figsize=(20,15))
+def smooth(y, filters=DEFAULT_FILTERS):
+    """ Smoothes out every column of y with the filters given, a moving average of WINDOW_SIZE by default. """
+    return apply_filters(y, filters, WINDOW_SIZE, SECONDS_PER_SAMPLE)
+
+def smooth_title(filters):
+    """ Returns the title of the smoothed derivative panel. """
+    if list(filters) == DEFAULT_FILTERS:
+        return "Window Size " + str(WINDOW_SIZE) + " Derivative"
+    return "Window Size " + str(WINDOW_SIZE) + " Derivative (" + ", ".join(filters) + ")"
+
+@profiled("derivative")
+def analyse_run(run, filters=DEFAULT_FILTERS, baseline=None):
+    """ Returns the arrays plotted for run: traces, normalized traces, baseline subtraction and derivatives from STARTING_ROW on. """
+    df = run.optics
+    time = np.asarray(calculate_time(df.iloc[:, 0])[STARTING_ROW:], dtype=float)
+    traces = run.traces()[STARTING_ROW:]
+
+    baseline_sub, baseline_labels = (baseline or BaselineModel()).subtract(traces, time, T_0, T_F, SECONDS_PER_SAMPLE)
+    # The derivative is taken once and every channel is smoothed together
+    derivative = np.gradient(traces, time, axis=0)
+    smooth_derivative = smooth(derivative, filters)
+
+    return {"time": time,
+            "traces": traces,
+            "normalized": traces / traces[0],
+            "baseline_sub": baseline_sub,
+            "baseline_labels": baseline_labels,
+            "derivative": derivative,
+            "smooth_derivative": smooth_derivative}
+
+def draw_plot(png_name, title, additional_notes, analysis, filters=DEFAULT_FILTERS, render=None, run_name=None):
+    """ Draw the arrays returned by analyse_run and save them to png_name. """
+    time = analysis["time"]
+    template = get_template(build_derivative_figure, analysis["traces"].shape[1])
 
     # Plotting raw data
-    plt.subplot(3, 2, 1)
-    plt.title("Raw")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    plt.plot(time[STARTING_ROW:], df.iloc[STARTING_ROW:,1], label='Channel 1')
-    plt.plot(time[STARTING_ROW:], df.iloc[STARTING_ROW:,2], label='Channel 2')
-    plt.plot(time[STARTING_ROW:], df.iloc[STARTING_ROW:,3], label='Channel 3')
-
-    plt.legend()
+    set_lines(template.raw, time, analysis["traces"].T)
 
     # Plotting normalized data
-    ax1 = plt.subplot(3, 2, 2)
-    plt.title("Normalized")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU Gain")
-    plt.xticks([0, 1200, 2400, 3600])
-    ax1.set_ylim(bottom=1, top=6)
-    plt.yticks([1, 2, 3, 4, 5, 6])
-    plt.grid(True)
-
-    norm_ch1 = df.iloc[STARTING_ROW:,1].astype(float) / df.iloc[STARTING_ROW,1]
-    norm_ch2 = df.iloc[STARTING_ROW:,2].astype(float) / df.iloc[STARTING_ROW,2]
-    norm_ch3 = df.iloc[STARTING_ROW:,3].astype(float) / df.iloc[STARTING_ROW,3]
-
-    plt.plot(time[STARTING_ROW:], norm_ch1, label='Channel 1')
-    plt.plot(time[STARTING_ROW:], norm_ch2, label='Channel 2')
-    plt.plot(time[STARTING_ROW:], norm_ch3, label='Channel 3')
-
-    plt.legend()
+    set_lines(template.normalized, time, analysis["normalized"].T)
 
     # Format plot with Baseline Subtraction
-    ax2 = plt.subplot(3, 2, 3)
-    plt.title("Baseline Subtraction")
-    plt.xlabel("Time (s)")
-    plt.ylabel("Actual - Expected RFU")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    ch1_m, ch1_b = generate_baseline_eq(df.iloc[STARTING_ROW:,1])
-    ch2_m, ch2_b = generate_baseline_eq(df.iloc[STARTING_ROW:,2])
-    ch3_m, ch3_b = generate_baseline_eq(df.iloc[STARTING_ROW:,3])
-
-    ch1_eq = lambda x: ch1_m * x + ch1_b
-    ch2_eq = lambda x: ch2_m * x + ch2_b
-    ch3_eq = lambda x: ch3_m * x + ch3_b
-
-    ch1_exp = [ch1_eq(x) for x in time[STARTING_ROW:]]
-    ch2_exp = [ch2_eq(x) for x in time[STARTING_ROW:]]
-    ch3_exp = [ch3_eq(x) for x in time[STARTING_ROW:]]
-
-    ch1_baseline_sub = np.subtract(df.iloc[STARTING_ROW:,1], ch1_exp)
-    ch2_baseline_sub = np.subtract(df.iloc[STARTING_ROW:,2], ch2_exp)
-    ch3_baseline_sub = np.subtract(df.iloc[STARTING_ROW:,3], ch3_exp)
-
-    ch1_exp_form = "Channel 1: y = " + str(round(ch1_m, 4)) + "x + " + str(round(ch1_b, 4))
-    ch2_exp_form = "Channel 2: y = " + str(round(ch2_m, 4)) + "x + " + str(round(ch2_b, 4))
-    ch3_exp_form = "Channel 3: y = " + str(round(ch3_m, 4)) + "x + " + str(round(ch3_b, 4))
-
-    plt.plot(time[STARTING_ROW:], ch1_baseline_sub, label=ch1_exp_form)
-    plt.plot(time[STARTING_ROW:], ch2_baseline_sub, label=ch2_exp_form)
-    plt.plot(time[STARTING_ROW:], ch3_baseline_sub, label=ch3_exp_form)
-
-    plt.legend()
+    set_lines(template.baseline_sub, time, analysis["baseline_sub"].T, analysis["baseline_labels"])
 
     # Format plot with date and Additional Notes
-    ax3 = plt.subplot(3, 2, 4)
-    ax3.set_axis_off()
-    df_other = pd.read_excel(file_name, sheet_name='Others')
-    additional_notes = parse_other(df_other.iloc[:,0])
-    plt.suptitle(file_name + "\n" + str(date), fontsize = 14)
-    plt.text(0, 0.65, additional_notes)
+    template.title.set_text(title)
+    template.notes.set_text(additional_notes)
 
     # Plotting raw derivative data
-    plt.subplot(3, 2, 5)
-    plt.title("Raw Derivative")
-    plt.xlabel("Time (s)")
-    plt.ylabel("dRFU / dt")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    plt.plot(time[STARTING_ROW:], np.gradient(df.iloc[STARTING_ROW:,1], time[STARTING_ROW:]), label='Channel 1 Derivative')
-    plt.plot(time[STARTING_ROW:], np.gradient(df.iloc[STARTING_ROW:,2], time[STARTING_ROW:]), label='Channel 2 Derivative')
-    plt.plot(time[STARTING_ROW:], np.gradient(df.iloc[STARTING_ROW:,3], time[STARTING_ROW:]), label='Channel 3 Derivative')
+    set_lines(template.derivative, time, analysis["derivative"].T)
 
-    plt.legend()
+    # Plotting smoothed derivative data
+    template.smooth_axes.set_title(smooth_title(filters))
+    set_lines(template.smooth_derivative, time, analysis["smooth_derivative"].T)
 
-    # Plotting window size 50 derivative data
-    WINDOW_SIZE = 50
+    template.export(png_name, render, run_name)
 
-    plt.subplot(3, 2, 6)
-    plt.title("Window Size 50 Derivative")
-    plt.xlabel("Time (s)")
-    plt.ylabel("dRFU / dt")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    plt.plot(time[STARTING_ROW:], smooth(np.gradient(df.iloc[STARTING_ROW:,1], time[STARTING_ROW:]), WINDOW_SIZE), label='Channel 1 Derivative')
-    plt.plot(time[STARTING_ROW:], smooth(np.gradient(df.iloc[STARTING_ROW:,2], time[STARTING_ROW:]), WINDOW_SIZE), label='Channel 2 Derivative')
-    plt.plot(time[STARTING_ROW:], smooth(np.gradient(df.iloc[STARTING_ROW:,3], time[STARTING_ROW:]), WINDOW_SIZE), label='Channel 3 Derivative')
-
-    plt.legend()
-
-    png_name = file_name[:len(file_name)-5]
-    plt.savefig(png_name + '.png', dpi = 300)
-    # plt.show()
+@profiled("render")
+def generate_plot(run, filters=DEFAULT_FILTERS, render=None, baseline=None):
+    """ Generate the plot with the date of creation and file name. """
+    file_name = run.file_name
+    png_name = os.path.splitext(file_name)[0]
+    draw_plot(png_name + '.png', file_name + "\n" + str(run.date), parse_other(run.others), analyse_run(run, filters, baseline), filters, render, file_name)
+
+def output_names(file_name):
+    """ Returns the files generate_plot writes for file_name. """
+    return [os.path.splitext(file_name)[0] + '.png']
+
+def process_file(file_name, cache=None, filters=DEFAULT_FILTERS, render=None, baseline=None):
+    """ Load and plot a single run. Runs inside a worker process when --workers is used. """
+    generate_plot(load_cached_run(file_name, file_date(file_name), cache), filters, render, baseline)
+
+def refresh_live_plot(follower, live_run, filters=DEFAULT_FILTERS, render=None, baseline=None):
+    """ Redraw the PNG of the log being followed from the running sums of live_run. """
+    file_name = follower.file_name
+    title = file_name + "\n" + "Live, " + str(len(live_run.traces)) + " samples at " + datetime.now().strftime("%H:%M:%S")
+    analysis = live_run.snapshot()
+    analysis["baseline_labels"] = equation_labels(analysis["slopes"], analysis["intercepts"])
+    if baseline is not None and baseline.model != "linear":
+        # Only the line of best fit has running sums, other models are fitted again to what has been logged
+        try:
+            analysis["baseline_sub"], analysis["baseline_labels"] = baseline.subtract(analysis["traces"], analysis["time"], T_0, T_F, SECONDS_PER_SAMPLE)
+        except ValueError:
+            analysis["baseline_sub"] = np.full_like(analysis["traces"], np.nan)
+    if list(filters) != DEFAULT_FILTERS:
+        analysis["smooth_derivative"] = smooth(analysis["derivative"], filters)
+    draw_plot(os.path.splitext(file_name)[0] + '.png', title, parse_other(follower.others), analysis, filters, render, file_name)
+    print("Updated " + os.path.splitext(file_name)[0] + ".png with " + str(len(live_run.traces)) + " samples")
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Plot the baseline subtraction and derivatives of every .xlsx file in the current directory to a PNG")
+    add_scan_arguments(parser)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_manifest_arguments(parser)
+    add_profile_arguments(parser)
+    add_render_arguments(parser)
+    add_filter_arguments(parser)
+    add_baseline_arguments(parser)
+    parser.add_argument("--follow", metavar="LOG",
+                        help="follow a run that is still being recorded (.csv, .tsv or a periodically saved .xlsx)")
+    parser.add_argument("--interval", type=float, default=30.0,
+                        help="seconds between PNG updates with --follow (default: 30)")
+    parser.add_argument("--idle-timeout", type=float, default=600.0,
+                        help="stop following once the log has not grown for this many seconds (default: 600)")
+    args = parser.parse_args()
+    if args.follow and args.report:
+        parser.error("--follow keeps redrawing one run's PNG, it cannot add pages to --report")
+    return args
 
 def main():
     """ Loops through every .xlsx file in current directory and create tables to write to OUTPUT_FILENAME. """
-    current_dir = os.getcwd()
-    files = os.listdir(current_dir)
+    args = parse_args()
+    profile_from_args(args)
+    filters = filters_from_args(args)
+    render = render_settings_from_args(args)
+    baseline = baseline_from_args(args)
+    if args.follow:
+        follow(args.follow, partial(refresh_live_plot, filters=filters, render=render, baseline=baseline), STARTING_ROW, T_0, T_F, SECONDS_PER_SAMPLE, WINDOW_SIZE,
+               interval=args.interval, idle_timeout=args.idle_timeout)
+        return
 
-    for file_name in files:
-        date = datetime.fromtimestamp(os.stat(file_name).st_ctime)
-        generate_plot(date, file_name)
+    manifest = manifest_from_args(args, "Derivative Baseline Subtraction Script",
+                                  {"STARTING_ROW": STARTING_ROW, "SECONDS_PER_SAMPLE": SECONDS_PER_SAMPLE,
+                                   "T_0": T_0, "T_F": T_F, "WINDOW_SIZE": WINDOW_SIZE, "FILTERS": filters,
+                                   "BASELINE": baseline.parameters(), "render": render.parameters()})
+    files = runs_from_args(args)
+    run_reported(render, partial(process_file, cache=cache_from_args(args), filters=filters, render=render, baseline=baseline), files, args.workers, manifest, output_names)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,210 @@
+# Task: Produce every deliverable of a run in one pass: the summary table, the raw plot, the baseline subtraction
+#       plot and the derivative plot. Each output is an optional stage. A workbook is parsed once and the
+#       normalized, baseline and derivative arrays are computed once and shared by every stage that needs them.
+#       Outputs:  <name>_raw.png | <name>_baseline.png | <name>_derivative.png | Table Output.xlsx
+
+import argparse
+import os
+from functools import partial
+from wainamics.loader import file_date
+from wainamics.dataset import RunData
+from wainamics.baseline import add_baseline_arguments, baseline_from_args
+from wainamics.rendering import get_template, set_lines, add_render_arguments, render_settings_from_args
+from wainamics.figures import parse_other, title_of, build_raw_figure, build_baseline_figure, build_derivative_figure
+from wainamics.report import iter_reported, run_reported
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments
+from wainamics.scan import add_scan_arguments, runs_from_args, shard_file_name, select_shard
+from wainamics.manifest import Manifest, add_manifest_arguments, manifest_from_args
+from wainamics.profiling import profiled, add_profile_arguments, profile_from_args
+from wainamics.filters import DEFAULT_FILTERS, add_filter_arguments, filters_from_args
+from wainamics.table_writer import TableWriter
+from wainamics.store import add_store_arguments, load_stored_run, open_store
+from wainamics.timepoints import Timepoints, add_timepoint_arguments, timepoints_from_args
+from wainamics.features import add_feature_arguments, features_from_args
+from wainamics.watch import add_watch_arguments, watch
+
+OUTPUT_FILENAME = "Table Output.xlsx"
+
+# Change STARTING_ROW for when to begin parsing data. This is to account for any initial data
+STARTING_ROW = 5
+
+# Change SECONDS_PER_SAMPLE depending on how often the machine samples data
+SECONDS_PER_SAMPLE = 10
+
+# Line of best fit times in seconds
+T_0 = 60 * 5
+T_F = 60 * 15
+
+# Number of samples averaged when smoothing the derivative
+WINDOW_SIZE = 50
+
+# Every stage, in the order they run. Each plot stage writes <name> + its suffix.
+STAGES = ["table", "raw", "baseline", "derivative"]
+PLOT_SUFFIXES = {"raw": "_raw.png", "baseline": "_baseline.png", "derivative": "_derivative.png"}
+
+@profiled("format_table")
+def format_table(data, timepoints=None):
+    """ Format the table with the date of creation and file name, from the raw readings of data.
+        Derivative features reuse the smoothed derivative the derivative plot is drawn from. """
+    if timepoints is None:
+        timepoints = Timepoints(seconds_per_sample=SECONDS_PER_SAMPLE)
+    features = None if timepoints.features is None else timepoints.features.run_features(data)
+    return timepoints.table(data.run, data.traces(), features)
+
+def write_to_same_sheet(tables, new_row=6, file_name=OUTPUT_FILENAME):
+    """ Write tables into the same sheet, skipping new_row amount of rows before writing the next table."""
+    with TableWriter(file_name, same_sheet=True, new_row=new_row) as writer:
+        for df in tables:
+            if df is None:
+                continue
+            writer.write(df)
+
+def publish_tables(manifest, new_row=6):
+    """ Rewrite the summary table from the tables recorded in manifest, in file name order. """
+    write_to_same_sheet([manifest.table(file_name) for file_name in sorted(manifest.entries)], new_row)
+
+@profiled("render")
+def generate_raw_plot(data, png_name, render=None):
+    """ Plot the raw and normalized readings of every sample. """
+    template = get_template(build_raw_figure, data.channel_count())
+    set_lines(template.raw, data.time(), data.traces().T)
+    set_lines(template.normalized, data.time(), data.normalized().T)
+    template.title.set_text(title_of(data.run))
+    template.notes.set_text(parse_other(data.run.others))
+    template.export(png_name, render, data.run.file_name)
+
+@profiled("render")
+def generate_baseline_plot(data, png_name, render=None):
+    """ Plot the readings from STARTING_ROW on with their baseline subtraction. """
+    template = get_template(build_baseline_figure, data.channel_count())
+    time = data.trimmed_time()
+    set_lines(template.raw, time, data.trimmed_traces().T)
+    set_lines(template.normalized, time, data.trimmed_normalized().T)
+    set_lines(template.baseline_sub, time, data.baseline_sub().T, data.baseline_labels())
+    template.title.set_text(title_of(data.run))
+    template.notes.set_text(parse_other(data.run.others))
+    template.export(png_name, render, data.run.file_name)
+
+@profiled("render")
+def generate_derivative_plot(data, png_name, render=None):
+    """ Plot the baseline subtraction together with the raw and smoothed derivatives. """
+    template = get_template(build_derivative_figure, data.channel_count())
+    time = data.trimmed_time()
+    set_lines(template.raw, time, data.trimmed_traces().T)
+    set_lines(template.normalized, time, data.trimmed_normalized().T)
+    set_lines(template.baseline_sub, time, data.baseline_sub().T, data.baseline_labels())
+    template.title.set_text(title_of(data.run))
+    template.notes.set_text(parse_other(data.run.others))
+    set_lines(template.derivative, time, data.derivative().T)
+
+    title = "Window Size " + str(WINDOW_SIZE) + " Derivative"
+    if list(data.filters) != DEFAULT_FILTERS:
+        title += " (" + ", ".join(data.filters) + ")"
+    template.smooth_axes.set_title(title)
+    set_lines(template.smooth_derivative, time, data.smooth_derivative().T)
+    template.export(png_name, render, data.run.file_name)
+
+PLOTTERS = {"raw": generate_raw_plot, "baseline": generate_baseline_plot, "derivative": generate_derivative_plot}
+
+def output_names(file_name, stages=STAGES):
+    """ Returns the PNG files the plot stages write for file_name. """
+    base_name = os.path.splitext(file_name)[0]
+    return [base_name + PLOT_SUFFIXES[stage] for stage in stages if stage in PLOT_SUFFIXES]
+
+def process_file(file_name, cache=None, stages=STAGES, filters=DEFAULT_FILTERS, render=None, store=None, timepoints=None, baseline=None):
+    """ Load a run once and produce every selected output from it. Returns its table, or None without the table stage. """
+    if store:
+        run = load_stored_run(store, file_name, SECONDS_PER_SAMPLE)
+    else:
+        run = load_cached_run(file_name, file_date(file_name), cache)
+    data = RunData(run, STARTING_ROW, SECONDS_PER_SAMPLE, T_0, T_F, WINDOW_SIZE, filters, baseline)
+
+    table = format_table(data, timepoints) if "table" in stages else None
+    base_name = os.path.splitext(file_name)[0]
+    for stage in stages:
+        if stage in PLOTTERS:
+            PLOTTERS[stage](data, base_name + PLOT_SUFFIXES[stage], render)
+    return table
+
+def parse_stages(text):
+    """ Returns the stages named in a comma separated list, in the order they run. """
+    names = [name.strip() for name in text.split(",") if name.strip()]
+    unknown = [name for name in names if name not in STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown output " + ", ".join(unknown) + ", choose from " + ", ".join(STAGES))
+    return [stage for stage in STAGES if stage in names]
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Write the table, raw, baseline and derivative plots of every .xlsx file in the current directory in one pass")
+    parser.add_argument("--outputs", type=parse_stages, default=STAGES,
+                        help="comma separated outputs to make, from " + ", ".join(STAGES) + " (default: all of them)")
+    add_scan_arguments(parser)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_manifest_arguments(parser)
+    add_profile_arguments(parser)
+    add_render_arguments(parser)
+    add_filter_arguments(parser)
+    add_baseline_arguments(parser)
+    add_store_arguments(parser)
+    add_timepoint_arguments(parser)
+    add_feature_arguments(parser)
+    add_watch_arguments(parser)
+    args = parser.parse_args()
+    if args.watch and args.store:
+        parser.error("--watch processes the workbooks as they land, it cannot read from --store")
+    if args.watch and args.report:
+        parser.error("--watch never finishes the batch, it cannot write --report")
+    if args.watch and (args.input or args.shard):
+        parser.error("--watch only watches the current folder, it cannot take --input or --shard")
+    if args.store and args.input:
+        parser.error("--store already holds the runs, it cannot take --input")
+    return args
+
+def main():
+    """ Loops through every .xlsx file in current directory once and makes every selected output. """
+    args = parse_args()
+    profile_from_args(args)
+    stages = args.outputs
+    filters = filters_from_args(args)
+    baseline = baseline_from_args(args)
+    features = features_from_args(args, STARTING_ROW, SECONDS_PER_SAMPLE, T_0, T_F, WINDOW_SIZE, filters, baseline)
+    timepoints = timepoints_from_args(args, SECONDS_PER_SAMPLE, features)
+    render = render_settings_from_args(args)
+    current_dir = os.getcwd()
+    output_name = os.path.join(current_dir, shard_file_name(OUTPUT_FILENAME, args.shard))
+    parameters = {"STARTING_ROW": STARTING_ROW, "SECONDS_PER_SAMPLE": SECONDS_PER_SAMPLE, "T_0": T_0, "T_F": T_F,
+                  "WINDOW_SIZE": WINDOW_SIZE, "FILTERS": filters, "BASELINE": baseline.parameters(), "timepoints": timepoints.parameters(), "outputs": stages,
+                  "render": render.parameters()}
+    manifest = manifest_from_args(args, "Pipeline Script", parameters)
+
+    if args.store:
+        # Runs in a store have no workbook on disk to fingerprint, so every output is made again
+        manifest = None
+        files = select_shard([entry["file_name"] for entry in open_store(args.store).entries], args.shard)
+    else:
+        files = runs_from_args(args, [OUTPUT_FILENAME])
+    worker = partial(process_file, cache=cache_from_args(args), stages=stages, filters=filters, render=render, store=args.store, timepoints=timepoints, baseline=baseline)
+    outputs = partial(output_names, stages=stages)
+    if args.watch:
+        # The manifest is what lets a restarted watch skip the runs it already did
+        publish = partial(publish_tables, new_row=timepoints.new_row()) if "table" in stages else None
+        watch(worker, Manifest("Pipeline Script", parameters), outputs, publish, args.workers, args.settle, args.poll, [OUTPUT_FILENAME])
+        return
+    if "table" not in stages:
+        run_reported(render, worker, files, args.workers, manifest, outputs)
+        return
+
+    tables, changed = iter_reported(render, worker, files, args.workers, manifest, outputs)
+    if not changed and os.path.isfile(output_name):
+        return
+
+    if os.path.isfile(output_name):
+        os.remove(output_name)
+    write_to_same_sheet(tables, timepoints.new_row(), output_name)
+
+if __name__ == '__main__':
+    main()
+    print("Done! Please check the PNG files and " + OUTPUT_FILENAME)
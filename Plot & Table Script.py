@@ -4,43 +4,29 @@
 #   DATE | FILENAME | COLUMN | 20 MINS | 40 MINS | 60 MINS
 #                               EXP VS ACT
 
+import argparse
 import os
-from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
+from functools import partial
+from wainamics.loader import file_date
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments
+from wainamics.scan import add_scan_arguments, runs_from_args, shard_file_name
+from wainamics.manifest import add_manifest_arguments, manifest_from_args
+from wainamics.profiling import profiled, add_profile_arguments, profile_from_args
+from wainamics.table_writer import TableWriter
+from wainamics.timepoints import Timepoints, add_timepoint_arguments, timepoints_from_args
+from wainamics.rendering import FigureTemplate, get_template, time_axes, add_lines, set_lines, channel_labels, add_render_arguments, render_settings_from_args
+from wainamics.figures import parse_other
+from wainamics.report import iter_reported
 
 OUTPUT_FILENAME = "Table Output.xlsx"
 
-def create_table(date, file_name, col_b, col_c, col_d, ratio_bd, ratio_cd):
-    """ Create a table with the desired formatting. """
-    data = { 'Date Created': [date, np.nan, np.nan, np.nan],
-                'File Name': [file_name, np.nan, np.nan, np.nan],
-                'Minutes': [0, 20, 40, 60],
-                'Ch 1': col_b,
-                'Ch 2': col_c,
-                'Ch 3' : col_d,
-                'Ch1 / Ch3' : ratio_bd,
-                'Ch2 / Ch3' : ratio_cd
-    }
-    table = pd.DataFrame(data)
-    table = table.fillna('')
-    return table
-
-
-def calculate_intervals():
-    """ Calculate the intervals between each sample. Change SECONDS_PER_SAMPLE based on sampling rate. """
-    SECONDS_PER_SAMPLE = 10
-    seconds_per_minute = 60
-    minutes = [0, 20, 40, 60]
-    intervals = [int(minutes[0] * seconds_per_minute / SECONDS_PER_SAMPLE + 1),         # Off by one
-                    int(minutes[1] * seconds_per_minute / SECONDS_PER_SAMPLE),
-                    int(minutes[2] * seconds_per_minute / SECONDS_PER_SAMPLE),
-                    int(minutes[3] * seconds_per_minute / SECONDS_PER_SAMPLE - 1)]      # [, ) 
-    return intervals
+# Change SECONDS_PER_SAMPLE depending on how often the machine samples data
+SECONDS_PER_SAMPLE = 10
 
 def plot_table(table):
     """ Plot the current table to inspect formatting. """
+    import matplotlib.pyplot as plt
     plt.rcParams["figure.figsize"] = [10, 5]
     plt.rcParams["figure.autolayout"] = True
     fig, ax = plt.subplots()
@@ -54,58 +40,32 @@ def plot_table(table):
     the_table.set_fontsize(7)
     plt.show()
 
-def format_table(date, file_name):
+@profiled("format_table")
+def format_table(run, timepoints=None):
     """ Format the table with the date of creation and file name. """
-    if not ".xlsx" in file_name:
-        return
-
-    df = pd.read_excel(file_name)
-    intervals = calculate_intervals()
-
-    if intervals[3] > len(df.iloc[:, 1]) or intervals[3] > len(df.iloc[:, 1]) or intervals[3] > len(df.iloc[:, 1]):
-        col_b = [df.iloc[intervals[0], 1], df.iloc[intervals[1], 1], df.iloc[intervals[2], 1], df.iloc[len(df.iloc[:, 1]) - 1, 1]]
-        col_c = [df.iloc[intervals[0], 2], df.iloc[intervals[1], 2], df.iloc[intervals[2], 2], df.iloc[len(df.iloc[:, 2]) - 1, 2]]
-        col_d = [df.iloc[intervals[0], 3], df.iloc[intervals[1], 3], df.iloc[intervals[2], 3], df.iloc[len(df.iloc[:, 3]) - 1, 3]]
-    else:
-        col_b = [df.iloc[intervals[0], 1], df.iloc[intervals[1], 1], df.iloc[intervals[2], 1], df.iloc[intervals[3] - 1, 1]]
-        col_c = [df.iloc[intervals[0], 2], df.iloc[intervals[1], 2], df.iloc[intervals[2], 2], df.iloc[intervals[3] - 1, 2]]
-        col_d = [df.iloc[intervals[0], 3], df.iloc[intervals[1], 3], df.iloc[intervals[2], 3], df.iloc[intervals[3] - 1, 3]]
-
-    ratio_bd = [float(format(i / j, '.4f')) for i, j in zip(col_b, col_d)]
-    ratio_cd = [float(format(i / j, '.4f')) for i, j in zip(col_c, col_d)]
-    
-    table = create_table(date, file_name, col_b, col_c, col_d, 
-                                ratio_bd, ratio_cd)
+    if timepoints is None:
+        timepoints = Timepoints(seconds_per_sample=SECONDS_PER_SAMPLE)
+    table = timepoints.table(run)
     # plot_table(table)
     return table
 
-def write_to_same_sheet(tables):
-    """ Write tables into the same sheet, skipping NEW_ROW amount of rows before writing the next table."""
-    start_row = 1
-    NEW_ROW = 6
-
-    for df in tables:
-        if df is None:
-            continue
-        if start_row == 1:
-            df.to_excel(OUTPUT_FILENAME)
-        else:
-            with pd.ExcelWriter(OUTPUT_FILENAME, mode="a", engine="openpyxl", if_sheet_exists="overlay") as writer:
-                df.to_excel(writer, startrow=start_row)
-        start_row += NEW_ROW
-
-def write_to_new_sheet(tables):
+@profiled("excel_write")
+def write_to_same_sheet(tables, new_row=6, file_name=OUTPUT_FILENAME):
+    """ Write tables into the same sheet, skipping new_row amount of rows before writing the next table."""
+    with TableWriter(file_name, same_sheet=True, new_row=new_row) as writer:
+        for df in tables:
+            if df is None:
+                continue
+            writer.write(df)
+
+@profiled("excel_write")
+def write_to_new_sheet(tables, file_name=OUTPUT_FILENAME):
     """ Write tables to a new sheet every time. """
-    start = 1
-    for df in tables:
-        if df is None:
-            continue
-        if start == 1:
-            start += 1
-            df.to_excel(OUTPUT_FILENAME)
-        else:
-            with pd.ExcelWriter(OUTPUT_FILENAME, mode="a", engine="openpyxl", if_sheet_exists="new") as writer:
-                df.to_excel(writer)
+    with TableWriter(file_name, same_sheet=False) as writer:
+        for df in tables:
+            if df is None:
+                continue
+            writer.write(df)
 
 def calculate_time(time_col):
     """ Calculate the intervals between each sample. Change SECONDS_PER_SAMPLE based on sampling rate. """
@@ -117,100 +77,109 @@ def calculate_time(time_col):
         sum += SECONDS_PER_SAMPLE
     return time
 
-def parse_other(df_other):
-    """ Returns a string of Additional Notes and everything after. """
-    additional_notes = ""
-    found = False
-    for cell in df_other:   
-        if "Additional Notes" in cell:
-            found = True
-        if found:
-            additional_notes += cell + "\n"
-    return additional_notes
-
-def generate_plot(date, file_name, table):
-    """ Generate the plot with the date of creation and file name. """
-    if not ".xlsx" in file_name or "~$" in file_name:
-        return
-
-    df = pd.read_excel(file_name)
-    
-    time = calculate_time(df.iloc[:, 0])
-
-    # Begin plotting
-    fig = plt.figure(figsize=(15,20))
+def build_figure(channels=3):
+    """ Build the figure layout once per channel count. generate_plot only swaps in the data of each run. """
+    template = FigureTemplate(figsize=(15,20))
+    fig = template.figure
     gs = fig.add_gridspec(4,5)
-    plt.suptitle(file_name + "\n" + str(date), fontsize = 14)
+    template.title = fig.suptitle("", fontsize = 14)
 
     # Plotting raw data
-    ax0 = fig.add_subplot(gs[0,0:2])
-    plt.title("Raw")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    plt.plot(time, df['Channel 1'], label='Channel 1')
-    plt.plot(time, df['Channel 2'], label='Channel 2')
-    plt.plot(time, df['Channel 3'], label='Channel 3')
-
-    plt.legend()
+    ax0 = time_axes(fig.add_subplot(gs[0,0:2]), "Raw", "RFU")
+    template.raw = add_lines(ax0, channel_labels(channels))
 
     # Plotting normalized data
-    ax1 = fig.add_subplot(gs[0,2:4])
-    plt.title("Normalized")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU Gain")
-    plt.xticks([0, 1200, 2400, 3600])
+    ax1 = time_axes(fig.add_subplot(gs[0,2:4]), "Normalized", "RFU Gain")
     ax1.set_ylim(bottom=1, top=6)
-    plt.yticks([1, 2, 3, 4, 5, 6])
-    plt.grid(True)
-
-    norm_ch1 = df.iloc[:,1].astype(float) / df.iloc[0,1]
-    norm_ch2 = df.iloc[:,2].astype(float) / df.iloc[0,2]
-    norm_ch3 = df.iloc[:,3].astype(float) / df.iloc[0,3]
-
-    plt.plot(time, norm_ch1, label='Channel 1')
-    plt.plot(time, norm_ch2, label='Channel 2')
-    plt.plot(time, norm_ch3, label='Channel 3')
-
-    plt.legend()
+    ax1.set_yticks([1, 2, 3, 4, 5, 6])
+    template.normalized = add_lines(ax1, channel_labels(channels))
 
     # Format plot with date and Additional Notes
     ax2 = fig.add_subplot(gs[0,4])
     ax2.set_axis_off()
-    df_other = pd.read_excel(file_name, sheet_name='Others')
-    additional_notes = parse_other(df_other.iloc[:,0])
-    plt.text(0, 0.65, additional_notes)
+    template.notes = ax2.text(0, 0.65, "")
 
     # Format plot with table
-    ax3 = fig.add_subplot(gs[1,:])
-    ax3.set_axis_off()
-    plt.title("RFU Comparisons")
+    template.table_axes = fig.add_subplot(gs[1,:])
+    template.table_axes.set_axis_off()
+    template.table_axes.set_title("RFU Comparisons")
+    template.table = None
+    return template
+
+@profiled("render")
+def generate_plot(run, table, render=None):
+    """ Generate the plot with the date of creation and file name. """
+    file_name = run.file_name
+    df = run.optics
+    
+    time = calculate_time(df.iloc[:, 0])
+    traces = run.traces()
+    template = get_template(build_figure, run.channel_count())
+    template.title.set_text(file_name + "\n" + str(run.date))
+
+    # Plotting raw data
+    set_lines(template.raw, time, traces.T)
+
+    # Plotting normalized data
+    set_lines(template.normalized, time, (traces / traces[0]).T)
+
+    # Format plot with date and Additional Notes
+    additional_notes = parse_other(run.others)
+    template.notes.set_text(additional_notes)
+
+    # Format plot with table. The table is rebuilt every run since its font only ever shrinks to fit
+    if template.table is not None:
+        template.table.remove()
     cropped_table = table.iloc[:,2:]
-    the_table = ax3.table(cellText=cropped_table.values, colLabels=cropped_table.columns, loc='center')
-    the_table.scale(1, 2)
+    template.table = template.table_axes.table(cellText=cropped_table.values, colLabels=cropped_table.columns, loc='center')
+    template.table.scale(1, 2)
 
     # Save PNG
-    png_name = file_name[:len(file_name)-5]
-    plt.savefig(png_name + '.png', dpi = 300)
-    # plt.show()
+    png_name = os.path.splitext(file_name)[0]
+    template.export(png_name + '.png', render, file_name, table)
+
+def output_names(file_name):
+    """ Returns the files generate_plot writes for file_name. """
+    return [os.path.splitext(file_name)[0] + '.png']
+
+def process_file(file_name, cache=None, render=None, timepoints=None):
+    """ Load a single run, plot it and return its table. Runs inside a worker process when --workers is used. """
+    run = load_cached_run(file_name, file_date(file_name), cache)
+    table = format_table(run, timepoints)
+    generate_plot(run, table, render)
+    return table
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Plot every .xlsx file in the current directory and write their tables to " + OUTPUT_FILENAME)
+    add_scan_arguments(parser)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_manifest_arguments(parser)
+    add_profile_arguments(parser)
+    add_timepoint_arguments(parser)
+    add_render_arguments(parser)
+    return parser.parse_args()
 
 def main():
     """ Loops through every .xlsx file in current directory and create tables to write to OUTPUT_FILENAME. """
+    args = parse_args()
+    profile_from_args(args)
+    timepoints = timepoints_from_args(args, SECONDS_PER_SAMPLE)
     current_dir = os.getcwd()
-    if os.path.isfile(os.path.join(current_dir, OUTPUT_FILENAME)):
-        os.remove(os.path.join(current_dir, OUTPUT_FILENAME))
-
-    tables = []
-    files = os.listdir(current_dir)
-    for file_name in files:
-        date = datetime.fromtimestamp(os.stat(file_name).st_ctime)
-        table = format_table(date, file_name)
-        tables.append(table)
-        generate_plot(date, file_name, table)
+    output_name = os.path.join(current_dir, shard_file_name(OUTPUT_FILENAME, args.shard))
+    render = render_settings_from_args(args)
+    manifest = manifest_from_args(args, "Plot & Table Script", {"timepoints": timepoints.parameters(), "render": render.parameters()})
+
+    files = runs_from_args(args, [OUTPUT_FILENAME])
+    tables, changed = iter_reported(render, partial(process_file, cache=cache_from_args(args), render=render, timepoints=timepoints), files, args.workers, manifest, output_names)
+    if not changed and os.path.isfile(output_name):
+        return
+
+    if os.path.isfile(output_name):
+        os.remove(output_name)
     
-    write_to_same_sheet(tables) # UNCOMMENT TO WRITE EVERY FILE INTO THE SAME SHEET
+    write_to_same_sheet(tables, timepoints.new_row(), output_name) # UNCOMMENT TO WRITE EVERY FILE INTO THE SAME SHEET
 
     # write_to_new_sheet(tables) # UNCOMMENT TO WRITE EVERY FILE INTO NEW SHEETS
 
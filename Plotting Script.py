@@ -1,12 +1,20 @@
 # Name: Thanh T. Tran
 # Date: 2/17/2022
-# Task: Generate PNG of 3 channels vs. plots. 
+# Task: Generate PNG of every channel vs. plots. 
 #           Include a legend, date created, and "Additional Notes" text box
 
+import argparse
 import os
-from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
+from functools import partial
+from wainamics.rendering import get_template, set_lines, add_render_arguments, render_settings_from_args
+from wainamics.figures import parse_other, build_raw_figure
+from wainamics.report import run_reported
+from wainamics.loader import file_date
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments
+from wainamics.scan import add_scan_arguments, runs_from_args
+from wainamics.manifest import add_manifest_arguments, manifest_from_args
+from wainamics.profiling import profiled, add_profile_arguments, profile_from_args
 
 SECONDS_PER_SAMPLE = 10
 
@@ -19,83 +27,57 @@ def calculate_time(time_col):
         sum += SECONDS_PER_SAMPLE
     return time
 
-def parse_other(df_other):
-    """ Returns a string of Additional Notes and everything after. """
-    additional_notes = ""
-    found = False
-    for cell in df_other:   
-        if "Additional Notes" in cell:
-            found = True
-        if found:
-            additional_notes += cell + "\n"
-    return additional_notes
-
-def generate_plot(date, file_name):
+@profiled("render")
+def generate_plot(run, render=None):
     """ Generate the plot with the date of creation and file name. """
-    if not ".xlsx" in file_name or "~$" in file_name:
-        return
-
-    df = pd.read_excel(file_name)
+    file_name = run.file_name
+    df = run.optics
     
     time = calculate_time(df.iloc[:, 0])
-
-    # Begin plotting
-    plt.figure(figsize=(15,10))
+    traces = run.traces()
+    template = get_template(build_raw_figure, run.channel_count())
 
     # Plotting raw data
-    plt.subplot(2, 2, 1)
-    plt.title("Raw")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU")
-    plt.xticks([0, 1200, 2400, 3600])
-    plt.grid(True)
-
-    plt.plot(time, df['Channel 1'], label='Channel 1')
-    plt.plot(time, df['Channel 2'], label='Channel 2')
-    plt.plot(time, df['Channel 3'], label='Channel 3')
-
-    plt.legend()
+    set_lines(template.raw, time, traces.T)
 
     # Plotting normalized data
-    ax1 = plt.subplot(2, 2, 2)
-    plt.title("Normalized")
-    plt.xlabel("Time (s)")
-    plt.ylabel("RFU Gain")
-    plt.xticks([0, 1200, 2400, 3600])
-    ax1.set_ylim(bottom=1, top=6)
-    plt.yticks([1, 2, 3, 4, 5, 6])
-    plt.grid(True)
-
-    norm_ch1 = df.iloc[:,1].astype(float) / df.iloc[0,1]
-    norm_ch2 = df.iloc[:,2].astype(float) / df.iloc[0,2]
-    norm_ch3 = df.iloc[:,3].astype(float) / df.iloc[0,3]
-
-    plt.plot(time, norm_ch1, label='Channel 1')
-    plt.plot(time, norm_ch2, label='Channel 2')
-    plt.plot(time, norm_ch3, label='Channel 3')
-
-    plt.legend()
+    set_lines(template.normalized, time, (traces / traces[0]).T)
 
     # Format plot with date and Additional Notes
-    ax2 = plt.subplot(2, 2, 3)
-    ax2.set_axis_off()
-    df_other = pd.read_excel(file_name, sheet_name='Others')
-    additional_notes = parse_other(df_other.iloc[:,0])
-    plt.suptitle(file_name + "\n" + str(date), fontsize = 14)
-    plt.text(0, 0.65, additional_notes)
-
-    png_name = file_name[:len(file_name)-5]
-    plt.savefig(png_name + '.png', dpi = 300)
-    # plt.show()
+    additional_notes = parse_other(run.others)
+    template.title.set_text(file_name + "\n" + str(run.date))
+    template.notes.set_text(additional_notes)
+
+    png_name = os.path.splitext(file_name)[0]
+    template.export(png_name + '.png', render, file_name)
+
+def output_names(file_name):
+    """ Returns the files generate_plot writes for file_name. """
+    return [os.path.splitext(file_name)[0] + '.png']
+
+def process_file(file_name, cache=None, render=None):
+    """ Load and plot a single run. Runs inside a worker process when --workers is used. """
+    generate_plot(load_cached_run(file_name, file_date(file_name), cache), render)
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Plot every .xlsx file in the current directory to a PNG")
+    add_scan_arguments(parser)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_manifest_arguments(parser)
+    add_profile_arguments(parser)
+    add_render_arguments(parser)
+    return parser.parse_args()
 
 def main():
     """ Loops through every .xlsx file in current directory and create tables to write to OUTPUT_FILENAME. """
-    current_dir = os.getcwd()
-    files = os.listdir(current_dir)
-
-    for file_name in files:
-        date = datetime.fromtimestamp(os.stat(file_name).st_ctime)
-        generate_plot(date, file_name)
+    args = parse_args()
+    profile_from_args(args)
+    render = render_settings_from_args(args)
+    manifest = manifest_from_args(args, "Plotting Script", {"SECONDS_PER_SAMPLE": SECONDS_PER_SAMPLE, "render": render.parameters()})
+    files = runs_from_args(args)
+    run_reported(render, partial(process_file, cache=cache_from_args(args), render=render), files, args.workers, manifest, output_names)
 
 if __name__ == '__main__':
     main()
@@ -4,43 +4,26 @@
 #   DATE | FILENAME | COLUMN | 20 MINS | 40 MINS | 60 MINS
 #                               EXP VS ACT
 
+import argparse
 import os
-from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
-import numpy as np
+from functools import partial
+from wainamics.loader import file_date
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments
+from wainamics.scan import add_scan_arguments, runs_from_args, shard_file_name
+from wainamics.manifest import add_manifest_arguments, manifest_from_args, iter_incremental
+from wainamics.profiling import profiled, add_profile_arguments, profile_from_args
+from wainamics.table_writer import TableWriter
+from wainamics.timepoints import Timepoints, add_timepoint_arguments, timepoints_from_args
 
 OUTPUT_FILENAME = "Table Output.xlsx"
 
-def create_table(date, file_name, col_b, col_c, col_d, ratio_bd, ratio_cd):
-    """ Create a table with the desired formatting. """
-    data = { 'Date Created': [date, np.nan, np.nan, np.nan],
-                'File Name': [file_name, np.nan, np.nan, np.nan],
-                'Minutes': [0, 20, 40, 60],
-                'Ch 1': col_b,
-                'Ch 2': col_c,
-                'Ch 3' : col_d,
-                'Ch1 / Ch3' : ratio_bd,
-                'Ch2 / Ch3' : ratio_cd
-    }
-    table = pd.DataFrame(data)
-    table = table.fillna('')
-    return table
-
-
-def calculate_intervals():
-    """ Calculate the intervals between each sample. Change SECONDS_PER_SAMPLE based on sampling rate. """
-    SECONDS_PER_SAMPLE = 10
-    seconds_per_minute = 60
-    minutes = [0, 20, 40, 60]
-    intervals = [int(minutes[0] * seconds_per_minute / SECONDS_PER_SAMPLE + 1),         # Off by one
-                    int(minutes[1] * seconds_per_minute / SECONDS_PER_SAMPLE),
-                    int(minutes[2] * seconds_per_minute / SECONDS_PER_SAMPLE),
-                    int(minutes[3] * seconds_per_minute / SECONDS_PER_SAMPLE - 1)]      # [, ) 
-    return intervals
+# Change SECONDS_PER_SAMPLE depending on how often the machine samples data
+SECONDS_PER_SAMPLE = 10
 
 def plot_table(table):
     """ Plot the current table to inspect formatting. """
+    import matplotlib.pyplot as plt
     plt.rcParams["figure.figsize"] = [10, 5]
     plt.rcParams["figure.autolayout"] = True
     fig, ax = plt.subplots()
@@ -54,72 +37,67 @@ def plot_table(table):
     the_table.set_fontsize(7)
     plt.show()
 
-def format_table(date, file_name):
+@profiled("format_table")
+def format_table(run, timepoints=None):
     """ Format the table with the date of creation and file name. """
-    if not ".xlsx" in file_name:
-        return
-
-    df = pd.read_excel(file_name)
-    intervals = calculate_intervals()
-
-    if intervals[3] > len(df.iloc[:, 1]) or intervals[3] > len(df.iloc[:, 1]) or intervals[3] > len(df.iloc[:, 1]):
-        col_b = [df.iloc[intervals[0], 1], df.iloc[intervals[1], 1], df.iloc[intervals[2], 1], df.iloc[len(df.iloc[:, 1]) - 1, 1]]
-        col_c = [df.iloc[intervals[0], 2], df.iloc[intervals[1], 2], df.iloc[intervals[2], 2], df.iloc[len(df.iloc[:, 2]) - 1, 2]]
-        col_d = [df.iloc[intervals[0], 3], df.iloc[intervals[1], 3], df.iloc[intervals[2], 3], df.iloc[len(df.iloc[:, 3]) - 1, 3]]
-    else:
-        col_b = [df.iloc[intervals[0], 1], df.iloc[intervals[1], 1], df.iloc[intervals[2], 1], df.iloc[intervals[3] - 1, 1]]
-        col_c = [df.iloc[intervals[0], 2], df.iloc[intervals[1], 2], df.iloc[intervals[2], 2], df.iloc[intervals[3] - 1, 2]]
-        col_d = [df.iloc[intervals[0], 3], df.iloc[intervals[1], 3], df.iloc[intervals[2], 3], df.iloc[intervals[3] - 1, 3]]
-
-    ratio_bd = [float(format(i / j, '.4f')) for i, j in zip(col_b, col_d)]
-    ratio_cd = [float(format(i / j, '.4f')) for i, j in zip(col_c, col_d)]
-    
-    table = create_table(date, file_name, col_b, col_c, col_d, 
-                                ratio_bd, ratio_cd)
+    if timepoints is None:
+        timepoints = Timepoints(seconds_per_sample=SECONDS_PER_SAMPLE)
+    table = timepoints.table(run)
     # plot_table(table)
     return table
 
-def write_to_same_sheet(tables):
-    """ Write tables into the same sheet, skipping NEW_ROW amount of rows before writing the next table."""
-    start_row = 1
-    NEW_ROW = 6
-
-    for df in tables:
-        if df is None:
-            continue
-        if start_row == 1:
-            df.to_excel(OUTPUT_FILENAME)
-        else:
-            with pd.ExcelWriter(OUTPUT_FILENAME, mode="a", engine="openpyxl", if_sheet_exists="overlay") as writer:
-                df.to_excel(writer, startrow=start_row)
-        start_row += NEW_ROW
-
-def write_to_new_sheet(tables):
+@profiled("excel_write")
+def write_to_same_sheet(tables, new_row=6, file_name=OUTPUT_FILENAME):
+    """ Write tables into the same sheet, skipping new_row amount of rows before writing the next table."""
+    with TableWriter(file_name, same_sheet=True, new_row=new_row) as writer:
+        for df in tables:
+            if df is None:
+                continue
+            writer.write(df)
+
+@profiled("excel_write")
+def write_to_new_sheet(tables, file_name=OUTPUT_FILENAME):
     """ Write tables to a new sheet every time. """
-    start = 1
-    for df in tables:
-        if df is None:
-            continue
-        if start == 1:
-            start += 1
-            df.to_excel(OUTPUT_FILENAME)
-        else:
-            with pd.ExcelWriter(OUTPUT_FILENAME, mode="a", engine="openpyxl", if_sheet_exists="new") as writer:
-                df.to_excel(writer)
+    with TableWriter(file_name, same_sheet=False) as writer:
+        for df in tables:
+            if df is None:
+                continue
+            writer.write(df)
+
+def process_file(file_name, cache=None, timepoints=None):
+    """ Load a single run and return its table. Runs inside a worker process when --workers is used. """
+    run = load_cached_run(file_name, file_date(file_name), cache)
+    return format_table(run, timepoints)
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Write a table of every .xlsx file in the current directory to " + OUTPUT_FILENAME)
+    add_scan_arguments(parser)
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_manifest_arguments(parser)
+    add_profile_arguments(parser)
+    add_timepoint_arguments(parser)
+    return parser.parse_args()
 
 def main():
     """ Loops through every .xlsx file in current directory and create tables to write to OUTPUT_FILENAME. """
+    args = parse_args()
+    profile_from_args(args)
+    timepoints = timepoints_from_args(args, SECONDS_PER_SAMPLE)
     current_dir = os.getcwd()
-    if os.path.isfile(os.path.join(current_dir, OUTPUT_FILENAME)):
-        os.remove(os.path.join(current_dir, OUTPUT_FILENAME))
+    output_name = os.path.join(current_dir, shard_file_name(OUTPUT_FILENAME, args.shard))
+    manifest = manifest_from_args(args, "Table Script", {"timepoints": timepoints.parameters()})
+
+    files = runs_from_args(args, [OUTPUT_FILENAME])
+    tables, changed = iter_incremental(partial(process_file, cache=cache_from_args(args), timepoints=timepoints), files, args.workers, manifest)
+    if not changed and os.path.isfile(output_name):
+        return
 
-    tables = []
-    files = os.listdir(current_dir)
-    for file_name in files:
-        date = datetime.fromtimestamp(os.stat(file_name).st_ctime)
-        tables.append(format_table(date, file_name))
+    if os.path.isfile(output_name):
+        os.remove(output_name)
     
-    write_to_same_sheet(tables) # UNCOMMENT TO WRITE EVERY FILE INTO THE SAME SHEET
+    write_to_same_sheet(tables, timepoints.new_row(), output_name) # UNCOMMENT TO WRITE EVERY FILE INTO THE SAME SHEET
 
     # write_to_new_sheet(tables) # UNCOMMENT TO WRITE EVERY FILE INTO NEW SHEETS
 
@@ -0,0 +1,222 @@
+# Task: Time every stage of every script on synthetic runs and compare against stored baselines.
+#       Each script runs in its own process on a fresh copy of the runs, so imports, figure templates and
+#       peak RSS are measured per script. Stage times come from the same instrumentation as --profile, with
+#       allocation tracking left off so it does not slow the stages down. Startup is the time to run the
+#       script with --help in a new interpreter, which is interpreter start plus the script's imports.
+#
+#       python benchmarks/run_benchmarks.py --files 20 --samples 2000 --save-baseline
+#       python benchmarks/run_benchmarks.py --files 20 --samples 2000
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from synthetic import generate_runs
+from wainamics.profiling import PROFILER
+
+SCRIPTS = ["Table Script.py",
+           "Plotting Script.py",
+           "Plot & Table Script.py",
+           "Baseline Subtraction Script.py",
+           "Derivative Baseline Subtraction Script.py",
+           "Pipeline Script.py"]
+
+STAGES = ["parse", "format_table", "baseline_fit", "derivative", "render", "savefig", "excel_write", "other"]
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baselines.json")
+
+# Heavy libraries reported when a script run loaded them
+HEAVY_MODULES = ["pandas", "matplotlib", "scipy", "openpyxl"]
+
+# Stages faster than this are too noisy to flag
+NOISE_SECONDS = 0.05
+
+def peak_rss_megabytes():
+    """ Returns the peak resident memory of this process in MB, or None where it cannot be read. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+def load_script(script):
+    """ Import a script by file name without running its main. """
+    spec = importlib.util.spec_from_file_location("benchmarked_script", os.path.join(REPO_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def profile_script(script, directory):
+    """ Run script over directory with every stage timed. Returns the stage times, total and peak RSS. """
+    start = time.perf_counter()
+    module = load_script(script)
+    import_seconds = time.perf_counter() - start
+
+    os.chdir(directory)
+    sys.argv = [script, "--no-cache"]
+    PROFILER.enable(memory=False)
+    start = time.perf_counter()
+    module.main()
+    total = time.perf_counter() - start
+    records = PROFILER.disable()
+
+    totals = {}
+    calls = {}
+    for record in records:
+        totals[record["stage"]] = totals.get(record["stage"], 0.0) + record["wall_seconds"]
+        calls[record["stage"]] = calls.get(record["stage"], 0) + 1
+    stages = {stage: totals[stage] for stage in STAGES if stage in totals}
+    stages["other"] = max(total - sum(totals.values()), 0.0)
+    return {"import": import_seconds,
+            "total": total,
+            "stages": stages,
+            "calls": calls,
+            "modules": [name for name in HEAVY_MODULES if name in sys.modules],
+            "peak_rss_mb": peak_rss_megabytes()}
+
+def measure_startup(script, run_dir):
+    """ Returns the seconds a new interpreter takes to import script and print its --help. """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(REPO_DIR, script), "--help"], cwd=run_dir, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def run_child(script, run_dir, result_file):
+    """ Benchmark script in a new interpreter and return its result. """
+    command = [sys.executable, os.path.abspath(__file__), "--child", script, run_dir, result_file]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(result_file) as result:
+        return json.load(result)
+
+def benchmark(scripts, data_dir, work_dir, repeat):
+    """ Benchmark every script on a fresh copy of data_dir and keep each script's fastest repeat. """
+    results = {}
+    for script in scripts:
+        best = None
+        for i in range(repeat):
+            run_dir = os.path.join(work_dir, "run")
+            shutil.rmtree(run_dir, ignore_errors=True)
+            shutil.copytree(data_dir, run_dir)
+            result = run_child(script, run_dir, os.path.join(work_dir, "result.json"))
+            result["startup"] = measure_startup(script, run_dir)
+            if best is None or result["total"] < best["total"]:
+                best = result
+        results[script] = best
+        print(format_result(script, best))
+    return results
+
+def format_result(script, result):
+    """ Returns one line per script with its total, stage times and peak RSS. """
+    stages = ", ".join(stage + " " + format(seconds, ".3f") for stage, seconds in result["stages"].items())
+    line = script + ": " + format(result["total"], ".3f") + " s (" + stages + "), startup " + format(result["startup"], ".3f") + " s"
+    line += ", loaded " + (", ".join(result["modules"]) or "no heavy modules")
+    if result["peak_rss_mb"] is not None:
+        line += ", peak RSS " + format(result["peak_rss_mb"], ".1f") + " MB"
+    return line
+
+def config_key(args):
+    """ Returns the key baselines are stored under, one per workload. """
+    return "files=" + str(args.files) + ",samples=" + str(args.samples) + ",channels=" + str(args.channels)
+
+def compare(results, baseline, tolerance):
+    """ Returns a message for every script and stage that got slower or bigger than baseline allows. """
+    regressions = []
+    for script, result in results.items():
+        if script not in baseline:
+            continue
+        old = baseline[script]
+        measured = [("total", result["total"], old["total"]), ("startup", result["startup"], old.get("startup"))]
+        measured += [(stage, seconds, old["stages"].get(stage)) for stage, seconds in result["stages"].items()]
+        for name, new_seconds, old_seconds in measured:
+            if old_seconds is None or new_seconds - old_seconds < NOISE_SECONDS:
+                continue
+            if new_seconds > old_seconds * (1 + tolerance):
+                regressions.append(script + " " + name + ": " + format(old_seconds, ".3f") + " s -> " + format(new_seconds, ".3f") + " s")
+        if result["peak_rss_mb"] and old.get("peak_rss_mb") and result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(script + " peak RSS: " + format(old["peak_rss_mb"], ".1f") + " MB -> " + format(result["peak_rss_mb"], ".1f") + " MB")
+    return regressions
+
+def read_baselines(file_name):
+    """ Returns every stored baseline, keyed by workload. """
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name) as baselines:
+        return json.load(baselines)
+
+def write_baselines(file_name, baselines):
+    """ Store the baselines as readable JSON so changes to them show up in diffs. """
+    with open(file_name, "w") as output:
+        json.dump(baselines, output, indent=2, sort_keys=True)
+        output.write("\n")
+
+def parse_args():
+    """ Parse the command line options. """
+    parser = argparse.ArgumentParser(description="Benchmark the scripts on synthetic runs")
+    parser.add_argument("--files", type=int, default=10, help="number of synthetic runs (default: 10)")
+    parser.add_argument("--samples", type=int, default=400, help="samples per run, at least 360 (default: 400)")
+    parser.add_argument("--channels", type=int, default=3, help="channels per run (default: 3)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per script, the fastest is kept (default: 3)")
+    parser.add_argument("--script", dest="scripts", action="append", choices=SCRIPTS,
+                        help="benchmark only this script, can be given more than once (default: all of them)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file (default: benchmarks/baselines.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline for this workload")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a stage may slow down before it counts as a regression (default: 0.25)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    """ Generate the runs, benchmark the scripts and check them against the baseline. """
+    args = parse_args()
+    if args.child:
+        script, run_dir, result_file = args.child
+        result = profile_script(script, run_dir)
+        with open(result_file, "w") as output:
+            json.dump(result, output)
+        return 0
+
+    work_dir = tempfile.mkdtemp(prefix="wainamics_benchmark_")
+    try:
+        data_dir = os.path.join(work_dir, "data")
+        start = time.perf_counter()
+        generate_runs(data_dir, args.files, args.samples, args.channels)
+        print("Generated " + str(args.files) + " runs of " + str(args.samples) + " samples in " + format(time.perf_counter() - start, ".1f") + " s")
+        results = benchmark(args.scripts or SCRIPTS, data_dir, work_dir, args.repeat)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        write_baselines(args.output, {config_key(args): results})
+
+    baselines = read_baselines(args.baseline)
+    if args.save_baseline:
+        baselines.setdefault(config_key(args), {}).update(results)
+        write_baselines(args.baseline, baselines)
+        print("Saved baseline for " + config_key(args) + " to " + args.baseline)
+        return 0
+
+    if config_key(args) not in baselines:
+        print("No baseline for " + config_key(args) + ", run with --save-baseline to store one")
+        return 0
+    regressions = compare(results, baselines[config_key(args)], args.tolerance)
+    for regression in regressions:
+        print("Regression: " + regression)
+    if not regressions:
+        print("No regressions against " + args.baseline)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
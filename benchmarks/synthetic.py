@@ -0,0 +1,87 @@
+# Task: Generate synthetic run workbooks shaped like the instrument logs the scripts read.
+#       Each workbook has an Optics sheet (Time column, then Channel 1..N) holding a sloped baseline with a
+#       sigmoid rise and some noise, and an Others sheet ending in an "Additional Notes" block.
+#       The scripts need at least 360 samples per run for their 60 minute timepoint. The same runs can be
+#       written as CSV or TSV exports, with the Others lines as '#' notes above the header.
+
+import argparse
+import csv
+import os
+import numpy as np
+from openpyxl import Workbook
+
+SECONDS_PER_SAMPLE = 10
+
+OTHERS = ["Run Information", "Operator: Benchmark", "Instrument: Synthetic", "Additional Notes",
+          "Synthetic run for benchmarking", "Not a real sample"]
+
+def format_clock(seconds):
+    """ Returns seconds as an HH:MM:SS string like the instrument's time column. """
+    seconds = int(seconds)
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def synthetic_traces(samples, channels, seed=0):
+    """ Returns a (samples, channels) array of integer RFU readings. """
+    rng = np.random.default_rng(seed)
+    time = np.arange(samples) * SECONDS_PER_SAMPLE
+    rise_time = rng.uniform(1200, 2800, channels)
+    height = rng.uniform(100, 400, channels)
+    start = 1000.0 * np.arange(1, channels + 1)
+    slope = rng.uniform(0.3, 0.7, channels)
+    traces = (start + slope * time[:, np.newaxis]
+              + height / (1 + np.exp(-(time[:, np.newaxis] - rise_time) / 200))
+              + rng.normal(0, 5, (samples, channels)))
+    return np.rint(traces).astype(int)
+
+def write_run_workbook(file_name, samples=400, channels=3, seed=0):
+    """ Write one synthetic run to file_name. """
+    workbook = Workbook(write_only=True)
+    optics = workbook.create_sheet("Optics")
+    optics.append(["Time"] + ["Channel " + str(i + 1) for i in range(channels)])
+    for i, row in enumerate(synthetic_traces(samples, channels, seed).tolist()):
+        optics.append([format_clock(i * SECONDS_PER_SAMPLE)] + row)
+
+    others = workbook.create_sheet("Others")
+    for line in OTHERS:
+        others.append([line])
+    workbook.save(file_name)
+
+def write_run_text(file_name, samples=400, channels=3, seed=0, delimiter=","):
+    """ Write one synthetic run to file_name as a text export. """
+    with open(file_name, "w", newline="") as export:
+        # The first row of the Others sheet is its header, which the loader skips
+        for line in OTHERS[1:]:
+            export.write("# " + line + "\n")
+        writer = csv.writer(export, delimiter=delimiter)
+        writer.writerow(["Time"] + ["Channel " + str(i + 1) for i in range(channels)])
+        for i, row in enumerate(synthetic_traces(samples, channels, seed).tolist()):
+            writer.writerow([format_clock(i * SECONDS_PER_SAMPLE)] + row)
+
+FORMATS = ["xlsx", "csv", "tsv"]
+
+def generate_runs(directory, files=10, samples=400, channels=3, file_format="xlsx"):
+    """ Write files synthetic runs into directory and return their names. """
+    os.makedirs(directory, exist_ok=True)
+    file_names = []
+    for i in range(files):
+        file_name = os.path.join(directory, "synthetic_run_" + str(i).zfill(4) + "." + file_format)
+        if file_format == "xlsx":
+            write_run_workbook(file_name, samples, channels, seed=i)
+        else:
+            write_run_text(file_name, samples, channels, seed=i, delimiter="\t" if file_format == "tsv" else ",")
+        file_names.append(file_name)
+    return file_names
+
+def main():
+    """ Write synthetic runs into a directory from the command line. """
+    parser = argparse.ArgumentParser(description="Generate synthetic run workbooks")
+    parser.add_argument("directory")
+    parser.add_argument("--files", type=int, default=10, help="number of workbooks (default: 10)")
+    parser.add_argument("--samples", type=int, default=400, help="samples per run (default: 400)")
+    parser.add_argument("--channels", type=int, default=3, help="channels per run (default: 3)")
+    parser.add_argument("--format", choices=FORMATS, default="xlsx", help="file format of the runs (default: xlsx)")
+    args = parser.parse_args()
+    generate_runs(args.directory, args.files, args.samples, args.channels, args.format)
+
+if __name__ == '__main__':
+    main()
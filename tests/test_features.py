@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from wainamics.features import DerivativeFeatures
+
+# A baseline drifting at DRIFT RFU/s, with a rise of RISE RFU/s between rows START and END, 10 s apart
+DRIFT = 2.0
+RISE = 0.5
+START = 180
+END = 300
+
+def drifting_trace(samples=400, channels=2):
+    """ Returns a (samples, channels) trace whose rise starts at 1800 s on a baseline steeper than the rise. """
+    time = np.arange(samples) * 10.0
+    rise = RISE * (np.clip(time, START * 10.0, END * 10.0) - START * 10.0)
+    return np.repeat((1000 + DRIFT * time + rise)[:, None], channels, axis=1)
+
+def test_drifting_baseline():
+    """ The peak, threshold and onset are read off the baseline subtracted derivative. The central difference is
+        RISE / 2 at row START, so the 50 sample moving average first passes RISE / 2 halfway after it, at 1805 s,
+        and the tangent through the rise meets the baseline where the rise starts, at 1800 s. """
+    features = DerivativeFeatures(starting_row=0).block_features([drifting_trace()])[0]
+    assert features[0] == pytest.approx([RISE, RISE])
+    assert features[2] == pytest.approx([1805 / 60, 1805 / 60], abs=0.005)
+    assert features[3] == pytest.approx([30.0, 30.0])
+
+def test_drifting_baseline_threshold():
+    """ A threshold of 0.3 * RISE lies between the averages at rows START - 10 and START - 9, 14.5 and 15.5 rises
+        over 50 samples, so it is crossed halfway between them, at 1705 s. """
+    features = DerivativeFeatures(starting_row=0, threshold=0.3 * RISE).block_features([drifting_trace()])[0]
+    assert features[2] == pytest.approx([1705 / 60, 1705 / 60], abs=0.005)
+    assert features[3] == pytest.approx([30.0, 30.0])
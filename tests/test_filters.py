@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from wainamics.filters import FILTERS, apply_filters
+
+@pytest.mark.parametrize("name", sorted(FILTERS))
+@pytest.mark.parametrize("samples", [0, 1, 2, 5, 15, 16])
+def test_short_run(name, samples):
+    """ Runs shorter than the window, or than the Butterworth padding, are smoothed without raising. """
+    y = np.linspace(0, 1, samples * 3).reshape(samples, 3)
+    smoothed = apply_filters(y, [name], 50, 10)
+    assert smoothed.shape == y.shape
+    assert np.isfinite(smoothed).all()
+
+def test_butterworth_long_run_unchanged():
+    """ Runs long enough for the default padding are filtered exactly as sosfiltfilt does by default. """
+    from scipy.signal import butter, sosfiltfilt
+    y = np.random.default_rng(0).normal(size=(500, 3))
+    sos = butter(4, 0.1 / 50, output="sos", fs=0.1)
+    assert np.array_equal(FILTERS["butterworth"](y, 50, 10), sosfiltfilt(sos, y, axis=0))
@@ -0,0 +1,2 @@
+# Task: Shared helpers for the Wainamics log scripts. The scripts import this package from the
+#       folder they live in, so keep the "wainamics" folder next to them.
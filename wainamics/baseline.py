@@ -0,0 +1,182 @@
+# Task: Fit the straight-line baseline of every channel between t_0 and t_f in one closed-form solve and
+#       subtract it from the traces with a single broadcast. Used by both baseline subtraction scripts.
+#       traces are (samples, channels) arrays, or (runs, samples, channels) to fit a whole batch at once.
+#       BaselineModel picks a heavier correction for runs with curved drift or photobleaching: a higher degree
+#       polynomial over the same window, a smoothed rolling minimum, or asymmetric least squares over the whole
+#       trace. Each handles every channel at once and costs time linear in the trace length. The rolling minimum
+#       and asymmetric least squares need scipy, which is only imported when one of them is asked for.
+
+import numpy as np
+from wainamics.profiling import profiled
+
+def baseline_window(t_0, t_f, seconds_per_sample):
+    """ Returns the sample slice and the x values (in seconds) of the [t_0, t_f) fitting window. """
+    sample_initial = int(t_0 / seconds_per_sample)
+    sample_final = int(t_f / seconds_per_sample)
+    x = np.arange(t_0, t_f, seconds_per_sample, dtype=float)
+    return slice(sample_initial, sample_final), x
+
+@profiled("baseline_fit")
+def fit_baselines(traces, t_0, t_f, seconds_per_sample):
+    """ Least squares line y = m * x + b over [t_0, t_f) for every channel. Returns (slopes, intercepts),
+        each shaped like traces without the sample axis. """
+    window, x = baseline_window(t_0, t_f, seconds_per_sample)
+    y = np.asarray(traces, dtype=float)[..., window, :]
+    if y.shape[-2] != len(x):
+        raise ValueError("Traces have " + str(y.shape[-2]) + " samples in the baseline window, expected " + str(len(x)))
+
+    # Normal equations of a first degree fit, solved for every channel and run together
+    x_centered = x - x.mean()
+    y_mean = y.mean(axis=-2)
+    slopes = np.einsum("i,...ic->...c", x_centered, y) / np.dot(x_centered, x_centered)
+    intercepts = y_mean - slopes * x.mean()
+    return slopes, intercepts
+
+def equation_labels(slopes, intercepts):
+    """ Returns the legend entry with the line of best fit of every channel. """
+    return ["Channel " + str(i + 1) + ": y = " + str(round(slope, 4)) + "x + " + str(round(intercept, 4))
+            for i, (slope, intercept) in enumerate(zip(slopes, intercepts))]
+
+def subtract_baselines(traces, time, slopes, intercepts):
+    """ Returns traces minus each channel's fitted line evaluated at time. """
+    time = np.asarray(time, dtype=float)[:, np.newaxis]
+    expected = slopes[..., np.newaxis, :] * time + intercepts[..., np.newaxis, :]
+    return np.asarray(traces, dtype=float) - expected
+
+BASELINE_MODELS = ["linear", "polynomial", "rolling_min", "als"]
+
+# Degree of the polynomial baseline
+DEFAULT_DEGREE = 2
+
+# Seconds the rolling minimum looks across
+DEFAULT_ROLLING_SECONDS = 600
+
+# Smoothness and asymmetry of the asymmetric least squares baseline, and its most reweighting passes
+DEFAULT_ALS_LAMBDA = 1e5
+DEFAULT_ALS_P = 0.01
+ALS_ITERATIONS = 10
+
+def polynomial_baselines(traces, time, t_0, t_f, seconds_per_sample, degree=DEFAULT_DEGREE):
+    """ Least squares polynomial of degree over [t_0, t_f) for every channel, in one solve.
+        Returns (expected at time, coefficients) with coefficients[i] the x^i term of every channel. """
+    from numpy.polynomial import polynomial
+    window, x = baseline_window(t_0, t_f, seconds_per_sample)
+    y = np.asarray(traces, dtype=float)[window]
+    if len(y) != len(x) or len(x) <= degree:
+        raise ValueError("Traces have " + str(len(y)) + " samples in the baseline window, a degree " + str(degree) + " fit needs " + str(max(len(x), degree + 1)))
+    coefficients = polynomial.polyfit(x, y, degree)
+    return polynomial.polyval(np.asarray(time, dtype=float), coefficients).T, coefficients
+
+def rolling_min_baselines(traces, window_size):
+    """ Minimum of every channel over window_size samples, smoothed by a mean over the same window so the
+        baseline does not step. Both filters cost O(n) whatever the window. """
+    from scipy.ndimage import minimum_filter1d, uniform_filter1d
+    minimum = minimum_filter1d(np.asarray(traces, dtype=float), window_size, axis=0, mode="nearest")
+    return uniform_filter1d(minimum, window_size, axis=0, mode="nearest")
+
+def second_difference_band(samples, lam):
+    """ Returns lam * D'D, D the second difference matrix of samples points, in solveh_banded's upper form. """
+    band = np.zeros((3, samples))
+    band[2, :-2] += 1
+    band[2, 1:-1] += 4
+    band[2, 2:] += 1
+    band[1, 1:-1] -= 2
+    band[1, 2:] -= 2
+    band[0, 2:] = 1
+    return lam * band
+
+def als_baselines(traces, lam=DEFAULT_ALS_LAMBDA, p=DEFAULT_ALS_P, iterations=ALS_ITERATIONS):
+    """ Asymmetric least squares baseline of every channel (Eilers and Boelens): a smooth curve that readings
+        above it pull on with weight p and readings below with weight 1 - p. Every channel is one block of a
+        single banded system, so each reweighting pass is one O(n) banded Cholesky solve for the whole run. """
+    from scipy.linalg import solveh_banded
+    y = np.asarray(traces, dtype=float)
+    samples, channels = y.shape
+    if samples < 3:
+        raise ValueError("Traces have " + str(samples) + " samples, asymmetric least squares needs 3")
+
+    # The bands of each channel start with zeros, so tiling them leaves the channels uncoupled
+    band = np.tile(second_difference_band(samples, lam), channels)
+    smoothness = band[2].copy()
+    readings = y.T.ravel()
+    weights = np.ones_like(readings)
+    for _ in range(iterations):
+        band[2] = smoothness + weights
+        fitted = solveh_banded(band, weights * readings, check_finite=False)
+        new_weights = np.where(readings > fitted, p, 1 - p)
+        if np.array_equal(new_weights, weights):
+            break
+        weights = new_weights
+    return fitted.reshape(channels, samples).T
+
+def format_coefficient(value):
+    """ Returns a fitted coefficient with four significant figures. """
+    return "%.4g" % value
+
+def polynomial_labels(coefficients):
+    """ Returns the legend entry with the fitted polynomial of every channel, highest power first. """
+    labels = []
+    for i, channel in enumerate(np.asarray(coefficients).T):
+        terms = [format_coefficient(value) + ("x^" + str(power) if power > 1 else "x" if power == 1 else "")
+                 for power, value in reversed(list(enumerate(channel)))]
+        labels.append("Channel " + str(i + 1) + ": y = " + " + ".join(terms))
+    return labels
+
+def range_labels(description, expected):
+    """ Returns the legend entry of every channel of a baseline without an equation: what it is and where it runs. """
+    return ["Channel " + str(i + 1) + ": " + description + ", " + format_coefficient(column[0]) + " to " + format_coefficient(column[-1])
+            for i, column in enumerate(np.asarray(expected).T)]
+
+class BaselineModel:
+    """ Which baseline the scripts subtract. linear is the line of best fit over [t_0, t_f) the scripts have
+        always used. degree, rolling_seconds, lam and p only apply to their own model. """
+
+    def __init__(self, model="linear", degree=DEFAULT_DEGREE, rolling_seconds=DEFAULT_ROLLING_SECONDS, lam=DEFAULT_ALS_LAMBDA, p=DEFAULT_ALS_P):
+        self.model = model
+        self.degree = degree
+        self.rolling_seconds = rolling_seconds
+        self.lam = lam
+        self.p = p
+
+    def subtract(self, traces, time, t_0, t_f, seconds_per_sample):
+        """ Returns (traces minus the baseline of every channel, the legend entries with each channel's fit). """
+        traces = np.asarray(traces, dtype=float)
+        if self.model == "linear":
+            slopes, intercepts = fit_baselines(traces, t_0, t_f, seconds_per_sample)
+            return subtract_baselines(traces, time, slopes, intercepts), equation_labels(slopes, intercepts)
+        if self.model == "polynomial":
+            expected, coefficients = polynomial_baselines(traces, time, t_0, t_f, seconds_per_sample, self.degree)
+            return traces - expected, polynomial_labels(coefficients)
+        if self.model == "rolling_min":
+            window_size = max(int(round(self.rolling_seconds / seconds_per_sample)), 1)
+            expected = rolling_min_baselines(traces, window_size)
+            return traces - expected, range_labels("rolling minimum over " + format_coefficient(self.rolling_seconds) + " s", expected)
+        expected = als_baselines(traces, self.lam, self.p)
+        return traces - expected, range_labels("ALS, lambda " + format_coefficient(self.lam) + ", p " + format_coefficient(self.p), expected)
+
+    def parameters(self):
+        """ Returns the settings that change the baseline, for the manifest. """
+        if self.model == "linear":
+            return {"model": self.model}
+        settings = {"polynomial": {"degree": self.degree},
+                    "rolling_min": {"rolling_seconds": self.rolling_seconds},
+                    "als": {"lambda": self.lam, "p": self.p}}
+        return dict({"model": self.model}, **settings[self.model])
+
+def add_baseline_arguments(parser):
+    """ Add the options that choose the baseline model of the baseline subtraction scripts. """
+    group = parser.add_argument_group("baseline")
+    group.add_argument("--baseline", choices=BASELINE_MODELS, default="linear",
+                       help="baseline subtracted from every channel (default: linear, the line of best fit between T_0 and T_F)")
+    group.add_argument("--degree", type=int, default=DEFAULT_DEGREE,
+                       help="degree of the polynomial baseline, fitted between T_0 and T_F (default: " + str(DEFAULT_DEGREE) + ")")
+    group.add_argument("--rolling-window", type=float, default=DEFAULT_ROLLING_SECONDS, metavar="SECONDS",
+                       help="seconds the rolling_min baseline looks across (default: " + str(DEFAULT_ROLLING_SECONDS) + ")")
+    group.add_argument("--als-lambda", type=float, default=DEFAULT_ALS_LAMBDA,
+                       help="smoothness of the als baseline, larger is stiffer (default: %g)" % DEFAULT_ALS_LAMBDA)
+    group.add_argument("--als-p", type=float, default=DEFAULT_ALS_P,
+                       help="weight of readings above the als baseline, between 0 and 1 (default: " + str(DEFAULT_ALS_P) + ")")
+
+def baseline_from_args(args):
+    """ Returns the BaselineModel asked for on the command line. """
+    return BaselineModel(args.baseline, args.degree, args.rolling_window, args.als_lambda, args.als_p)
@@ -0,0 +1,85 @@
+# Task: Fan per-file work out to a pool of worker processes and collect the results in file order.
+#       A file that fails is reported and skipped so the rest of the batch still finishes.
+#       The figure templates a process built are closed when its batch finishes, and in the workers when they shut down.
+
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from wainamics.profiling import PROFILER, WAIT_STAGE, add_records, call_for_file, call_profiled
+
+# Number of worker processes used when --workers is not given. 1 keeps the old one-file-at-a-time behaviour.
+DEFAULT_WORKERS = 1
+
+def add_batch_arguments(parser):
+    """ Add the --workers option shared by every script. """
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="number of worker processes, 0 uses every core (default: 1)")
+
+def count_workers(workers, file_count):
+    """ Returns how many worker processes to start for file_count files. """
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, file_count))
+
+def report_failure(file_name, error):
+    """ Print which file failed and why without stopping the batch. """
+    print("Failed to process " + file_name + ": " + repr(error))
+    traceback.print_exception(type(error), error, error.__traceback__)
+
+def release_figures():
+    """ Close the figure templates this process built, if it has drawn any. """
+    rendering = sys.modules.get("wainamics.rendering")
+    if rendering is not None:
+        rendering.release_templates()
+
+def start_worker():
+    """ Pool initializer that releases the worker's figures when it shuts down. Pool workers leave without running
+        atexit, so the release is hooked into multiprocessing's own exit instead. """
+    from multiprocessing.util import Finalize
+    Finalize(None, release_figures, exitpriority=0)
+
+def iter_batch(worker, file_names, workers=DEFAULT_WORKERS, failed=None):
+    """ Call worker(file_name) for every file and yield the results in the same order as soon as each is ready.
+        Failed files give None and are appended to failed when a list is passed. """
+    if failed is None:
+        failed = []
+    workers = count_workers(workers, len(file_names))
+
+    if workers == 1:
+        for file_name in file_names:
+            try:
+                result = call_for_file(worker, file_name)
+            except Exception as error:
+                report_failure(file_name, error)
+                failed.append(file_name)
+                result = None
+            yield result
+    else:
+        # worker must be a module level function so it can be sent to the pool
+        profiling = PROFILER.enabled
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_worker) as pool:
+            if profiling:
+                # Workers profile themselves and send their records back with each result
+                futures = [pool.submit(call_profiled, worker, file_name) for file_name in file_names]
+            else:
+                futures = [pool.submit(worker, file_name) for file_name in file_names]
+            for i, (file_name, future) in enumerate(zip(file_names, futures)):
+                try:
+                    if profiling:
+                        # Waiting gets its own stage so the caller's stage, such as the Excel write, stays exclusive
+                        result, records = PROFILER.call(WAIT_STAGE, future.result, (), {})
+                        add_records(records)
+                    else:
+                        result = future.result()
+                except Exception as error:
+                    report_failure(file_name, error)
+                    failed.append(file_name)
+                    result = None
+                # Drop the finished future so its result is not kept alive until the batch ends
+                futures[i] = None
+                yield result
+
+    release_figures()
+    if failed:
+        print(str(len(failed)) + " of " + str(len(file_names)) + " files failed, see above")
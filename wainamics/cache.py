@@ -0,0 +1,134 @@
+# Task: Keep an on-disk cache of parsed runs so rerunning a script over an unchanged folder skips openpyxl.
+#       Every workbook gets one .npz entry named after its path. The entry stores the file's size and
+#       modification time, so editing or replacing the workbook invalidates it automatically. Once the cache
+#       grows past its size cap the least recently used entries are deleted.
+
+import hashlib
+import os
+import tempfile
+import zipfile
+import numpy as np
+from wainamics.loader import Run, file_date, load_run
+from wainamics.profiling import profiled
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "wainamics")
+DEFAULT_MAX_MEGABYTES = 1024
+
+# Bump CACHE_VERSION whenever the loader changes what it reads, so older entries are ignored
+CACHE_VERSION = 2
+
+# Scanning the cache folder on every write would make large batches quadratic, so roughly one new entry
+# in EVICT_INTERVAL triggers an eviction pass. Scripts also evict once when they start.
+EVICT_INTERVAL = 32
+
+def fingerprint(file_name):
+    """ Returns the size, modification time and cache version that an entry must match to be reused. """
+    stat = os.stat(file_name)
+    return np.array([stat.st_size, stat.st_mtime_ns, CACHE_VERSION], dtype=np.int64)
+
+class RunCache:
+    """ Directory of .npz files holding the Optics and Others data of previously parsed workbooks. """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_megabytes=DEFAULT_MAX_MEGABYTES):
+        self.directory = directory
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+
+    def entry_key(self, file_name):
+        """ Returns the hex digest of the absolute path of file_name. """
+        return hashlib.sha1(os.path.abspath(file_name).encode("utf-8")).hexdigest()
+
+    def entry_path(self, file_name):
+        """ Returns the cache file used for file_name. """
+        return os.path.join(self.directory, self.entry_key(file_name) + ".npz")
+
+    def get(self, file_name, date):
+        """ Returns the cached Run of file_name, or None when there is no up to date entry. """
+        import pandas as pd
+        path = self.entry_path(file_name)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                if not np.array_equal(entry["fingerprint"], fingerprint(file_name)):
+                    return None
+                names = [str(name) for name in entry["columns"]]
+                optics = pd.DataFrame({name: entry["column_" + str(i)] for i, name in enumerate(names)})
+                others = [str(cell) for cell in entry["others"]]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+
+        # Mark the entry as recently used for eviction
+        os.utime(path)
+        return Run(file_name, date, optics, others)
+
+    def put(self, run):
+        """ Store run in the cache, occasionally evicting old entries if the cache is over its size cap. """
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {"fingerprint": fingerprint(run.file_name),
+                  "columns": np.array([str(name) for name in run.optics.columns], dtype=str),
+                  "others": np.array(run.others, dtype=str)}
+        for i, name in enumerate(run.optics.columns):
+            column = run.optics[name].to_numpy()
+            # Time stamps come back from openpyxl as strings or datetime objects, keep them as text
+            if column.dtype == object:
+                column = column.astype(str)
+            arrays["column_" + str(i)] = column
+
+        # Write to a temporary file first so other worker processes never read a half written entry
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as temp_file:
+            np.savez(temp_file, **arrays)
+        os.replace(temp_path, self.entry_path(run.file_name))
+        if int(self.entry_key(run.file_name)[:8], 16) % EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """ Delete the least recently used entries until the cache fits in max_bytes. """
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(".npz"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass    # Another worker evicted it first
+            total -= size
+
+@profiled("parse")
+def load_cached_run(file_name, date=None, cache=None):
+    """ Load file_name from cache when possible, otherwise parse it and store the result. """
+    if date is None:
+        date = file_date(file_name)
+    if cache is None:
+        return load_run(file_name, date)
+
+    run = cache.get(file_name, date)
+    if run is None:
+        run = load_run(file_name, date)
+        cache.put(run)
+    return run
+
+def add_cache_arguments(parser):
+    """ Add the options that control the run cache. """
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="folder for cached runs (default: " + DEFAULT_CACHE_DIR + ")")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_MEGABYTES,
+                        help="size cap of the cache in MB (default: " + str(DEFAULT_MAX_MEGABYTES) + ")")
+    parser.add_argument("--no-cache", action="store_true", help="always parse the workbooks")
+
+def cache_from_args(args):
+    """ Returns the RunCache selected on the command line, or None when caching is switched off. """
+    if args.no_cache:
+        return None
+    cache = RunCache(args.cache_dir, args.cache_size)
+    cache.evict()
+    return cache
@@ -0,0 +1,97 @@
+# Task: Hold the arrays of one run that several outputs are drawn from.
+#       Each array is computed the first time an output asks for it and then reused, so a run that is both
+#       tabulated and plotted three ways is still only normalized, fitted and differentiated once.
+
+import numpy as np
+from wainamics.baseline import BaselineModel
+from wainamics.filters import DEFAULT_FILTERS, apply_filters
+from wainamics.profiling import profiled
+
+class RunData:
+    """ Shared arrays of a run. Arrays named trimmed_* and everything derived from the baseline start at starting_row,
+        the others start at the first sample like the Plotting Script. """
+
+    def __init__(self, run, starting_row, seconds_per_sample, t_0, t_f, window_size, filters=DEFAULT_FILTERS, baseline=None):
+        self.run = run
+        self.starting_row = starting_row
+        self.seconds_per_sample = seconds_per_sample
+        self.t_0 = t_0
+        self.t_f = t_f
+        self.window_size = window_size
+        self.filters = filters
+        self.baseline_model = baseline or BaselineModel()
+        self.arrays = {}
+
+    def cached(self, name, compute):
+        """ Returns the array called name, computing it the first time. """
+        if name not in self.arrays:
+            self.arrays[name] = compute()
+        return self.arrays[name]
+
+    def time(self):
+        """ Returns the time in seconds of every sample. """
+        return self.cached("time", lambda: np.arange(len(self.run.optics), dtype=float) * self.seconds_per_sample)
+
+    def traces(self):
+        """ Returns the channel readings as a (samples, channels) array. """
+        return self.cached("traces", self.run.traces)
+
+    def channel_count(self):
+        """ Returns how many channels the run has. """
+        return self.run.channel_count()
+
+    def normalized(self):
+        """ Returns the traces divided by their first sample. """
+        return self.cached("normalized", lambda: self.traces() / self.traces()[0])
+
+    def trimmed_time(self):
+        """ Returns the time of every sample from starting_row on. """
+        return self.time()[self.starting_row:]
+
+    def trimmed_traces(self):
+        """ Returns the traces from starting_row on. """
+        return self.traces()[self.starting_row:]
+
+    def trimmed_normalized(self):
+        """ Returns the traces from starting_row on divided by their sample at starting_row. """
+        return self.cached("trimmed_normalized", lambda: self.trimmed_traces() / self.trimmed_traces()[0])
+
+    def baseline_sub(self):
+        """ Returns the trimmed traces minus the baselines of the baseline model. """
+        return self.subtracted_baseline()[0]
+
+    def baseline_labels(self):
+        """ Returns the legend entry with every channel's fitted baseline. """
+        return self.subtracted_baseline()[1]
+
+    def subtracted_baseline(self):
+        """ Returns (baseline_sub, labels), fitting the baseline model the first time. """
+        return self.cached("baseline_sub", lambda: self.baseline_model.subtract(self.trimmed_traces(), self.trimmed_time(),
+                                                                                 self.t_0, self.t_f, self.seconds_per_sample))
+
+    def derivative(self):
+        """ Returns dRFU / dt of the trimmed traces. """
+        return self.cached("derivative", self.compute_derivative)
+
+    @profiled("derivative")
+    def compute_derivative(self):
+        """ Take the derivative of every channel in one call. """
+        return np.gradient(self.trimmed_traces(), self.trimmed_time(), axis=0)
+
+    def smooth_derivative(self):
+        """ Returns the derivative smoothed by the filter chain. """
+        return self.cached("smooth_derivative", self.compute_smooth_derivative)
+
+    @profiled("derivative")
+    def compute_smooth_derivative(self):
+        """ Smooth every channel of the derivative together. """
+        return apply_filters(self.derivative(), self.filters, self.window_size, self.seconds_per_sample)
+
+    def smooth_subtracted_derivative(self):
+        """ Returns the derivative of the baseline subtracted traces smoothed by the filter chain, which the features of curved baselines are read off. """
+        return self.cached("smooth_subtracted_derivative", self.compute_smooth_subtracted_derivative)
+
+    @profiled("derivative")
+    def compute_smooth_subtracted_derivative(self):
+        """ Differentiate and smooth every channel of the baseline subtracted traces together. """
+        return apply_filters(np.gradient(self.baseline_sub(), self.trimmed_time(), axis=0), self.filters, self.window_size, self.seconds_per_sample)
@@ -0,0 +1,148 @@
+# Task: Pull the numbers usually read off the derivative plots out of every channel of every run:
+#       the height and time of the peak of the smoothed derivative, when the derivative first reaches a threshold,
+#       and the onset, where the tangent to the baseline subtracted trace at its steepest point meets the baseline.
+#       Every feature is read off the smoothed derivative of the baseline subtracted trace, so a drifting baseline
+#       neither lifts the peak nor tilts the tangent, and the samples the moving average pads with zeros are left
+#       out, where its ramp would otherwise cross a threshold first.
+#       Runs of the same length are stacked into one (runs, samples, channels) block, so the baseline fit, the
+#       gradient, the smoothing and every feature are one vectorized pass per group instead of one per run.
+
+import numpy as np
+from wainamics.baseline import BaselineModel, fit_baselines, subtract_baselines
+from wainamics.filters import DEFAULT_FILTERS, apply_filters, padded_samples
+
+# Rows added below the minutes of a table, in order
+FEATURE_LABELS = ["Peak dRFU/dt", "Peak Minute", "Threshold Minute", "Onset Minute"]
+
+# Without --threshold, the threshold is this fraction of each channel's own peak
+THRESHOLD_FRACTION = 0.5
+
+# Decimal places of the derivative peaks and of the feature minutes in the tables
+PEAK_DECIMALS = 4
+MINUTE_DECIMALS = 2
+
+SECONDS_PER_MINUTE = 60
+
+def extract_features(time, baseline_sub, smooth_derivative, threshold=None, edges=(0, 0)):
+    """ Returns the features of (runs, samples, channels) arrays sampled at time as a (runs, features, channels) array:
+        peak dRFU / dt, then the peak, threshold and onset times in seconds. NaN where a feature does not exist.
+        smooth_derivative is the smoothed derivative of baseline_sub, and edges how many of its samples at the
+        start and at the end are left out, see padded_samples. """
+    start, end = edges
+    samples = baseline_sub.shape[1]
+    if start + end >= samples:
+        return np.full((baseline_sub.shape[0], len(FEATURE_LABELS), baseline_sub.shape[2]), np.nan)
+    time = np.asarray(time, dtype=float)[start:samples - end]
+    baseline_sub = baseline_sub[:, start:samples - end]
+    smooth_derivative = smooth_derivative[:, start:samples - end]
+    runs = np.arange(smooth_derivative.shape[0])[:, None]
+    channels = np.arange(smooth_derivative.shape[2])[None, :]
+
+    peak = np.argmax(smooth_derivative, axis=1)
+    peak_value = smooth_derivative[runs, peak, channels]
+    peak_time = time[peak]
+
+    # First sample at or above the threshold, placed between it and the sample before
+    level = peak_value * THRESHOLD_FRACTION if threshold is None else np.full_like(peak_value, threshold)
+    above = smooth_derivative >= level[:, None, :]
+    first = np.argmax(above, axis=1)
+    before = np.maximum(first - 1, 0)
+    low = smooth_derivative[runs, before, channels]
+    high = smooth_derivative[runs, first, channels]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fraction = np.where(first > 0, (level - low) / (high - low), 0.0)
+        crossing = np.where(above.any(axis=1), time[before] + fraction * (time[first] - time[before]), np.nan)
+        onset = np.where(peak_value > 0, peak_time - baseline_sub[runs, peak, channels] / peak_value, np.nan)
+    return np.stack([peak_value, peak_time, crossing, onset], axis=1)
+
+def feature_rows(features):
+    """ Returns (features, channels) values from extract_features as they appear in the tables, times in minutes. """
+    rows = np.array(features, dtype=float)
+    rows[0] = np.round(rows[0], PEAK_DECIMALS)
+    rows[1:] = np.round(rows[1:] / SECONDS_PER_MINUTE, MINUTE_DECIMALS)
+    return rows
+
+class DerivativeFeatures:
+    """ How the derivative is taken and smoothed before its features are read, matching the constants of the
+        Derivative Baseline Subtraction Script. threshold=None uses half of each channel's peak, and the onset
+        is read against baseline, a BaselineModel, or the line of best fit when it is None. """
+
+    def __init__(self, starting_row=5, seconds_per_sample=10, t_0=60 * 5, t_f=60 * 15, window_size=50, filters=DEFAULT_FILTERS, threshold=None, baseline=None):
+        self.starting_row = starting_row
+        self.seconds_per_sample = seconds_per_sample
+        self.t_0 = t_0
+        self.t_f = t_f
+        self.window_size = window_size
+        self.filters = list(filters)
+        self.threshold = threshold
+        self.baseline = baseline or BaselineModel()
+
+    def edges(self):
+        """ Returns how many samples at the start and at the end of the smoothed derivative are left out. """
+        return padded_samples(self.filters, self.window_size)
+
+    def run_features(self, data):
+        """ Returns the table rows of a RunData, from the baseline it has already subtracted for the plots. """
+        try:
+            baseline_sub = data.baseline_sub()
+            if self.baseline.model == "linear":
+                # The derivative of a line is its slope, so the plots' smoothed derivative only needs the slope taken off
+                slopes, _ = fit_baselines(data.trimmed_traces(), self.t_0, self.t_f, self.seconds_per_sample)
+                smooth_derivative = data.smooth_derivative() - slopes
+            else:
+                smooth_derivative = data.smooth_subtracted_derivative()
+        except ValueError:
+            return np.full((len(FEATURE_LABELS), data.channel_count()), np.nan)    # Too short for the baseline window
+        features = extract_features(data.trimmed_time(), baseline_sub[None], smooth_derivative[None], self.threshold, self.edges())
+        return feature_rows(features[0])
+
+    def block_features(self, traces):
+        """ Returns the table rows of every (samples, channels) array in traces, one pass per group of equal shape. """
+        shapes = {}
+        for i, trace in enumerate(traces):
+            shapes.setdefault(trace.shape, []).append(i)
+
+        rows = [None] * len(traces)
+        for (samples, channels), group in shapes.items():
+            block = np.stack([traces[i] for i in group])[:, self.starting_row:].astype(float)
+            try:
+                values = self.group_features(block)
+            except ValueError:
+                values = np.full((len(group), len(FEATURE_LABELS), channels), np.nan)
+            for j, i in enumerate(group):
+                rows[i] = feature_rows(values[j])
+        return rows
+
+    def group_features(self, block):
+        """ Returns the features of a (runs, samples, channels) block of runs trimmed to starting_row. """
+        time = (np.arange(block.shape[1]) + self.starting_row) * float(self.seconds_per_sample)
+        if self.baseline.model == "linear":
+            slopes, intercepts = fit_baselines(block, self.t_0, self.t_f, self.seconds_per_sample)
+            baseline_sub = subtract_baselines(block, time, slopes, intercepts)
+            # The derivative of a line is its slope, taken off once the traces' derivative is smoothed, as in run_features
+            derivative = np.gradient(block, time, axis=1)
+        else:
+            baseline_sub = np.stack([self.baseline.subtract(trace, time, self.t_0, self.t_f, self.seconds_per_sample)[0] for trace in block])
+            derivative = np.gradient(baseline_sub, time, axis=1)
+            slopes = np.zeros((block.shape[0], block.shape[2]))
+        # The filters smooth along the first axis, so the samples go first while the block is smoothed
+        smooth_derivative = apply_filters(derivative.transpose(1, 0, 2), self.filters, self.window_size, self.seconds_per_sample).transpose(1, 0, 2)
+        return extract_features(time, baseline_sub, smooth_derivative - slopes[:, None, :], self.threshold, self.edges())
+
+    def parameters(self):
+        """ Returns the settings that change the features, for the manifest. """
+        return {"starting_row": self.starting_row, "seconds_per_sample": self.seconds_per_sample, "t_0": self.t_0, "t_f": self.t_f,
+                "window_size": self.window_size, "filters": self.filters, "threshold": self.threshold, "baseline": self.baseline.parameters()}
+
+def add_feature_arguments(parser):
+    """ Add the options that add derivative features to the tables. """
+    parser.add_argument("--features", action="store_true",
+                        help="add the peak, threshold and onset of every channel's smoothed derivative below the minutes of each table")
+    parser.add_argument("--threshold", type=float, metavar="DRFU",
+                        help="dRFU / dt of the baseline subtracted trace the threshold minute is read at (default: half of each channel's peak)")
+
+def features_from_args(args, starting_row, seconds_per_sample, t_0, t_f, window_size, filters=DEFAULT_FILTERS, baseline=None):
+    """ Returns the DerivativeFeatures asked for on the command line, or None without --features. """
+    if not args.features:
+        return None
+    return DerivativeFeatures(starting_row, seconds_per_sample, t_0, t_f, window_size, filters, args.threshold, baseline)
@@ -0,0 +1,92 @@
+# Task: Lay out the raw, baseline subtraction and derivative figures in one place.
+#       The Plotting, Baseline Subtraction and Derivative Baseline Subtraction Scripts and the Pipeline Script
+#       all draw into these templates, so a layout change is made once and every script's PNGs follow it.
+
+from wainamics.loader import additional_notes as parse_other
+from wainamics.rendering import FigureTemplate, time_axes, add_lines, channel_labels
+
+def title_of(run):
+    """ Returns the figure title with the file name and date of creation. """
+    return run.file_name + "\n" + str(run.date)
+
+def build_raw_figure(channels=3):
+    """ Build the raw plot layout once per channel count. Each run only swaps in its data. """
+    template = FigureTemplate(figsize=(15,10))
+    fig = template.figure
+
+    # Plotting raw data
+    ax0 = time_axes(fig.add_subplot(2, 2, 1), "Raw", "RFU")
+    template.raw = add_lines(ax0, channel_labels(channels))
+
+    # Plotting normalized data
+    ax1 = time_axes(fig.add_subplot(2, 2, 2), "Normalized", "RFU Gain")
+    ax1.set_ylim(bottom=1, top=6)
+    ax1.set_yticks([1, 2, 3, 4, 5, 6])
+    template.normalized = add_lines(ax1, channel_labels(channels))
+
+    # Format plot with date and Additional Notes
+    ax2 = fig.add_subplot(2, 2, 3)
+    ax2.set_axis_off()
+    template.title = fig.suptitle("", fontsize = 14)
+    template.notes = ax2.text(0, 0.65, "")
+    return template
+
+def build_baseline_figure(channels=3):
+    """ Build the baseline subtraction plot layout once per channel count. """
+    template = FigureTemplate(figsize=(15,10))
+    fig = template.figure
+
+    # Plotting raw data
+    ax0 = time_axes(fig.add_subplot(2, 2, 1), "Raw", "RFU")
+    template.raw = add_lines(ax0, channel_labels(channels))
+
+    # Plotting normalized data
+    ax1 = time_axes(fig.add_subplot(2, 2, 2), "Normalized", "RFU Gain")
+    ax1.set_ylim(bottom=1, top=6)
+    ax1.set_yticks([1, 2, 3, 4, 5, 6])
+    template.normalized = add_lines(ax1, channel_labels(channels))
+
+    # Format plot with Baseline Subtraction, the legend is rebuilt with each run's equations
+    ax2 = time_axes(fig.add_subplot(2, 2, 3), "Baseline Subtraction", "Actual - Expected RFU")
+    template.baseline_sub = add_lines(ax2, channel_labels(channels))
+
+    # Format plot with date and Additional Notes
+    ax3 = fig.add_subplot(2, 2, 4)
+    ax3.set_axis_off()
+    template.title = fig.suptitle("", fontsize = 14)
+    template.notes = ax3.text(0, 0, "")
+    return template
+
+def build_derivative_figure(channels=3):
+    """ Build the derivative plot layout once per channel count. The smoothed derivative's title is set with each run's filters. """
+    template = FigureTemplate(figsize=(20,15))
+    fig = template.figure
+
+    # Plotting raw data
+    ax0 = time_axes(fig.add_subplot(3, 2, 1), "Raw", "RFU")
+    template.raw = add_lines(ax0, channel_labels(channels))
+
+    # Plotting normalized data
+    ax1 = time_axes(fig.add_subplot(3, 2, 2), "Normalized", "RFU Gain")
+    ax1.set_ylim(bottom=1, top=6)
+    ax1.set_yticks([1, 2, 3, 4, 5, 6])
+    template.normalized = add_lines(ax1, channel_labels(channels))
+
+    # Format plot with Baseline Subtraction, the legend is rebuilt with each run's equations
+    ax2 = time_axes(fig.add_subplot(3, 2, 3), "Baseline Subtraction", "Actual - Expected RFU")
+    template.baseline_sub = add_lines(ax2, channel_labels(channels))
+
+    # Format plot with date and Additional Notes
+    ax3 = fig.add_subplot(3, 2, 4)
+    ax3.set_axis_off()
+    template.title = fig.suptitle("", fontsize = 14)
+    template.notes = ax3.text(0, 0.65, "")
+
+    # Plotting raw derivative data
+    ax4 = time_axes(fig.add_subplot(3, 2, 5), "Raw Derivative", "dRFU / dt")
+    template.derivative = add_lines(ax4, channel_labels(channels, " Derivative"))
+
+    # Plotting smoothed derivative data
+    template.smooth_axes = time_axes(fig.add_subplot(3, 2, 6), "", "dRFU / dt")
+    template.smooth_derivative = add_lines(template.smooth_axes, channel_labels(channels, " Derivative"))
+    return template
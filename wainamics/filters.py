@@ -0,0 +1,75 @@
+# Task: Smooth derivative traces with a chain of filters.
+#       Every filter works on a whole (samples, channels) array at once. The moving average uses cumulative
+#       sums so its cost does not depend on the window size. Savitzky-Golay and the zero-phase Butterworth
+#       filter need scipy, which is only imported when one of them is asked for.
+
+import numpy as np
+
+# Polynomial order of the Savitzky-Golay fit in each window
+SAVGOL_ORDER = 2
+
+# Order of the Butterworth low-pass filter. Its cutoff is the first null of a moving average of the same window.
+BUTTER_ORDER = 4
+
+def moving_average(y, window_size, seconds_per_sample=None):
+    """ Moving average over window_size samples of every column of y, the same as
+        np.convolve(column, np.ones(window_size) / window_size, mode='same') but in O(n). """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    sums = np.concatenate([np.zeros((1,) + y.shape[1:]), np.cumsum(y, axis=0)])
+    index = np.arange(n)
+    low = np.clip(index - window_size // 2, 0, n)
+    high = np.clip(index + (window_size - 1) // 2 + 1, 0, n)
+    return (sums[high] - sums[low]) / window_size
+
+def savitzky_golay(y, window_size, seconds_per_sample=None):
+    """ Savitzky-Golay smoothing of every column of y. Even windows are widened by one sample, and windows longer
+        than the run are shortened to it. Single samples are returned as they are. """
+    from scipy.signal import savgol_filter
+    y = np.asarray(y, dtype=float)
+    if len(y) < 2:
+        return y
+    window_length = min(window_size | 1, len(y) if len(y) % 2 else len(y) - 1)
+    return savgol_filter(y, window_length, min(SAVGOL_ORDER, window_length - 1), axis=0)
+
+def butterworth(y, window_size, seconds_per_sample):
+    """ Zero-phase Butterworth low-pass of every column of y, run forwards and backwards as second order sections.
+        Runs shorter than the filter's usual padding are padded by what they have, and single samples are returned as they are. """
+    from scipy.signal import butter, sosfiltfilt
+    y = np.asarray(y, dtype=float)
+    if len(y) < 2:
+        return y
+    sample_rate = 1.0 / seconds_per_sample
+    cutoff = min(sample_rate / window_size, 0.99 * sample_rate / 2)
+    sos = butter(BUTTER_ORDER, cutoff, output="sos", fs=sample_rate)
+    # sosfiltfilt's default padding, which must be shorter than the run
+    padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+    return sosfiltfilt(sos, y, axis=0, padlen=min(padlen, len(y) - 1))
+
+FILTERS = {"moving_average": moving_average,
+           "savgol": savitzky_golay,
+           "butterworth": butterworth}
+
+DEFAULT_FILTERS = ["moving_average"]
+
+def padded_samples(filters, window_size):
+    """ Returns how many samples at the start and at the end of a run the filter chain averages with the zeros
+        the moving average pads the run with. Savitzky-Golay and Butterworth fit or mirror the ends instead. """
+    count = sum(1 for name in filters if name == "moving_average")
+    return count * (window_size // 2), count * ((window_size - 1) // 2)
+
+def apply_filters(y, filters, window_size, seconds_per_sample):
+    """ Run y through each named filter in turn and return the result. """
+    for name in filters:
+        y = FILTERS[name](y, window_size, seconds_per_sample)
+    return y
+
+def add_filter_arguments(parser):
+    """ Add the --filter option used by the scripts that smooth derivatives. """
+    parser.add_argument("--filter", dest="filters", action="append", choices=sorted(FILTERS),
+                        help="smoothing filter for the derivative, give it more than once to chain filters "
+                             "(default: moving_average)")
+
+def filters_from_args(args):
+    """ Returns the filter chain asked for on the command line. """
+    return args.filters or DEFAULT_FILTERS
@@ -0,0 +1,256 @@
+# Task: Analyse a run while the instrument is still writing it.
+#       A follower reads the rows appended to a growing CSV/TSV log, or the new rows of an .xlsx file that is
+#       saved periodically. Every new sample updates running sums, so the [t_0, t_f) baseline fit, the
+#       derivative and the moving average of the derivative cost O(1) per sample. Outputs are refreshed
+#       from those sums at a fixed interval instead of re-analysing the whole trace on every tick: a refresh
+#       only recomputes the last window of the moving average, whose samples are still arriving.
+
+import csv
+import io
+import os
+import time as clock
+import numpy as np
+from wainamics.loader import CHANNEL_PREFIX, NOTE_PREFIX, find_channel_columns, load_run
+from wainamics.filters import moving_average
+
+class GrowingArray:
+    """ Append-only 2-D array that doubles its buffer when full. """
+
+    def __init__(self, width, capacity=1024):
+        self.buffer = np.empty((capacity, width))
+        self.length = 0
+
+    def append(self, row):
+        """ Add one row. """
+        if self.length == len(self.buffer):
+            self.buffer = np.concatenate([self.buffer, np.empty_like(self.buffer)])
+        self.buffer[self.length] = row
+        self.length += 1
+
+    def view(self):
+        """ Returns the rows added so far without copying them. """
+        return self.buffer[:self.length]
+
+    def __len__(self):
+        return self.length
+
+class LiveRun:
+    """ Growing trace of one run with running sums for its baseline fit and derivatives.
+        Samples before starting_row are counted for the time axis but otherwise skipped, like the batch scripts. """
+
+    def __init__(self, channel_count, starting_row, t_0, t_f, seconds_per_sample, window_size):
+        self.starting_row = starting_row
+        self.seconds_per_sample = seconds_per_sample
+        self.window_size = window_size
+        self.rows_seen = 0
+        self.traces = GrowingArray(channel_count)
+
+        # Finished central differences and their prefix sums, which give any moving average in O(1)
+        self.derivative = GrowingArray(channel_count)
+        self.derivative_sums = GrowingArray(channel_count)
+        self.derivative_sums.append(np.zeros(channel_count))
+        # Moving averages whose window lies entirely within the finished derivative, so no later sample changes them
+        self.smoothed = GrowingArray(channel_count)
+
+        # Running sums of the [t_0, t_f) line fit, x in seconds as in fit_baselines
+        self.window_start = int(t_0 / seconds_per_sample)
+        self.window_end = int(t_f / seconds_per_sample)
+        self.t_0 = t_0
+        self.fit_n = 0
+        self.fit_sx = 0.0
+        self.fit_sxx = 0.0
+        self.fit_sy = np.zeros(channel_count)
+        self.fit_sxy = np.zeros(channel_count)
+
+    def add(self, values):
+        """ Add the channel values of the next sample and update every running sum. """
+        self.rows_seen += 1
+        if self.rows_seen <= self.starting_row:
+            return
+        values = np.asarray(values, dtype=float)
+        index = len(self.traces)
+        self.traces.append(values)
+
+        if self.window_start <= index < self.window_end:
+            x = self.t_0 + (index - self.window_start) * self.seconds_per_sample
+            self.fit_n += 1
+            self.fit_sx += x
+            self.fit_sxx += x * x
+            self.fit_sy += values
+            self.fit_sxy += x * values
+
+        # A new sample completes the derivative of the one before it
+        traces = self.traces.view()
+        if index == 1:
+            self.add_derivative((traces[1] - traces[0]) / self.seconds_per_sample)
+        elif index >= 2:
+            self.add_derivative((traces[index] - traces[index - 2]) / (2 * self.seconds_per_sample))
+
+    def add_derivative(self, value):
+        """ Store a finished derivative sample, extend its prefix sums and finish the moving average it completes. """
+        self.derivative.append(value)
+        self.derivative_sums.append(self.derivative_sums.view()[-1] + value)
+        sums = self.derivative_sums.view()
+        while len(self.smoothed) + (self.window_size - 1) // 2 + 1 <= len(self.derivative):
+            index = len(self.smoothed)
+            low = max(index - self.window_size // 2, 0)
+            high = index + (self.window_size - 1) // 2 + 1
+            self.smoothed.append((sums[high] - sums[low]) / self.window_size)
+
+    def baseline(self):
+        """ Returns (slopes, intercepts) of the samples of [t_0, t_f) seen so far, NaN until there are two. """
+        n = self.fit_n
+        if n < 2:
+            nan = np.full_like(self.fit_sy, np.nan)
+            return nan, nan
+        slopes = (n * self.fit_sxy - self.fit_sx * self.fit_sy) / (n * self.fit_sxx - self.fit_sx ** 2)
+        intercepts = (self.fit_sy - slopes * self.fit_sx) / n
+        return slopes, intercepts
+
+    def time(self):
+        """ Returns the time in seconds of every sample kept, like calculate_time()[STARTING_ROW:]. """
+        return (self.starting_row + np.arange(len(self.traces))) * float(self.seconds_per_sample)
+
+    def full_derivative(self):
+        """ Returns the derivative of every sample, the newest one taken one-sided like np.gradient does. """
+        traces = self.traces.view()
+        if len(traces) < 2:
+            return np.zeros_like(traces)
+        last = (traces[-1] - traces[-2]) / self.seconds_per_sample
+        return np.concatenate([self.derivative.view(), last[np.newaxis]])
+
+    def smooth_derivative(self):
+        """ Returns the moving average of the derivative over window_size samples, matching
+            np.convolve(..., mode='same') with zeros beyond either end. Only the samples whose window
+            reaches the newest, one-sided derivative are computed here, the rest were finished as they arrived. """
+        if len(self.traces) < 2:
+            return moving_average(self.full_derivative(), self.window_size)
+        finished = self.smoothed.view()
+        n = len(self.traces)
+        start = max(len(finished) - self.window_size // 2, 0)
+        # Prefix sums from start on, the last one including the newest derivative
+        sums = self.derivative_sums.view()[start:]
+        sums = np.concatenate([sums, sums[-1:] + self.full_derivative()[-1]])
+        index = np.arange(len(finished), n)
+        low = np.maximum(index - self.window_size // 2, 0) - start
+        high = np.minimum(index + (self.window_size - 1) // 2 + 1, n) - start
+        return np.concatenate([finished, (sums[high] - sums[low]) / self.window_size])
+
+    def snapshot(self):
+        """ Returns the arrays the derivative script plots, computed from the running sums. """
+        traces = self.traces.view().copy()
+        time = self.time()
+        slopes, intercepts = self.baseline()
+        return {"time": time,
+                "traces": traces,
+                "normalized": traces / traces[0],
+                "slopes": slopes,
+                "intercepts": intercepts,
+                "baseline_sub": traces - (slopes * time[:, np.newaxis] + intercepts),
+                "derivative": self.full_derivative(),
+                "smooth_derivative": self.smooth_derivative()}
+
+class TextLogFollower:
+    """ Reads the rows appended to a CSV or TSV log since the last call. """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.delimiter = "\t" if file_name.lower().endswith((".tsv", ".txt")) else ","
+        self.offset = 0
+        self.columns = None
+        self.channel_names = None
+        self.others = []
+
+    def read_rows(self):
+        """ Returns the channel values of every complete line written since the last call. """
+        with open(self.file_name, "rb") as log:
+            log.seek(self.offset)
+            data = log.read()
+        # Only use complete lines, the instrument may be half way through writing the last one
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        lines = io.StringIO(data[:end].decode("utf-8-sig"))
+
+        rows = []
+        for row in csv.reader(lines, delimiter=self.delimiter):
+            if not row:
+                continue
+            if self.columns is None and row[0].startswith(NOTE_PREFIX):
+                # Notes above the header, as the batch loader reads them
+                self.others.append(self.delimiter.join(row)[len(NOTE_PREFIX):].strip())
+                continue
+            if self.columns is None:
+                self.columns = find_channel_columns(row)
+                self.channel_names = [row[i] if i < len(row) else CHANNEL_PREFIX + " " + str(i) for i in self.columns]
+                continue
+            rows.append([float(row[i]) if i < len(row) and row[i] != "" else np.nan for i in self.columns])
+        return rows
+
+class SnapshotFollower:
+    """ Reads the new rows of an .xlsx file that the instrument saves again every so often. """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.modified = None
+        self.rows_read = 0
+        self.channel_names = None
+        self.others = []
+
+    def read_rows(self):
+        """ Returns the channel values of the rows added since the last snapshot that was read. """
+        modified = os.stat(self.file_name).st_mtime_ns
+        if modified == self.modified:
+            return []
+        try:
+            run = load_run(self.file_name)
+        except Exception:
+            return []   # The instrument is still saving, try again on the next poll
+        self.modified = modified
+        self.channel_names = [str(name) for name in run.optics.columns[1:]]
+        self.others = run.others
+        values = run.optics.iloc[self.rows_read:, 1:].to_numpy(dtype=float)
+        self.rows_read = len(run.optics)
+        return list(values)
+
+def follower_for(file_name):
+    """ Returns the follower that matches the extension of file_name. """
+    if file_name.lower().endswith(".xlsx"):
+        return SnapshotFollower(file_name)
+    return TextLogFollower(file_name)
+
+def follow(file_name, refresh, starting_row, t_0, t_f, seconds_per_sample, window_size,
+           interval=30.0, poll=1.0, idle_timeout=600.0):
+    """ Follow file_name until it stops growing for idle_timeout seconds, calling refresh(follower, live_run)
+        at most every interval seconds while new samples arrive, and once more at the end. """
+    follower = follower_for(file_name)
+    live_run = None
+    last_refresh = None
+    last_growth = clock.monotonic()
+    pending = False
+
+    try:
+        while True:
+            rows = follower.read_rows() if os.path.isfile(file_name) else []
+            now = clock.monotonic()
+            if rows:
+                last_growth = now
+                if live_run is None:
+                    live_run = LiveRun(len(follower.channel_names), starting_row, t_0, t_f, seconds_per_sample, window_size)
+                for values in rows:
+                    live_run.add(values)
+                pending = True
+
+            ready = live_run is not None and len(live_run.traces) >= 2
+            if pending and ready and (last_refresh is None or now - last_refresh >= interval):
+                refresh(follower, live_run)
+                last_refresh = now
+                pending = False
+            if now - last_growth >= idle_timeout:
+                break
+            clock.sleep(poll)
+    except KeyboardInterrupt:
+        pass
+
+    if pending and live_run is not None and len(live_run.traces) >= 2:
+        refresh(follower, live_run)
+    return live_run
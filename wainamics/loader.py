@@ -0,0 +1,200 @@
+# Task: Open a run workbook once and read everything the scripts need from it in one streaming pass.
+#       The resulting Run is handed to the table, plot and baseline stages so no stage re-parses the file.
+#       Runs exported as CSV or TSV are read by pandas' C parser instead, which is many times faster than
+#       parsing the XML of a workbook. Their notes come from '#' lines above the header row and from an
+#       optional <name>.notes.txt next to them, in place of the Others sheet. Workbooks are read with
+#       python-calamine when it is installed and openpyxl otherwise. Every reader goes through the same row
+#       handling, so a run gives the same arrays whichever format it was saved in.
+
+import csv
+import os
+from datetime import datetime
+
+OPTICS_SHEET = "Optics"
+OTHERS_SHEET = "Others"
+
+# Columns whose header starts with CHANNEL_PREFIX are read as channels. Files without such headers
+# fall back to DEFAULT_CHANNEL_COLUMNS, the three columns after the time column.
+CHANNEL_PREFIX = "Channel"
+DEFAULT_CHANNEL_COLUMNS = [1, 2, 3]
+TIME_COLUMN = 0
+
+TEXT_EXTENSIONS = {".csv": ",", ".tsv": "\t"}
+
+# Lines of a text export starting with NOTE_PREFIX hold what the Others sheet holds in a workbook
+NOTE_PREFIX = "#"
+NOTES_SUFFIX = ".notes.txt"
+
+class Run:
+    """ Parsed contents of a single run workbook. """
+
+    def __init__(self, file_name, date, optics, others):
+        self.file_name = file_name
+        self.date = date
+        self.optics = optics    # DataFrame: time column followed by the channel columns
+        self.others = others    # List of strings from column A of the Others sheet
+
+    def __len__(self):
+        return len(self.optics)
+
+    def channel_count(self):
+        """ Returns how many channels the run has. """
+        return self.optics.shape[1] - 1
+
+    def traces(self):
+        """ Returns the readings of every channel as a (samples, channels) array. """
+        return self.optics.iloc[:, 1:].to_numpy(dtype=float)
+
+def is_run_file(file_name):
+    """ Returns True for run workbooks and text exports, skipping Excel's ~$ lock files. Text files only count
+        when they have a channel header, so other CSV files in the folder, such as --profile traces, are left alone. """
+    if "~$" in file_name:
+        return False
+    if ".xlsx" in file_name:
+        return True
+    if is_text_log(file_name):
+        try:
+            return any(isinstance(name, str) and name.startswith(CHANNEL_PREFIX) for name in read_text_header(file_name)[1])
+        except (OSError, UnicodeDecodeError):
+            return False
+    return False
+
+def is_text_log(file_name):
+    """ Returns True when file_name has the extension of a CSV or TSV export. """
+    return os.path.splitext(file_name)[1].lower() in TEXT_EXTENSIONS
+
+def text_delimiter(file_name):
+    """ Returns the delimiter of a CSV or TSV export. """
+    return TEXT_EXTENSIONS[os.path.splitext(file_name)[1].lower()]
+
+def file_date(file_name):
+    """ Returns the creation date shown in the plot titles and tables. """
+    return datetime.fromtimestamp(os.stat(file_name).st_ctime)
+
+def additional_notes(others):
+    """ Returns the "Additional Notes" line of the Others sheet and everything after it, as the figures and the store show them. """
+    notes = ""
+    found = False
+    for cell in others:
+        if "Additional Notes" in cell:
+            found = True
+        if found:
+            notes += cell + "\n"
+    return notes
+
+def find_channel_columns(header):
+    """ Returns the indices of the channel columns in the Optics header row. """
+    columns = [i for i, name in enumerate(header) if isinstance(name, str) and name.startswith(CHANNEL_PREFIX)]
+    if not columns:
+        columns = DEFAULT_CHANNEL_COLUMNS
+    return columns
+
+def column_names(header, columns):
+    """ Returns the header of each of columns, naming blank ones like pd.read_excel does. """
+    return [header[i] if i < len(header) and header[i] is not None and header[i] != "" else "Unnamed: " + str(i) for i in columns]
+
+def optics_frame(header, rows):
+    """ Returns the time column and the channel columns of the rows under header as a DataFrame. """
+    import pandas as pd
+    columns = [TIME_COLUMN] + find_channel_columns(header)
+    kept = []
+    for row in rows:
+        values = [row[i] if i < len(row) and row[i] != "" else None for i in columns]
+        # Instruments pad the sheet with formatted but empty rows, so stop at the first blank one
+        if all(value is None for value in values):
+            break
+        kept.append(values)
+    return pd.DataFrame(kept, columns=column_names(header, columns))
+
+def read_optics(sheet):
+    """ Read the time column and the channel columns of an openpyxl Optics sheet into a DataFrame. """
+    header = next(sheet.iter_rows(max_row=1, values_only=True), ())
+    columns = [TIME_COLUMN] + find_channel_columns(header)
+    return optics_frame(header, sheet.iter_rows(min_row=2, max_col=max(columns) + 1, values_only=True))
+
+def read_others(sheet):
+    """ Read column A of the Others sheet, skipping the header row like pd.read_excel does. """
+    others = []
+    for (cell,) in sheet.iter_rows(min_row=2, max_col=1, values_only=True):
+        if cell is not None:
+            others.append(str(cell))
+    return others
+
+def read_text_header(file_name):
+    """ Returns (notes, header, lines before the header row) of a CSV or TSV export. """
+    notes = []
+    with open(file_name, newline="", encoding="utf-8-sig") as log:
+        for skipped, line in enumerate(log):
+            if not line.startswith(NOTE_PREFIX):
+                header = next(csv.reader([line], delimiter=text_delimiter(file_name)), [])
+                return notes, header, skipped
+            notes.append(line[len(NOTE_PREFIX):].strip())
+    return notes, [], len(notes)
+
+def read_notes_file(file_name):
+    """ Returns the lines of the notes file saved next to a text export, if there is one. """
+    notes_name = os.path.splitext(file_name)[0] + NOTES_SUFFIX
+    if not os.path.isfile(notes_name):
+        return []
+    with open(notes_name, encoding="utf-8-sig") as notes:
+        return [line.rstrip("\r\n") for line in notes if line.strip()]
+
+def load_text_run(file_name, date):
+    """ Read a CSV or TSV export with pandas' C parser and return it as a Run. """
+    import pandas as pd
+    notes, header, skipped = read_text_header(file_name)
+    columns = [TIME_COLUMN] + find_channel_columns(header)
+    optics = pd.read_csv(file_name, sep=text_delimiter(file_name), skiprows=skipped,
+                         usecols=columns, encoding="utf-8-sig", engine="c", skip_blank_lines=False)
+    # Same as the workbooks: the run ends at the first blank row
+    blank = optics.isna().all(axis=1).to_numpy()
+    if blank.any():
+        optics = optics.iloc[:blank.argmax()].reset_index(drop=True)
+    optics.columns = column_names(header, columns)
+    return Run(file_name, date, optics, notes + read_notes_file(file_name))
+
+def calamine_workbook():
+    """ Returns python-calamine's CalamineWorkbook, or None when it is not installed. """
+    try:
+        from python_calamine import CalamineWorkbook
+    except ImportError:
+        return None
+    return CalamineWorkbook
+
+def load_calamine_run(file_name, date, CalamineWorkbook):
+    """ Read a workbook with python-calamine, which parses it in Rust, and return it as a Run. """
+    workbook = CalamineWorkbook.from_path(file_name)
+    optics_name = OPTICS_SHEET if OPTICS_SHEET in workbook.sheet_names else workbook.sheet_names[0]
+    rows = workbook.get_sheet_by_name(optics_name).to_python(skip_empty_area=False)
+    optics = optics_frame(rows[0] if rows else [], rows[1:])
+    others = []
+    if OTHERS_SHEET in workbook.sheet_names:
+        for row in workbook.get_sheet_by_name(OTHERS_SHEET).to_python(skip_empty_area=False)[1:]:
+            if row and row[0] != "":
+                others.append(str(row[0]))
+    return Run(file_name, date, optics, others)
+
+def load_run(file_name, date=None):
+    """ Read file_name once and return its Optics and Others data as a Run. The reader is chosen by extension. """
+    if date is None:
+        date = file_date(file_name)
+    if is_text_log(file_name):
+        return load_text_run(file_name, date)
+    CalamineWorkbook = calamine_workbook()
+    if CalamineWorkbook is not None:
+        return load_calamine_run(file_name, date, CalamineWorkbook)
+
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_name, read_only=True, data_only=True)
+    try:
+        if OPTICS_SHEET in workbook.sheetnames:
+            optics = read_optics(workbook[OPTICS_SHEET])
+        else:
+            optics = read_optics(workbook.worksheets[0])
+        others = []
+        if OTHERS_SHEET in workbook.sheetnames:
+            others = read_others(workbook[OTHERS_SHEET])
+    finally:
+        workbook.close()
+
+    return Run(file_name, date, optics, others)
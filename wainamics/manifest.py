@@ -0,0 +1,160 @@
+# Task: Remember which runs a script has already processed so --incremental only redoes new or changed ones.
+#       The manifest lives next to the outputs and records, per script, the analysis parameters plus each
+#       input's size, modification time, output files and table. A run is processed again when any of
+#       those change or an output has gone missing. Tables of unchanged runs are restored from the
+#       manifest so the summary table can be rewritten without opening their workbooks.
+
+import json
+import os
+import tempfile
+from datetime import datetime
+from wainamics.batch import iter_batch
+from wainamics.scan import shard_file_name
+
+MANIFEST_FILENAME = ".wainamics_manifest.json"
+
+# Bump MANIFEST_VERSION when the scripts change what they produce, so every run is redone once
+MANIFEST_VERSION = 1
+
+def encode_cell(value):
+    """ Convert a table cell into something json can store. """
+    if isinstance(value, datetime):
+        if value != value:      # NaT
+            return None
+        return {"datetime": value.isoformat()}
+    if hasattr(value, "item"):
+        return value.item()     # numpy scalar
+    return value
+
+def decode_cell(value):
+    """ Undo encode_cell. """
+    if isinstance(value, dict) and "datetime" in value:
+        return datetime.fromisoformat(value["datetime"])
+    return value
+
+def encode_table(table):
+    """ Returns table as a json friendly dict. """
+    return {"columns": [str(name) for name in table.columns],
+            "rows": [[encode_cell(value) for value in row] for row in table.itertuples(index=False)]}
+
+def decode_table(data):
+    """ Rebuild a table stored by encode_table. """
+    import pandas as pd
+    rows = [[decode_cell(value) for value in row] for row in data["rows"]]
+    return pd.DataFrame(rows, columns=data["columns"])
+
+def input_fingerprint(file_name):
+    """ Returns the size and modification time of file_name. """
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class Manifest:
+    """ The entries a single script has recorded in MANIFEST_FILENAME. """
+
+    def __init__(self, section, parameters, path=MANIFEST_FILENAME):
+        self.section = section
+        self.parameters = dict(parameters, manifest_version=MANIFEST_VERSION)
+        self.path = path
+        self.entries = {}
+        self.pruned = False
+
+        sections = self.read_sections()
+        stored = sections.get(section, {})
+        # Changing a parameter invalidates every run of this script
+        if stored.get("parameters") == json.loads(json.dumps(self.parameters)):
+            self.entries = stored.get("runs", {})
+
+    def read_sections(self):
+        """ Returns every script's section of the manifest file. """
+        try:
+            with open(self.path) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+
+    def is_current(self, file_name, outputs=()):
+        """ Returns True when file_name and its outputs are unchanged since they were recorded. """
+        entry = self.entries.get(file_name)
+        if entry is None or entry["fingerprint"] != input_fingerprint(file_name):
+            return False
+        if sorted(entry["outputs"]) != sorted(outputs):
+            return False
+        return all(os.path.isfile(output) for output in outputs)
+
+    def record(self, file_name, outputs=(), table=None, fingerprint=None):
+        """ Remember that file_name produced outputs and table with the current parameters.
+            fingerprint is the input as it was read, when it may have changed since. """
+        self.entries[file_name] = {"fingerprint": fingerprint or input_fingerprint(file_name),
+                                   "outputs": list(outputs),
+                                   "table": None if table is None else encode_table(table)}
+
+    def table(self, file_name):
+        """ Returns the table recorded for file_name, or None. """
+        data = self.entries[file_name]["table"]
+        return None if data is None else decode_table(data)
+
+    def prune(self, file_names):
+        """ Drop entries of runs that are no longer in file_names. """
+        keep = set(file_names)
+        for file_name in list(self.entries):
+            if file_name not in keep:
+                del self.entries[file_name]
+                self.pruned = True
+
+    def save(self):
+        """ Write this script's section back, keeping the sections of the other scripts. """
+        sections = self.read_sections()
+        sections[self.section] = {"parameters": self.parameters, "runs": self.entries}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as temp_file:
+            json.dump(sections, temp_file)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, self.path)
+
+def add_manifest_arguments(parser):
+    """ Add the --incremental option. """
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process runs that are new or changed since the last run (see " + MANIFEST_FILENAME + ")")
+
+def manifest_from_args(args, section, parameters):
+    """ Returns the Manifest for section when --incremental was given, otherwise None. Shards keep their own. """
+    if not args.incremental:
+        return None
+    return Manifest(section, parameters, shard_file_name(MANIFEST_FILENAME, getattr(args, "shard", None)))
+
+def no_outputs(file_name):
+    """ Default for runs that do not write files of their own. """
+    return []
+
+def merge_results(worker, file_names, pending, workers, manifest, outputs):
+    """ Yield new results for the pending files and stored tables for the rest in file order, then save the manifest. """
+    failed = []
+    new_results = iter_batch(worker, pending, workers, failed)
+    pending_set = set(pending)
+
+    for file_name in file_names:
+        if file_name not in pending_set:
+            yield manifest.table(file_name)
+            continue
+        result = next(new_results)
+        # iter_batch records a failure just before yielding its None
+        if not failed or failed[-1] != file_name:
+            manifest.record(file_name, outputs(file_name), result if hasattr(result, "itertuples") else None)
+        yield result
+    manifest.save()
+
+    print("Processed " + str(len(pending)) + " new or changed of " + str(len(file_names)) + " files")
+
+def iter_incremental(worker, file_names, workers, manifest=None, outputs=None):
+    """ Returns (an iterator over the results of every file in order, whether anything changed).
+        worker only runs on files that need it, results of unchanged files are the tables stored in the manifest.
+        outputs(file_name) lists the files a run writes. """
+    if outputs is None:
+        outputs = no_outputs
+    if manifest is None:
+        return iter_batch(worker, file_names, workers), True
+
+    manifest.prune(file_names)
+    pending = [file_name for file_name in file_names if not manifest.is_current(file_name, outputs(file_name))]
+    return merge_results(worker, file_names, pending, workers, manifest, outputs), bool(pending) or manifest.pruned
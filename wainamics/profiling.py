@@ -0,0 +1,179 @@
+# Task: Record where a batch spends its time when --profile is given.
+#       Stage functions are wrapped with @profiled. While profiling is off the wrapper only checks one flag,
+#       so it costs next to nothing. While it is on, every call records the file it worked on, its wall time,
+#       CPU time and net allocations. Times are exclusive: a stage nested in another (parsing inside the Excel
+#       write loop, savefig inside generate_plot) is only counted in the inner stage. Worker processes send
+#       their records back with their results so the trace covers the whole batch.
+
+import atexit
+import csv
+import functools
+import json
+import time
+import tracemalloc
+
+TRACE_FIELDS = ["file", "stage", "wall_seconds", "cpu_seconds", "allocated_kb", "parent"]
+
+# parent is False for records sent back by worker processes, whose time overlaps the main process
+
+# Batch-wide stages such as the Excel write are recorded under this file name
+BATCH_FILE = "(batch)"
+
+# The main process waiting on its workers. It overlaps their stages, so it is reported apart from the shares.
+WAIT_STAGE = "wait"
+
+class Profiler:
+    """ Collects one record per stage call in this process. """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_file = None
+        self.records = []
+        self.file_name = BATCH_FILE
+        self.nested = []
+        self.start = None
+
+    def enable(self, trace_file=None, memory=True):
+        """ Start recording. memory=False skips tracemalloc, which slows allocation heavy stages down. """
+        self.enabled = True
+        self.trace_file = trace_file
+        self.records = []
+        self.nested = []
+        self.start = time.perf_counter()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        """ Stop recording and return the records collected so far. """
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        records = self.records
+        self.records = []
+        return records
+
+    def call(self, stage, function, args, kwargs):
+        """ Call function and record it as stage, minus the time and memory of the stages nested in it. """
+        self.nested.append([0.0, 0.0, 0])
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        allocated = tracemalloc.get_traced_memory()[0]
+        try:
+            return function(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            allocated = tracemalloc.get_traced_memory()[0] - allocated
+            inner = self.nested.pop()
+            self.records.append({"file": self.file_name,
+                                 "stage": stage,
+                                 "wall_seconds": wall - inner[0],
+                                 "cpu_seconds": cpu - inner[1],
+                                 "allocated_kb": (allocated - inner[2]) / 1024.0,
+                                 "parent": True})
+            if self.nested:
+                self.nested[-1][0] += wall
+                self.nested[-1][1] += cpu
+                self.nested[-1][2] += allocated
+
+# One profiler per process
+PROFILER = Profiler()
+
+def profiled(stage):
+    """ Decorator that records every call of the function as stage while profiling is on. """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            return PROFILER.call(stage, function, args, kwargs)
+        return wrapper
+    return decorate
+
+def call_for_file(worker, file_name):
+    """ Call worker(file_name) with its stages recorded under file_name. """
+    previous = PROFILER.file_name
+    PROFILER.file_name = file_name
+    try:
+        return worker(file_name)
+    finally:
+        PROFILER.file_name = previous
+
+def call_profiled(worker, file_name):
+    """ Run worker(file_name) in a worker process with profiling on. Returns (result, records). """
+    PROFILER.enable()
+    try:
+        result = call_for_file(worker, file_name)
+    finally:
+        records = PROFILER.disable()
+    return result, records
+
+def add_records(records):
+    """ Add the records sent back by a worker process. """
+    for record in records:
+        record["parent"] = False
+    PROFILER.records.extend(records)
+
+def summarize(records, total_seconds, slowest=5):
+    """ Returns the end-of-run summary: time share per stage and the slowest files. Worker processes run stages
+        side by side, so shares are of the summed stage time rather than of the wall time. Time spent waiting on
+        the workers overlaps their stages and is listed on its own, outside the shares. """
+    stages = {}
+    files = {}
+    wait_seconds = 0.0
+    for record in records:
+        if record["stage"] == WAIT_STAGE:
+            wait_seconds += record["wall_seconds"]
+            continue
+        stages[record["stage"]] = stages.get(record["stage"], 0.0) + record["wall_seconds"]
+        if record["file"] != BATCH_FILE:
+            files[record["file"]] = files.get(record["file"], 0.0) + record["wall_seconds"]
+
+    # Whatever no stage in this process accounts for: listing files, the manifest and so on
+    parent_seconds = sum(record["wall_seconds"] for record in records if record.get("parent", True))
+    stages["other"] = max(total_seconds - parent_seconds, 0.0)
+    stage_seconds = sum(stages.values())
+
+    lines = ["Profile: " + format(total_seconds, ".2f") + " s in total, " + format(stage_seconds, ".2f") + " s across stages"]
+    for stage, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+        share = 100.0 * seconds / stage_seconds if stage_seconds else 0.0
+        lines.append("  " + stage + ": " + format(seconds, ".3f") + " s (" + format(share, ".1f") + "%)")
+    if wait_seconds:
+        lines.append("Waiting on workers: " + format(wait_seconds, ".3f") + " s of wall time, overlapping the stages above")
+    if files:
+        lines.append("Slowest files:")
+        for file_name, seconds in sorted(files.items(), key=lambda item: -item[1])[:slowest]:
+            lines.append("  " + file_name + ": " + format(seconds, ".3f") + " s")
+    return "\n".join(lines)
+
+def write_trace(file_name, records, total_seconds):
+    """ Write the records as CSV when file_name ends in .csv, otherwise as JSON. """
+    with open(file_name, "w", newline="") as trace:
+        if file_name.lower().endswith(".csv"):
+            writer = csv.DictWriter(trace, fieldnames=TRACE_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump({"total_seconds": total_seconds, "records": records}, trace, indent=1)
+
+def finish_profile():
+    """ Write the trace and print the summary. Safe to call more than once. """
+    if not PROFILER.enabled:
+        return
+    total_seconds = time.perf_counter() - PROFILER.start
+    trace_file = PROFILER.trace_file
+    records = PROFILER.disable()
+    write_trace(trace_file, records, total_seconds)
+    print(summarize(records, total_seconds))
+    print("Profile trace written to " + trace_file)
+
+def add_profile_arguments(parser):
+    """ Add the --profile option shared by every script. """
+    parser.add_argument("--profile", metavar="TRACE",
+                        help="record the time, CPU time and memory of every stage of every file to TRACE (.json or .csv)")
+
+def profile_from_args(args):
+    """ Start profiling when --profile was given. The trace is written when the script exits. """
+    if args.profile:
+        PROFILER.enable(args.profile)
+        atexit.register(finish_profile)
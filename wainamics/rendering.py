@@ -0,0 +1,232 @@
+# Task: Render the run figures without pyplot's global figure list.
+#       Each script describes its layout once in a build function. The figure it returns is kept for the
+#       life of the process and generate_plot only swaps in each run's lines and text before saving, so
+#       axes, ticks and grids are not rebuilt per file and memory stays flat however many runs are drawn.
+#       matplotlib is only imported once the first figure is built, so runs that draw nothing never load it.
+#       RenderSettings picks the quality: quick low-dpi previews, or full resolution PNGs plus SVG/PDF exports
+#       for every run or only for the runs flagged for a closer look. With decimation on, long traces are cut
+#       down to the first, last, lowest and highest sample of every pixel column just before saving, which draws
+#       the same image from a few thousand vertices while the analysis keeps every sample.
+#       With --report every figure becomes a page of one PDF or HTML report instead (see wainamics/report.py).
+
+import fnmatch
+import os
+import numpy as np
+from wainamics.profiling import profiled
+from wainamics.report import Report, report_file
+
+TIME_TICKS = [0, 1200, 2400, 3600]
+
+# Dots per inch of full resolution and preview PNGs
+FULL_DPI = 300
+PREVIEW_DPI = 50
+
+# zlib level of PNG files, 0 (fastest, biggest) to 9 (slowest, smallest). 6 is what matplotlib uses by default.
+DEFAULT_PNG_COMPRESSION = 6
+
+# Lines are only decimated when they have more samples than this many per pixel column
+DECIMATE_RATIO = 4
+
+QUALITIES = ["full", "preview"]
+EXPORT_FORMATS = ["svg", "pdf"]
+
+# Legends get another column for every this many channels
+LEGEND_ROWS = 8
+
+# Matplotlib's default colours repeat after 10 lines, runs with more channels use this colour map
+MANY_CHANNEL_COLORS = "tab20"
+
+# One template per build function and channel count, per process. Worker processes build their own on first use.
+TEMPLATES = {}
+
+class FigureTemplate:
+    """ A figure drawn on the non-interactive Agg canvas. Build functions attach their lines and texts to it. """
+
+    def __init__(self, figsize):
+        Figure, FigureCanvasAgg = load_matplotlib()
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+
+    @profiled("savefig")
+    def save(self, file_name, dpi=FULL_DPI, png_compression=DEFAULT_PNG_COMPRESSION, decimate=False):
+        """ Save the figure with the data currently swapped in. The format follows the extension of file_name. """
+        full_data = decimate_lines(self.figure, dpi) if decimate else []
+        try:
+            if file_name.lower().endswith(".png"):
+                self.figure.savefig(file_name, dpi=dpi, pil_kwargs={"compress_level": png_compression})
+            else:
+                self.figure.savefig(file_name, dpi=dpi)
+        finally:
+            for line, x, y in full_data:
+                line.set_data(x, y)
+
+    def export(self, png_name, settings=None, run_name=None, table=None):
+        """ Save png_name at the quality of settings, plus its SVG/PDF exports when the run gets full resolution.
+            With a report the figure becomes its page instead, followed by table in HTML reports. """
+        if settings is None:
+            settings = RenderSettings()
+        if settings.report is not None:
+            settings.report.add_page(self.figure, png_name, table, settings.decimate)
+            return
+        if not settings.full_resolution(run_name or png_name):
+            self.save(png_name, PREVIEW_DPI, settings.png_compression, settings.decimate)
+            return
+        self.save(png_name, FULL_DPI, settings.png_compression, settings.decimate)
+        for extension in settings.exports:
+            self.save(os.path.splitext(png_name)[0] + "." + extension, FULL_DPI, decimate=settings.decimate)
+
+    def close(self):
+        """ Drop every artist so the figure can be freed right away. """
+        self.figure.clear()
+
+class RenderSettings:
+    """ How figures are saved. Runs matching one of the flagged file name patterns always get full resolution.
+        report is a Report every figure is added to instead of being saved on its own, or None. """
+
+    def __init__(self, quality="full", exports=(), flagged=(), png_compression=DEFAULT_PNG_COMPRESSION, decimate=False, report=None):
+        self.quality = quality
+        self.exports = list(exports)
+        self.flagged = list(flagged)
+        self.png_compression = png_compression
+        self.decimate = decimate
+        self.report = report
+
+    def is_flagged(self, run_name):
+        """ Returns whether run_name matches a flagged pattern, with or without its extension. """
+        names = [os.path.basename(run_name), os.path.splitext(os.path.basename(run_name))[0]]
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.flagged for name in names)
+
+    def full_resolution(self, run_name):
+        """ Returns whether run_name is saved at full resolution. """
+        return self.quality == "full" or self.is_flagged(run_name)
+
+    def parameters(self):
+        """ Returns the settings that change what is written, for the manifest. """
+        return {"quality": self.quality, "exports": self.exports, "flagged": self.flagged, "decimate": self.decimate}
+
+def read_flag_file(file_name):
+    """ Returns the run names or patterns listed one per line in file_name. """
+    with open(file_name) as flags:
+        return [line.strip() for line in flags if line.strip() and not line.startswith("#")]
+
+def add_render_arguments(parser):
+    """ Add the render quality options shared by the plotting scripts. """
+    group = parser.add_argument_group("render quality")
+    group.add_argument("--quality", choices=QUALITIES, default="full",
+                       help="full is " + str(FULL_DPI) + " dpi, preview is a quick " + str(PREVIEW_DPI) + " dpi PNG (default: full)")
+    group.add_argument("--export", dest="exports", action="append", choices=EXPORT_FORMATS, default=[],
+                       help="also save full resolution runs in this format, can be given more than once")
+    group.add_argument("--flag", dest="flagged", action="append", default=[], metavar="PATTERN",
+                       help="always save runs matching this file name pattern at full resolution, can be given more than once")
+    group.add_argument("--flag-file", help="file listing runs or patterns to save at full resolution, one per line")
+    group.add_argument("--decimate", action="store_true",
+                       help="draw long traces from the extremes of each pixel column only, the image looks the same but saves faster")
+    group.add_argument("--png-compression", type=int, choices=range(10), default=DEFAULT_PNG_COMPRESSION, metavar="0-9",
+                       help="PNG compression level, lower is faster (default: " + str(DEFAULT_PNG_COMPRESSION) + ")")
+    group.add_argument("--report", type=report_file, metavar="FILE",
+                       help="draw every run as a page of one .pdf or .html report instead of a PNG per run, always redoing every run")
+
+def render_settings_from_args(args):
+    """ Returns the RenderSettings asked for on the command line. """
+    flagged = list(args.flagged)
+    if args.flag_file:
+        flagged += read_flag_file(args.flag_file)
+    report = Report(args.report) if args.report else None
+    return RenderSettings(args.quality, args.exports, flagged, args.png_compression, args.decimate, report)
+
+def decimate_min_max(x, y, buckets):
+    """ Keep the first, lowest, highest and last sample of each of buckets equal runs of samples, in order.
+        x and y are (lines, samples) arrays and every line is decimated in the same vectorized pass. """
+    lines, samples = y.shape
+    size = -(-samples // buckets)
+    padded = np.concatenate([y, np.repeat(y[:, -1:], buckets * size - samples, axis=1)], axis=1).reshape(lines, buckets, size)
+
+    starts = np.arange(buckets) * size
+    lowest = starts + np.argmin(padded, axis=2)
+    highest = starts + np.argmax(padded, axis=2)
+    firsts = np.broadcast_to(starts, (lines, buckets))
+    lasts = np.broadcast_to(starts + size - 1, (lines, buckets))
+    index = np.sort(np.stack([firsts, lowest, highest, lasts], axis=2), axis=2).reshape(lines, -1)
+    index = np.minimum(index, samples - 1)
+    return np.take_along_axis(x, index, axis=1), np.take_along_axis(y, index, axis=1)
+
+def decimate_lines(figure, dpi):
+    """ Decimate every long line of figure to the pixel width of its axes at dpi.
+        Returns (line, x, y) with the full data of every line changed, so it can be put back. """
+    full_data = []
+    for ax in figure.axes:
+        buckets = int(np.ceil(ax.get_position().width * figure.get_figwidth() * dpi))
+        groups = {}
+        for line in ax.get_lines():
+            samples = len(line.get_xdata())
+            if samples > DECIMATE_RATIO * buckets:
+                groups.setdefault(samples, []).append(line)
+
+        # Lines with the same number of samples, normally every channel of a panel, are decimated together
+        for lines in groups.values():
+            x = np.array([np.asarray(line.get_xdata(), dtype=float) for line in lines])
+            y = np.array([np.asarray(line.get_ydata(), dtype=float) for line in lines])
+            x_decimated, y_decimated = decimate_min_max(x, y, buckets)
+            for i, line in enumerate(lines):
+                full_data.append((line, x[i], y[i]))
+                line.set_data(x_decimated[i], y_decimated[i])
+    return full_data
+
+def load_matplotlib():
+    """ Import matplotlib with the headless Agg backend, so no GUI toolkit is looked for. Returns (Figure, FigureCanvasAgg). """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    return Figure, FigureCanvasAgg
+
+def get_template(build, channels=3):
+    """ Returns the template build(channels) makes, building it the first time it is asked for. """
+    if (build, channels) not in TEMPLATES:
+        TEMPLATES[(build, channels)] = build(channels)
+    return TEMPLATES[(build, channels)]
+
+def release_templates():
+    """ Free every template built in this process. """
+    for template in TEMPLATES.values():
+        template.close()
+    TEMPLATES.clear()
+
+def time_axes(ax, title, ylabel):
+    """ Give ax the title, labels, time ticks and grid shared by every time series panel. """
+    ax.set_title(title)
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel(ylabel)
+    ax.set_xticks(TIME_TICKS)
+    ax.grid(True)
+    return ax
+
+def channel_labels(channels, suffix=""):
+    """ Returns the legend label of every channel. """
+    return ["Channel " + str(i + 1) + suffix for i in range(channels)]
+
+def add_legend(ax):
+    """ Draw the legend of ax, in more columns when it has many entries. """
+    ax.legend(ncol=1 + (len(ax.get_lines()) - 1) // LEGEND_ROWS)
+
+def add_lines(ax, labels):
+    """ Add one empty line per label to ax, plus the legend, and return the lines. """
+    if len(labels) > 10:
+        import matplotlib
+        colors = matplotlib.colormaps[MANY_CHANNEL_COLORS]
+        ax.set_prop_cycle(color=[colors(i % colors.N) for i in range(len(labels))])
+    lines = [ax.plot([], [], label=label)[0] for label in labels]
+    add_legend(ax)
+    return lines
+
+def set_lines(lines, x, ys, labels=None):
+    """ Swap the data of lines for x and ys and rescale their axes. Passing labels also rebuilds the legend. """
+    ax = lines[0].axes
+    for i, (line, y) in enumerate(zip(lines, ys)):
+        line.set_data(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        if labels is not None:
+            line.set_label(labels[i])
+    if labels is not None:
+        add_legend(ax)
+    ax.relim()
+    ax.autoscale_view()
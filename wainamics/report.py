@@ -0,0 +1,207 @@
+# Task: Gather the figures of a whole batch into one report, a multi-page PDF or a self-contained HTML page with an
+#       index, instead of a PNG beside every run. Workers spool each page to a local temporary folder, and the
+#       main process appends it to the report as soon as its run's result comes back in file order, then deletes
+#       it, so only the pages still in flight are ever held and the share sees one file written front to back.
+#       Pages stay vector, except that lines with more vertices than a rasterized image would take are drawn as
+#       an image inside the page, with the axes and text still vector. The Plot & Table Script's table is also
+#       written into the HTML report as a real table.
+
+import html
+import os
+import pickle
+import shutil
+import tempfile
+from urllib.parse import quote
+from wainamics.batch import iter_batch
+from wainamics.manifest import iter_incremental
+
+REPORT_FORMATS = [".pdf", ".html"]
+
+# Resolution of the parts of a page that are rasterized
+REPORT_DPI = 150
+
+# An axes whose lines have more vertices than this is rasterized, above it vectors outgrow the image
+RASTERIZE_VERTICES = 20000
+
+# Bytes copied at a time when the HTML body is appended to the report
+COPY_BYTES = 1 << 20
+
+def report_file(text):
+    """ argparse type for the report file, which must be a .pdf or .html file. """
+    if os.path.splitext(text)[1].lower() not in REPORT_FORMATS:
+        raise ValueError(text)
+    return text
+
+def page_key(png_name):
+    """ Returns the name of the page that stands in for png_name, its path so runs of different folders stay apart. """
+    return os.path.splitext(os.path.normpath(png_name))[0]
+
+def rasterize_dense_lines(figure):
+    """ Rasterize the lines of every axes with more than RASTERIZE_VERTICES vertices. Returns the lines changed. """
+    changed = []
+    for ax in figure.axes:
+        lines = ax.get_lines()
+        if sum(len(line.get_xdata()) for line in lines) > RASTERIZE_VERTICES:
+            for line in lines:
+                if not line.get_rasterized():
+                    line.set_rasterized(True)
+                    changed.append(line)
+    return changed
+
+class Report:
+    """ A report being written. Inside its with block, add_page can be called from any process with a copy of it,
+        and collect adds the spooled pages to the report in the order it is called. """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.html = file_name.lower().endswith(".html")
+        self.spool = None
+
+    def __getstate__(self):
+        # Workers only need to know where to spool, not the open report
+        return {"file_name": self.file_name, "html": self.html, "spool": self.spool}
+
+    def __enter__(self):
+        self.spool = tempfile.mkdtemp(prefix="wainamics-report-")
+        self.temp_name = self.file_name + ".tmp"
+        self.pages = []     # (page name, page number) in the order they were added
+        if self.html:
+            self.body = open(os.path.join(self.spool, "body.html"), "w", encoding="utf-8")
+        else:
+            from matplotlib.backends.backend_pdf import PdfPages
+            self.pdf = PdfPages(self.temp_name, metadata={"Title": os.path.basename(self.file_name)})
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.html:
+                self.body.close()
+                if exc_type is None:
+                    self.write_html()
+            else:
+                if exc_type is None:
+                    self.write_index_page()
+                self.pdf.close()
+            if exc_type is None:
+                os.replace(self.temp_name, self.file_name)
+        finally:
+            shutil.rmtree(self.spool, ignore_errors=True)
+            if os.path.exists(self.temp_name):
+                os.remove(self.temp_name)
+            self.spool = None
+
+    def spool_name(self, key, extension):
+        """ Returns where the page called key is spooled. """
+        return os.path.join(self.spool, quote(key, safe="") + extension)
+
+    def add_page(self, figure, png_name, table=None, decimate=False):
+        """ Spool figure as the page of png_name, with table below it in HTML reports. Runs in the worker processes. """
+        from wainamics.rendering import decimate_lines
+        key = page_key(png_name)
+        full_data = decimate_lines(figure, REPORT_DPI) if decimate else []
+        rasterized = rasterize_dense_lines(figure)
+        try:
+            if self.html:
+                figure.savefig(self.spool_name(key, ".svg.tmp"), format="svg", dpi=REPORT_DPI)
+                if table is not None:
+                    with open(self.spool_name(key, ".table.html"), "w", encoding="utf-8") as table_file:
+                        table_file.write(table.to_html(index=False, na_rep=""))
+                os.replace(self.spool_name(key, ".svg.tmp"), self.spool_name(key, ".svg"))
+            else:
+                with open(self.spool_name(key, ".pickle.tmp"), "wb") as page_file:
+                    pickle.dump(figure, page_file)
+                os.replace(self.spool_name(key, ".pickle.tmp"), self.spool_name(key, ".pickle"))
+        finally:
+            for line in rasterized:
+                line.set_rasterized(False)
+            for line, x, y in full_data:
+                line.set_data(x, y)
+
+    def collect(self, png_names):
+        """ Add the spooled pages of png_names to the report and delete them. Pages of failed runs are skipped. """
+        for key in [page_key(png_name) for png_name in png_names]:
+            if self.html:
+                self.append_html_page(key)
+            else:
+                self.append_pdf_page(key)
+
+    def append_pdf_page(self, key):
+        """ Draw the spooled figure of key onto the next PDF page. """
+        spooled = self.spool_name(key, ".pickle")
+        if not os.path.isfile(spooled):
+            return
+        with open(spooled, "rb") as page_file:
+            figure = pickle.load(page_file)
+        os.remove(spooled)
+        self.pdf.savefig(figure, dpi=REPORT_DPI)
+        self.pages.append((key, self.pdf.get_pagecount()))
+
+    def append_html_page(self, key):
+        """ Append the spooled SVG of key, and its table, to the HTML body. """
+        spooled = self.spool_name(key, ".svg")
+        if not os.path.isfile(spooled):
+            return
+        number = len(self.pages) + 1
+        with open(spooled, encoding="utf-8") as page_file:
+            svg = page_file.read()
+        os.remove(spooled)
+        self.body.write('<section id="page-' + str(number) + '">\n<h2>' + html.escape(key) + '</h2>\n')
+        self.body.write(svg[svg.index("<svg"):])
+        table_name = self.spool_name(key, ".table.html")
+        if os.path.isfile(table_name):
+            with open(table_name, encoding="utf-8") as table_file:
+                self.body.write(table_file.read())
+            os.remove(table_name)
+        self.body.write('<p><a href="#index">Back to the index</a></p>\n</section>\n')
+        self.pages.append((key, number))
+
+    def write_index_page(self):
+        """ End the PDF with a page listing every run and its page number. """
+        from wainamics.rendering import load_matplotlib
+        Figure, _ = load_matplotlib()
+        lines_per_page = 60
+        for start in range(0, len(self.pages), lines_per_page):
+            figure = Figure(figsize=(8.5, 11))
+            entries = self.pages[start:start + lines_per_page]
+            figure.text(0.1, 0.95, "Index", fontsize=14)
+            for i, (key, number) in enumerate(entries):
+                figure.text(0.1, 0.92 - i * 0.0145, key, fontsize=8)
+                figure.text(0.85, 0.92 - i * 0.0145, str(number), fontsize=8, ha="right")
+            self.pdf.savefig(figure)
+
+    def write_html(self):
+        """ Write the report: the index of every page followed by the body, copied a block at a time. """
+        with open(self.temp_name, "w", encoding="utf-8") as report:
+            title = html.escape(os.path.basename(self.file_name))
+            report.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>' + title + '</title>\n'
+                         '<style>body { font-family: sans-serif; } svg { max-width: 100%; height: auto; } '
+                         'table { border-collapse: collapse; } td, th { border: 1px solid #999; padding: 2px 6px; } '
+                         'section { page-break-before: always; }</style>\n</head>\n<body>\n')
+            report.write('<h1 id="index">' + title + '</h1>\n<ol>\n')
+            for key, number in self.pages:
+                report.write('<li><a href="#page-' + str(number) + '">' + html.escape(key) + '</a></li>\n')
+            report.write('</ol>\n')
+            with open(os.path.join(self.spool, "body.html"), encoding="utf-8") as body:
+                shutil.copyfileobj(body, report, COPY_BYTES)
+            report.write('</body>\n</html>\n')
+
+    def pages_of(self, results, file_names, outputs):
+        """ Pass results through, adding the pages of each run as soon as its result arrives. The report is
+            finished once every result has been taken. """
+        with self:
+            for file_name, result in zip(file_names, results):
+                self.collect(outputs(file_name))
+                yield result
+
+def iter_reported(render, worker, file_names, workers, manifest=None, outputs=None):
+    """ Same as iter_incremental, unless render has a report: then every run is processed in file name order and
+        its pages go into the report as it finishes. The report is written once the results have all been taken. """
+    if render is None or render.report is None:
+        return iter_incremental(worker, file_names, workers, manifest, outputs)
+    file_names = sorted(file_names)
+    return render.report.pages_of(iter_batch(worker, file_names, workers), file_names, outputs), True
+
+def run_reported(render, worker, file_names, workers, manifest=None, outputs=None):
+    """ Same as iter_reported, but waits for every file and returns the results as a list. """
+    results, changed = iter_reported(render, worker, file_names, workers, manifest, outputs)
+    return list(results), changed
@@ -0,0 +1,180 @@
+# Task: Find the runs a script works on. Without --input the scripts read the current folder as they always have.
+#       With --input they walk one or more archive folders and their dated subfolders with os.scandir, whose
+#       entries already know whether they are files or folders, so nothing is stat'ed while walking and lock
+#       files (~$) are dropped by name. --pattern keeps the runs whose path below its root matches a glob.
+#       --shard i/N keeps a fixed share of the runs, picked from a hash of that path, so N machines can split
+#       a backfill without talking to each other and without agreeing on the order the folders list in.
+#       Each shard writes its own summary table and manifest, and
+#           python -m wainamics.scan merge "Table Output.xlsx" "Table Output (shard 1 of 4).xlsx" ...
+#       joins the tables afterwards. --scan-manifest writes the runs a scan found, with their size and time.
+
+import argparse
+import csv
+import fnmatch
+import os
+import zlib
+from datetime import datetime
+from wainamics.loader import is_run_file
+
+SCAN_MANIFEST_COLUMNS = ["Path", "Size", "Modified"]
+
+# Folders that are never walked into: hidden ones, such as caches, and run stores
+SKIPPED_FOLDERS = [".*", "*.store"]
+
+def parse_shard(text):
+    """ argparse type for --shard: "i/N" is the i-th of N shards, counted from 1. """
+    index, count = (int(part) for part in text.split("/"))
+    if not 1 <= index <= count:
+        raise ValueError(text)
+    return index, count
+
+def shard_of(relative_path, count):
+    """ Returns which of count shards the run at relative_path belongs to, counted from 1. The hash only
+        depends on the path below the root, so every machine puts a run in the same shard. """
+    return zlib.crc32(relative_path.replace(os.sep, "/").encode("utf-8")) % count + 1
+
+def in_shard(relative_path, shard):
+    """ Returns True when the run at relative_path belongs to shard, an (index, count) pair, or shard is None. """
+    return shard is None or shard_of(relative_path, shard[1]) == shard[0]
+
+def select_shard(file_names, shard):
+    """ Returns the file names of shard, for runs that are already listed, such as the runs of a store. """
+    return [file_name for file_name in file_names if in_shard(file_name, shard)]
+
+def shard_file_name(file_name, shard):
+    """ Returns the name a shard writes file_name under, so shards sharing a folder do not overwrite each other. """
+    if shard is None:
+        return file_name
+    base, extension = os.path.splitext(file_name)
+    return base + " (shard " + str(shard[0]) + " of " + str(shard[1]) + ")" + extension
+
+def is_skipped(name, skip):
+    """ Returns True when name is one of the outputs in skip, or a shard's copy of one. """
+    return any(name == output or fnmatch.fnmatch(name, shard_file_name(output, ("*", "*"))) for output in skip)
+
+def matches(relative_path, patterns):
+    """ Returns True when no patterns are given, or one matches relative_path or its file name. """
+    relative_path = relative_path.replace(os.sep, "/")
+    name = relative_path.rsplit("/", 1)[-1]
+    return not patterns or any(fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def walk(root, recursive=True):
+    """ Yield (path below root, DirEntry) of every file under root, taking what scandir already knows about each entry. """
+    folders = [""]
+    while folders:
+        folder = folders.pop()
+        with os.scandir(os.path.join(root, folder) if folder else root) as scan:
+            for entry in scan:
+                relative_path = folder + "/" + entry.name if folder else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive and not any(fnmatch.fnmatch(entry.name, pattern) for pattern in SKIPPED_FOLDERS):
+                        folders.append(relative_path)
+                elif entry.is_file():
+                    yield relative_path, entry
+
+def iter_scan(roots=None, patterns=(), shard=None, skip=()):
+    """ Yield (path, DirEntry) of every run under roots, which may also be single files, in the order the folders
+        list. Without roots only the current folder is read, without its subfolders. Outputs named in skip are left out. """
+    if not roots:
+        roots, recursive = [os.curdir], False
+    else:
+        recursive = True
+    for root in roots:
+        if os.path.isfile(root):
+            found = [(os.path.basename(root), None)]
+            root = os.path.dirname(root) or os.curdir
+        else:
+            found = walk(root, recursive)
+        for relative_path, entry in found:
+            name = relative_path.rsplit("/", 1)[-1]
+            if "~$" in name or is_skipped(name, skip) or not matches(relative_path, patterns) or not in_shard(relative_path, shard):
+                continue
+            path = os.path.normpath(os.path.join(root, relative_path))
+            # Only now is a text export opened to check its header
+            if is_run_file(path):
+                yield path, entry
+
+def scan_runs(roots=None, patterns=(), shard=None, skip=()):
+    """ Returns the paths of every run under roots, see iter_scan. """
+    return [path for path, _ in iter_scan(roots, patterns, shard, skip)]
+
+def write_scan_manifest(file_name, runs):
+    """ Write the (path, DirEntry) pairs of runs to a CSV file with each run's size and modification time. """
+    with open(file_name, "w", newline="") as manifest_file:
+        writer = csv.writer(manifest_file)
+        writer.writerow(SCAN_MANIFEST_COLUMNS)
+        for path, entry in runs:
+            stat = os.stat(path) if entry is None else entry.stat()
+            writer.writerow([path, stat.st_size, datetime.fromtimestamp(stat.st_mtime).isoformat(timespec="seconds")])
+
+def add_scan_arguments(parser):
+    """ Add the options that choose which runs a script reads. """
+    group = parser.add_argument_group("input")
+    group.add_argument("--input", nargs="+", metavar="PATH",
+                       help="folders to read the runs from, subfolders included, or single runs (default: the current folder only)")
+    group.add_argument("--pattern", nargs="+", default=[], metavar="GLOB",
+                       help='only read runs whose path below its --input folder or file name matches, e.g. "2022-03-*/*.xlsx"')
+    group.add_argument("--shard", type=parse_shard, metavar="I/N",
+                       help="only read the I-th of N fixed shares of the runs, and write the summary table and manifest under the shard's own name")
+    group.add_argument("--scan-manifest", metavar="CSV",
+                       help="write the path, size and modification time of every run read to CSV")
+
+def runs_from_args(args, skip=()):
+    """ Returns the runs asked for on the command line, writing the scan manifest when one is asked for. """
+    if not args.scan_manifest:
+        return scan_runs(args.input, args.pattern, args.shard, skip)
+    runs = list(iter_scan(args.input, args.pattern, args.shard, skip))
+    write_scan_manifest(args.scan_manifest, runs)
+    return [path for path, _ in runs]
+
+def read_tables(file_name):
+    """ Returns every run table of a summary workbook written by TableWriter, on one sheet or one per sheet. """
+    import pandas as pd
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_name, read_only=True)
+    tables = []
+    for sheet in workbook.worksheets:
+        columns, rows = None, []
+        for row in sheet.iter_rows(values_only=True):
+            if len(row) > 1 and row[1] == "Date Created":
+                if columns is not None:
+                    tables.append(pd.DataFrame(rows, columns=columns))
+                columns = [name for name in row[1:] if name is not None]
+                rows = []
+            elif columns is not None and any(value is not None for value in row):
+                rows.append(list(row[1:1 + len(columns)]) + [None] * (len(columns) + 1 - len(row)))
+        if columns is not None:
+            tables.append(pd.DataFrame(rows, columns=columns))
+    workbook.close()
+    return tables
+
+def merge_tables(output, file_names):
+    """ Write the run tables of every summary workbook in file_names to output, on one sheet ordered by file name. """
+    from wainamics.table_writer import TableWriter
+    tables = [table for file_name in file_names for table in read_tables(file_name)]
+    tables.sort(key=lambda table: str(table["File Name"].iloc[0]))
+    new_row = max((len(table) + 2 for table in tables), default=6)
+    with TableWriter(output, same_sheet=True, new_row=new_row) as writer:
+        for table in tables:
+            writer.write(table)
+    return len(tables)
+
+def main():
+    """ List the runs a scan finds, or merge the summary tables of several shards. """
+    parser = argparse.ArgumentParser(description="List the runs a scan finds, or merge the summary tables that shards wrote")
+    parser.add_argument("command", choices=["list", "merge"])
+    parser.add_argument("files", nargs="*", metavar="FILE", help="for merge: the workbook to write, then the shards' workbooks")
+    add_scan_arguments(parser)
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        if len(args.files) < 2:
+            parser.error("merge needs the workbook to write and at least one workbook to merge")
+        count = merge_tables(args.files[0], args.files[1:])
+        print("Merged " + str(count) + " run tables into " + args.files[0])
+    else:
+        for path in runs_from_args(args):
+            print(path)
+
+if __name__ == '__main__':
+    main()
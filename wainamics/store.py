@@ -0,0 +1,218 @@
+# Task: Pack the channel data of a whole archive of runs into one memory-mapped array store.
+#       A store is a folder holding traces.npy, a (runs, samples, channels) block padded with NaN past each
+#       run's length, lengths.npy, and index.json with the file name, creation date, notes and channels of
+#       every run. The block is opened with mmap_mode, so slicing it is zero-copy and a query over thousands
+#       of runs only reads the pages it touches instead of opening any workbook.
+#
+#       python -m wainamics.store ingest [DIRECTORY] --store runs.store
+#       python -m wainamics.store list --store runs.store
+#       python -m wainamics.store table --store runs.store [--minutes 0 20 40 60] [--features]
+
+import argparse
+import json
+import os
+from datetime import datetime
+from functools import partial
+import numpy as np
+from wainamics.loader import Run, additional_notes, file_date, is_run_file
+from wainamics.cache import add_cache_arguments, cache_from_args, load_cached_run
+from wainamics.batch import add_batch_arguments, iter_batch
+from wainamics.manifest import input_fingerprint
+from wainamics.timepoints import add_timepoint_arguments, timepoints_from_args
+from wainamics.features import DerivativeFeatures, add_feature_arguments, features_from_args
+from wainamics.filters import add_filter_arguments, filters_from_args
+from wainamics.baseline import add_baseline_arguments, baseline_from_args
+from wainamics.table_writer import TableWriter
+
+DEFAULT_STORE = "runs.store"
+TABLE_FILENAME = "Table Output.xlsx"
+TRACES_FILENAME = "traces.npy"
+LENGTHS_FILENAME = "lengths.npy"
+INDEX_FILENAME = "index.json"
+STORE_VERSION = 1
+
+# Runs copied from the old block per step when the store is rewritten, to bound memory
+COPY_RUNS = 256
+
+# Stores opened in this process, by path. Worker processes open their own on first use.
+STORES = {}
+
+class RunStore:
+    """ Read-only view of a store. Every array handed out is a slice of the memory map. """
+
+    def __init__(self, path=DEFAULT_STORE):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILENAME)) as index:
+            data = json.load(index)
+        self.entries = data["runs"]
+        self.block = np.load(os.path.join(path, TRACES_FILENAME), mmap_mode="r")
+        self.lengths = np.load(os.path.join(path, LENGTHS_FILENAME), mmap_mode="r")
+        if len(self.block) != len(self.entries) or len(self.lengths) != len(self.entries):
+            raise ValueError(path + " is incomplete, ingest it again")
+        self.positions = {entry["file_name"]: i for i, entry in enumerate(self.entries)}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, file_name):
+        """ Returns the position of file_name in the store, or None. """
+        return self.positions.get(os.path.basename(file_name))
+
+    def traces(self, i):
+        """ Returns the (samples, channels) readings of run i without the padding. """
+        return self.block[i, :self.lengths[i]]
+
+    def tables(self, timepoints):
+        """ Returns the table of every run, read from the block in one pass. """
+        dates = [datetime.fromisoformat(entry["date"]) for entry in self.entries]
+        file_names = [entry["file_name"] for entry in self.entries]
+        channels = [len(entry["channels"]) for entry in self.entries]
+        features = timepoints.trace_features([self.traces(i)[:, :count] for i, count in enumerate(channels)])
+        return timepoints.block_tables(self.block, self.lengths, dates, file_names, channels, features)
+
+    def run(self, i, seconds_per_sample=10):
+        """ Returns run i as a Run the scripts can use in place of a parsed workbook. """
+        import pandas as pd
+        entry = self.entries[i]
+        traces = self.traces(i)
+        optics = pd.DataFrame(traces, columns=entry["channels"])
+        optics.insert(0, "Time", np.arange(len(traces)) * seconds_per_sample)
+        date = datetime.fromisoformat(entry["date"])
+        return Run(entry["file_name"], date, optics, entry["others"])
+
+def open_store(path):
+    """ Returns the RunStore at path, opening it the first time it is asked for in this process. """
+    if path not in STORES:
+        STORES[path] = RunStore(path)
+    return STORES[path]
+
+def load_stored_run(path, file_name, seconds_per_sample=10):
+    """ Returns file_name from the store at path as a Run. """
+    store = open_store(path)
+    i = store.find(file_name)
+    if i is None:
+        raise KeyError(file_name + " is not in " + path)
+    return store.run(i, seconds_per_sample)
+
+def add_store_arguments(parser):
+    """ Add the option that reads runs from a store instead of the workbooks. """
+    parser.add_argument("--store", help="read every run from this store (see wainamics/store.py) instead of the workbooks")
+
+def read_traces(file_name, cache=None):
+    """ Parse file_name and return what the store keeps of it. Runs inside a worker process when --workers is used. """
+    run = load_cached_run(file_name, file_date(file_name), cache)
+    return {"file_name": os.path.basename(file_name),
+            "date": run.date.isoformat(),
+            "notes": additional_notes(run.others),
+            "others": run.others,
+            "channels": [str(name) for name in run.optics.columns[1:]],
+            "fingerprint": input_fingerprint(file_name),
+            "traces": run.optics.iloc[:, 1:].to_numpy(dtype=float)}
+
+def read_index(path):
+    """ Returns the index entries of the store at path, or no entries when there is no store yet. """
+    if not os.path.isfile(os.path.join(path, INDEX_FILENAME)):
+        return []
+    with open(os.path.join(path, INDEX_FILENAME)) as index:
+        data = json.load(index)
+    if data.get("version") != STORE_VERSION:
+        return []
+    return data["runs"]
+
+def write_store(path, old_entries, new_runs):
+    """ Write a new block with the runs of old_entries that are kept followed by new_runs, then swap it in. """
+    old_store = RunStore(path) if old_entries else None
+    kept = [old_store.positions[entry["file_name"]] for entry in old_entries] if old_store else []
+
+    runs = len(kept) + len(new_runs)
+    old_shape = old_store.block.shape if kept else (0, 0, 0)
+    samples = max([old_shape[1]] + [len(run["traces"]) for run in new_runs])
+    channels = max([old_shape[2]] + [run["traces"].shape[1] for run in new_runs])
+
+    temp_traces = os.path.join(path, TRACES_FILENAME + ".tmp")
+    block = np.lib.format.open_memmap(temp_traces, mode="w+", dtype=float, shape=(runs, samples, channels))
+    lengths = np.zeros(runs, dtype=np.int64)
+
+    # Copy the kept runs a few at a time so the old block is never read into memory whole
+    for start in range(0, len(kept), COPY_RUNS):
+        rows = kept[start:start + COPY_RUNS]
+        old = old_store.block[rows]
+        block[start:start + len(rows)] = np.nan
+        block[start:start + len(rows), :old.shape[1], :old.shape[2]] = old
+        lengths[start:start + len(rows)] = old_store.lengths[rows]
+    for i, run in enumerate(new_runs, len(kept)):
+        traces = run["traces"]
+        block[i] = np.nan
+        block[i, :len(traces), :traces.shape[1]] = traces
+        lengths[i] = len(traces)
+    block.flush()
+    del block
+    del old_store     # Close the old memory map before replacing its file
+
+    entries = old_entries + [{key: value for key, value in run.items() if key != "traces"} for run in new_runs]
+    np.save(os.path.join(path, LENGTHS_FILENAME + ".tmp.npy"), lengths)
+    os.replace(temp_traces, os.path.join(path, TRACES_FILENAME))
+    os.replace(os.path.join(path, LENGTHS_FILENAME + ".tmp.npy"), os.path.join(path, LENGTHS_FILENAME))
+    with open(os.path.join(path, INDEX_FILENAME + ".tmp"), "w") as index:
+        json.dump({"version": STORE_VERSION, "runs": entries}, index)
+    os.replace(os.path.join(path, INDEX_FILENAME + ".tmp"), os.path.join(path, INDEX_FILENAME))
+    return entries
+
+def ingest(directory, path=DEFAULT_STORE, workers=1, cache=None):
+    """ Add every new or changed run workbook in directory to the store at path. Returns (added, total). """
+    os.makedirs(path, exist_ok=True)
+    file_names = sorted(file_name for file_name in os.listdir(directory) if is_run_file(os.path.join(directory, file_name)) and file_name != TABLE_FILENAME)
+    old_entries = read_index(path)
+    fingerprints = {os.path.join(directory, file_name): input_fingerprint(os.path.join(directory, file_name)) for file_name in file_names}
+
+    current = {entry["file_name"] for entry in old_entries
+               if fingerprints.get(os.path.join(directory, entry["file_name"])) == entry["fingerprint"]}
+    pending = [os.path.join(directory, file_name) for file_name in file_names if file_name not in current]
+    if not pending:
+        return 0, len(old_entries)
+
+    # Runs that changed are dropped and added again at the end; runs no longer in directory are kept
+    kept = [entry for entry in old_entries if entry["file_name"] in current or os.path.join(directory, entry["file_name"]) not in fingerprints]
+    new_runs = [run for run in iter_batch(partial(read_traces, cache=cache), pending, workers) if run is not None]
+    entries = write_store(path, kept, new_runs)
+    return len(new_runs), len(entries)
+
+def write_tables(store, timepoints, file_name=TABLE_FILENAME):
+    """ Write the table of every run in store to file_name, laid out like the Table Script's. """
+    with TableWriter(file_name, same_sheet=True, new_row=timepoints.new_row()) as writer:
+        for table in store.tables(timepoints):
+            writer.write(table)
+
+def main():
+    """ Ingest a directory of runs into a store, list what a store holds, or tabulate it. """
+    parser = argparse.ArgumentParser(description="Pack run workbooks into a memory-mapped store")
+    parser.add_argument("command", choices=["ingest", "list", "table"])
+    parser.add_argument("directory", nargs="?", default=".", help="folder of run workbooks to ingest (default: current directory)")
+    parser.add_argument("--store", default=DEFAULT_STORE, help="store folder (default: " + DEFAULT_STORE + ")")
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_timepoint_arguments(parser)
+    add_feature_arguments(parser)
+    add_filter_arguments(parser)
+    add_baseline_arguments(parser)
+    parser.add_argument("--seconds-per-sample", type=float, default=10, help="sampling interval of the runs (default: 10)")
+    parser.add_argument("--output", default=TABLE_FILENAME, help="workbook the table command writes (default: " + TABLE_FILENAME + ")")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        added, total = ingest(args.directory, args.store, args.workers, cache_from_args(args))
+        print("Added " + str(added) + " runs, " + str(total) + " runs in " + args.store)
+    elif args.command == "table":
+        # The derivative is taken with the Derivative Baseline Subtraction Script's settings
+        defaults = DerivativeFeatures()
+        features = features_from_args(args, defaults.starting_row, args.seconds_per_sample, defaults.t_0, defaults.t_f,
+                                      defaults.window_size, filters_from_args(args), baseline_from_args(args))
+        write_tables(RunStore(args.store), timepoints_from_args(args, args.seconds_per_sample, features), args.output)
+        print("Wrote the table of every run in " + args.store + " to " + args.output)
+    else:
+        store = RunStore(args.store)
+        for i, entry in enumerate(store.entries):
+            print(entry["file_name"] + "\t" + entry["date"] + "\t" + str(store.lengths[i]) + " samples\t" + entry["notes"].replace("\n", " | "))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,375 @@
+# Task: Try every combination of STARTING_ROW, T_0, T_F and WINDOW_SIZE over a folder or store of runs in one pass,
+#       instead of editing the constants and running a script again for each. Runs are parsed once and stacked
+#       into (runs, samples, channels) blocks of equal shape. Prefix sums of y, k * y and y * y along the samples
+#       give the least squares baseline and its residual for any window in O(1), and one prefix sum of the
+#       derivative gives the moving average of any width in O(n), so adding grid values costs arithmetic rather
+#       than another read, fit or smoothing pass. The features are read off the smoothed derivative less each
+#       window's baseline slope. That only shifts the running maximum of the smoothed derivative, so the peak and
+#       the threshold crossing of every baseline window are binary searches on it rather than a pass over the samples.
+#       Every combination reproduces what the scripts compute with those constants: the baseline fit, the
+#       derivative smoothed with the moving average and its features.
+#
+#       python -m wainamics.sweep [DIRECTORY] --t0 120:600:60 --tf 600:1200:60 --window-size 10:100:10
+#       python -m wainamics.sweep --store runs.store --starting-row 0 5 10 --per-run --output sweep.csv
+
+import argparse
+import os
+import time as clock
+import warnings
+from functools import partial
+import numpy as np
+from wainamics.loader import is_run_file
+from wainamics.cache import add_cache_arguments, cache_from_args
+from wainamics.batch import add_batch_arguments, iter_batch
+from wainamics.features import DerivativeFeatures, MINUTE_DECIMALS, PEAK_DECIMALS, SECONDS_PER_MINUTE, THRESHOLD_FRACTION
+from wainamics.filters import padded_samples
+from wainamics.store import TABLE_FILENAME, RunStore, read_traces
+
+OUTPUT_FILENAME = "Sweep Output.csv"
+
+# Decimal places of the baseline fits in the result table, as in the legend equations
+FIT_DECIMALS = 4
+
+# Enough digits for any rounded metric or median, without the binary tail of values like 2.0949999999999998
+CSV_FLOAT_FORMAT = "%.12g"
+
+PARAMETERS = ["STARTING_ROW", "T_0", "T_F", "WINDOW_SIZE"]
+BASELINE_METRICS = ["Slope", "Intercept", "Baseline RMS"]
+DERIVATIVE_METRICS = ["Peak dRFU/dt", "Peak Minute", "Threshold Minute", "Onset Minute"]
+
+def parse_grid(text):
+    """ argparse type for one grid value or an inclusive START:STOP:STEP range. Returns a list of values. """
+    parts = [float(part) for part in text.split(":")]
+    if len(parts) == 1:
+        values = parts
+    elif len(parts) == 3 and parts[2] > 0:
+        values = np.arange(parts[0], parts[1] + parts[2] / 2, parts[2]).tolist()
+    else:
+        raise ValueError(text)
+    return [int(value) if value == int(value) else value for value in values]
+
+def grid_values(groups):
+    """ Returns the sorted, distinct values of the lists parse_grid returned. """
+    return sorted({value for group in groups for value in group})
+
+def first_reaching(running_max, offsets, levels):
+    """ Returns the first sample at which running_max - offsets reaches levels, or the sample count where it never
+        does. running_max is (runs, samples, channels) and never decreases along the samples, offsets and levels
+        are (runs, channels, windows), so every window is a binary search of log2(samples) steps. """
+    samples = running_max.shape[1]
+    # Each channel's samples in one contiguous row, so every step gathers from a flat array
+    rows = np.ascontiguousarray(running_max.transpose(0, 2, 1)).ravel()
+    starts = (np.arange(running_max.shape[0] * running_max.shape[2]) * samples).reshape(levels.shape[:2] + (1,))
+    low = np.zeros(levels.shape, dtype=np.int64)
+    high = np.full(levels.shape, samples, dtype=np.int64)
+    for _ in range(samples.bit_length()):
+        middle = (low + high) // 2
+        reached = rows[starts + np.minimum(middle, samples - 1)] - offsets >= levels
+        # Once low meets high, middle is low and neither end moves
+        low = np.where(reached, low, np.minimum(middle + 1, high))
+        high = np.where(reached, middle, high)
+    return low
+
+def prefix_sums(block):
+    """ Returns the cumulative sums of a (runs, samples, channels) block along the samples, with a leading zero. """
+    sums = np.zeros((block.shape[0], block.shape[1] + 1, block.shape[2]))
+    np.cumsum(block, axis=1, out=sums[:, 1:])
+    return sums
+
+class Grid:
+    """ The values swept for each parameter, the sampling rate and the derivative threshold (see wainamics/features.py). """
+
+    def __init__(self, starting_rows, t_0s, t_fs, window_sizes, seconds_per_sample=10, threshold=None):
+        self.starting_rows = list(starting_rows)
+        self.t_0s = list(t_0s)
+        self.t_fs = list(t_fs)
+        self.window_sizes = list(window_sizes)
+        self.seconds_per_sample = seconds_per_sample
+        self.threshold = threshold
+
+    def __len__(self):
+        return len(self.starting_rows) * len(self.t_0s) * len(self.t_fs) * len(self.window_sizes)
+
+    def baseline_windows(self, samples):
+        """ Returns the first and last row of every (starting row, t_0, t_f) window in the untrimmed runs, and which
+            windows fit_baselines would accept. Each array is shaped (starting rows, t_0s, t_fs). """
+        starting_rows, t_0s, t_fs = np.meshgrid(self.starting_rows, self.t_0s, self.t_fs, indexing="ij")
+        first = starting_rows + (t_0s / self.seconds_per_sample).astype(np.int64)
+        last = starting_rows + (t_fs / self.seconds_per_sample).astype(np.int64)
+        counts = np.vectorize(lambda t_0, t_f: len(np.arange(t_0, t_f, self.seconds_per_sample)))(t_0s, t_fs)
+        valid = (counts == last - first) & (counts >= 2) & (last <= samples)
+        return np.where(valid, first, 0), np.where(valid, last, 2), valid
+
+    def fit_block(self, block):
+        """ Returns (slopes, intercepts, rms) of every baseline window, each shaped (runs, channels, starting rows, t_0s, t_fs).
+            The lines are in the seconds of fit_baselines, x = t_0 at the window's first row. """
+        # Readings relative to each run's first sample keep the sums of squares small
+        offset = block[:, :1]
+        y = block - offset
+        rows = np.arange(block.shape[1], dtype=float)[None, :, None]
+        sum_y, sum_ky, sum_yy = prefix_sums(y), prefix_sums(y * rows), prefix_sums(y * y)
+
+        first, last, valid = self.baseline_windows(block.shape[1])
+        first, last = first.ravel(), last.ravel()
+        count = (last - first).astype(float)[None, :, None]
+        window_y = sum_y[:, last] - sum_y[:, first]
+        window_ky = sum_ky[:, last] - sum_ky[:, first]
+        window_yy = sum_yy[:, last] - sum_yy[:, first]
+
+        # Consecutive rows k have mean (first + last - 1) / 2 and centered sum of squares count * (count^2 - 1) / 12
+        mean_k = ((first + last - 1) / 2.0)[None, :, None]
+        centered_ky = window_ky - mean_k * window_y
+        slope_k = centered_ky / (count * (count * count - 1) / 12.0)
+        residual = np.maximum(window_yy - window_y * window_y / count - slope_k * centered_ky, 0)
+
+        t_0s = np.broadcast_to(np.asarray(self.t_0s, dtype=float)[None, :, None], valid.shape).ravel()[None, :, None]
+        slopes = slope_k / self.seconds_per_sample
+        mean_x = t_0s + (count - 1) / 2.0 * self.seconds_per_sample
+        intercepts = window_y / count + offset - slopes * mean_x
+        rms = np.sqrt(residual / count)
+
+        shape = (block.shape[0],) + valid.shape + (block.shape[2],)
+        mask = valid[None, ..., None]
+        return [np.moveaxis(np.where(mask, array.reshape(shape), np.nan), -1, 1) for array in (slopes, intercepts, rms)]
+
+    def smooth_block(self, derivative_sums, window_size):
+        """ Returns the derivative smoothed by a moving average of window_size, as (runs, samples, channels), from the
+            (samples + 1, runs, channels) prefix sums of the trimmed derivative. The sums and the window arithmetic are
+            those of moving_average, so equal peaks stay equal and the peak is the sample the feature tables pick.
+            Samples come first so every window sum gathers whole contiguous rows. """
+        length = len(derivative_sums) - 1
+        index = np.arange(length)
+        low = np.clip(index - window_size // 2, 0, length)
+        high = np.clip(index + (window_size - 1) // 2 + 1, 0, length)
+        return ((derivative_sums[high] - derivative_sums[low]) / window_size).transpose(1, 0, 2)
+
+    def window_features(self, time, block, smooth, slopes, intercepts):
+        """ Returns (peak value, peak time, threshold time, onset) of every baseline window, each shaped like slopes,
+            (runs, channels, windows), as extract_features reads them off smooth less each window's slope.
+            time, block and smooth are the samples the moving average does not pad. """
+        runs = np.arange(block.shape[0])[:, None, None]
+        channels = np.arange(block.shape[2])[None, :, None]
+        running_max = np.maximum.accumulate(smooth, axis=1)
+
+        # The first sample of the largest smooth - m is where the running maximum less m first reaches it. That is the
+        # peak of smooth itself unless rounding makes an earlier, slightly lower sample equal once m is taken off.
+        peak_value = running_max[:, -1, :, None] - slopes
+        peak = np.broadcast_to(np.argmax(smooth, axis=1)[..., None], slopes.shape)
+        earlier = (peak > 0) & (running_max[runs, np.maximum(peak - 1, 0), channels] - slopes >= peak_value)
+        if earlier.any():
+            peak = np.where(earlier, first_reaching(running_max, slopes, peak_value), peak)
+        peak_time = time[peak]
+
+        level = peak_value * THRESHOLD_FRACTION if self.threshold is None else np.full_like(peak_value, self.threshold)
+        first = first_reaching(running_max, slopes, level)
+        reached = first < len(time)
+        first = np.where(reached, first, 0)
+        before = np.maximum(first - 1, 0)
+        low = smooth[runs, before, channels] - slopes
+        high = smooth[runs, first, channels] - slopes
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(first > 0, (level - low) / (high - low), 0.0)
+            crossing = np.where(reached, time[before] + fraction * (time[first] - time[before]), np.nan)
+            baseline_sub = block[runs, peak, channels] - (slopes * peak_time + intercepts)
+            onset = np.where(peak_value > 0, peak_time - baseline_sub / peak_value, np.nan)
+        return [np.where(np.isnan(slopes), np.nan, array) for array in (peak_value, peak_time, crossing, onset)]
+
+    def derivative_block(self, block, slopes, intercepts):
+        """ Returns (peak value, peak time, threshold time, onset) of every combination from the baselines of fit_block,
+            each shaped (runs, channels, starting rows, t_0s, t_fs, window sizes). Times are in seconds. """
+        seconds_per_sample = float(self.seconds_per_sample)
+        gradient = np.gradient(block, seconds_per_sample, axis=1).transpose(1, 0, 2)
+        time = np.arange(block.shape[1]) * seconds_per_sample
+
+        results = [np.full(slopes.shape + (len(self.window_sizes),), np.nan) for _ in DERIVATIVE_METRICS]
+        for i, starting_row in enumerate(self.starting_rows):
+            if block.shape[1] - starting_row < 2:
+                continue
+            # np.gradient of the trimmed run starts with a one sided difference where the untrimmed run is central
+            derivative = gradient[starting_row:].copy()
+            derivative[0] = (block[:, starting_row + 1] - block[:, starting_row]) / seconds_per_sample
+            derivative_sums = np.concatenate([np.zeros((1,) + derivative.shape[1:]), np.cumsum(derivative, axis=0)])
+            windows = slopes[:, :, i].shape
+            window_slopes = slopes[:, :, i].reshape(windows[:2] + (-1,))
+            window_intercepts = intercepts[:, :, i].reshape(windows[:2] + (-1,))
+            for j, window_size in enumerate(self.window_sizes):
+                start, end = padded_samples(["moving_average"], window_size)
+                kept = slice(starting_row + start, block.shape[1] - end)
+                if kept.start >= kept.stop:
+                    continue
+                smooth = self.smooth_block(derivative_sums, window_size)[:, start:len(derivative) - end]
+                features = self.window_features(time[kept], block[:, kept], smooth, window_slopes, window_intercepts)
+                for result, feature in zip(results, features):
+                    result[:, :, i, ..., j] = feature.reshape(windows)
+        return results
+
+    def sweep_block(self, block):
+        """ Returns every metric of a (runs, samples, channels) block, each shaped (runs, channels, starting rows, t_0s, t_fs, window sizes). """
+        block = np.asarray(block, dtype=float)
+        slopes, intercepts, rms = self.fit_block(block)
+        derivative = self.derivative_block(block, slopes, intercepts)
+        baseline = [np.broadcast_to(array[..., None], derivative[0].shape) for array in (slopes, intercepts, rms)]
+        return baseline + derivative
+
+    def sweep(self, traces):
+        """ Returns every metric of every (samples, channels) array in traces, one pass per group of equal shape.
+            Each metric is a list with one (channels, starting rows, t_0s, t_fs, window sizes) array per run. """
+        shapes = {}
+        for i, trace in enumerate(traces):
+            shapes.setdefault(trace.shape, []).append(i)
+
+        metrics = [[None] * len(traces) for _ in BASELINE_METRICS + DERIVATIVE_METRICS]
+        for group in shapes.values():
+            for metric, values in zip(metrics, self.sweep_block(np.stack([traces[i] for i in group]))):
+                for j, i in enumerate(group):
+                    metric[i] = values[j]
+        return [round_metric(name, values) for name, values in zip(BASELINE_METRICS + DERIVATIVE_METRICS, metrics)]
+
+    def combinations(self):
+        """ Returns the value of every parameter for every combination, in the order of the metric arrays. """
+        grids = np.meshgrid(self.starting_rows, self.t_0s, self.t_fs, self.window_sizes, indexing="ij")
+        return [grid.ravel() for grid in grids]
+
+def round_metric(name, values):
+    """ Returns the per run arrays of metric name rounded like the tables, with times in minutes. """
+    if name.endswith("Minute"):
+        return [np.round(array / SECONDS_PER_MINUTE, MINUTE_DECIMALS) for array in values]
+    return [np.round(array, FIT_DECIMALS if name in BASELINE_METRICS else PEAK_DECIMALS) for array in values]
+
+def per_run_table(grid, file_names, metrics):
+    """ Returns one row per run, channel and combination. """
+    import pandas as pd
+    parameters = grid.combinations()
+    frames = []
+    for i, file_name in enumerate(file_names):
+        channels = metrics[0][i].shape[0]
+        data = {"File Name": file_name,
+                "Channel": np.repeat(np.arange(1, channels + 1), len(grid))}
+        for name, values in zip(PARAMETERS, parameters):
+            data[name] = np.tile(values, channels)
+        for name, values in zip(BASELINE_METRICS + DERIVATIVE_METRICS, metrics):
+            data[name] = values[i].reshape(-1)
+        frames.append(pd.DataFrame(data))
+    return pd.concat(frames, ignore_index=True)
+
+def summary_table(grid, metrics):
+    """ Returns one row per combination and channel with the median of every metric over the runs, and how many
+        runs had every feature. Runs with fewer channels only count towards the channels they have. """
+    import pandas as pd
+    channels = max(values.shape[0] for values in metrics[0])
+
+    def stacked(values):
+        padded = np.full((len(values), channels) + values[0].shape[1:], np.nan)
+        for i, array in enumerate(values):
+            padded[i, :array.shape[0]] = array
+        return padded.reshape(len(values), channels, -1)
+
+    arrays = [stacked(values) for values in metrics]
+    data = {"Channel": np.repeat(np.arange(1, channels + 1), len(grid))}
+    for name, values in zip(PARAMETERS, grid.combinations()):
+        data[name] = np.tile(values, channels)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)     # All-NaN medians of combinations no run fits
+        for name, values in zip(BASELINE_METRICS + DERIVATIVE_METRICS, arrays):
+            data["Median " + name] = np.nanmedian(values, axis=0).reshape(-1)
+    data["Runs"] = np.all([np.isfinite(values) for values in arrays], axis=0).sum(axis=0).reshape(-1)
+    return pd.DataFrame(data)
+
+def plot_sweep(grid, summary, file_name):
+    """ Plot the median onset against the window size and the median baseline residual against t_f, at the first
+        values of the other parameters. """
+    from wainamics.rendering import FigureTemplate, channel_labels
+    template = FigureTemplate(figsize=(15, 5))
+    fig = template.figure
+    first = summary[(summary["STARTING_ROW"] == grid.starting_rows[0])]
+
+    ax0 = fig.add_subplot(1, 2, 1)
+    rows = first[(first["T_0"] == grid.t_0s[0]) & (first["T_F"] == grid.t_fs[0])]
+    for label, (channel, channel_rows) in zip(channel_labels(summary["Channel"].max()), rows.groupby("Channel")):
+        ax0.plot(channel_rows["WINDOW_SIZE"], channel_rows["Median Onset Minute"], marker="o", label=label)
+    ax0.set_title("Onset, T_0 = " + str(grid.t_0s[0]) + ", T_F = " + str(grid.t_fs[0]))
+    ax0.set_xlabel("WINDOW_SIZE")
+    ax0.set_ylabel("Median Onset Minute")
+    ax0.grid()
+    ax0.legend()
+
+    ax1 = fig.add_subplot(1, 2, 2)
+    rows = first[first["WINDOW_SIZE"] == grid.window_sizes[0]]
+    for t_0, t_0_rows in rows.groupby("T_0"):
+        residuals = t_0_rows.groupby("T_F")["Median Baseline RMS"].mean()
+        ax1.plot(residuals.index, residuals.values, marker="o", label="T_0 = " + str(t_0))
+    ax1.set_title("Baseline residual, mean of the channels")
+    ax1.set_xlabel("T_F (s)")
+    ax1.set_ylabel("Median Baseline RMS")
+    ax1.grid()
+    ax1.legend()
+
+    fig.suptitle("Parameter sweep, STARTING_ROW = " + str(grid.starting_rows[0]), fontsize=14)
+    template.save(file_name)
+
+def load_traces(directory, store=None, workers=1, cache=None, skip=()):
+    """ Returns (file names, traces) of every run in directory, or in the store at store. """
+    if store:
+        run_store = RunStore(store)
+        return ([entry["file_name"] for entry in run_store.entries],
+                [np.array(run_store.traces(i)[:, :len(entry["channels"])]) for i, entry in enumerate(run_store.entries)])
+    file_names = sorted(os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                        if file_name not in skip and is_run_file(os.path.join(directory, file_name)))
+    runs = [run for run in iter_batch(partial(read_traces, cache=cache), file_names, workers) if run is not None]
+    return [run["file_name"] for run in runs], [run["traces"] for run in runs]
+
+def write_table(table, file_name):
+    """ Write table as CSV, or as a workbook when file_name ends in .xlsx. """
+    if file_name.lower().endswith(".xlsx"):
+        table.to_excel(file_name, index=False)
+    else:
+        table.to_csv(file_name, index=False, float_format=CSV_FLOAT_FORMAT)
+
+def main():
+    """ Sweep the grid over every run and write the result table. """
+    defaults = DerivativeFeatures()
+    parser = argparse.ArgumentParser(description="Evaluate every combination of STARTING_ROW, T_0, T_F and WINDOW_SIZE over a folder of runs")
+    parser.add_argument("directory", nargs="?", default=".", help="folder of runs (default: current directory)")
+    parser.add_argument("--store", help="read the runs from this store (see wainamics/store.py) instead")
+    parser.add_argument("--starting-row", type=parse_grid, nargs="+", default=[[defaults.starting_row]], metavar="ROWS",
+                        help="values or START:STOP:STEP ranges of STARTING_ROW (default: " + str(defaults.starting_row) + ")")
+    parser.add_argument("--t0", type=parse_grid, nargs="+", default=[[defaults.t_0]], metavar="SECONDS",
+                        help="values or ranges of T_0 in seconds (default: " + str(defaults.t_0) + ")")
+    parser.add_argument("--tf", type=parse_grid, nargs="+", default=[[defaults.t_f]], metavar="SECONDS",
+                        help="values or ranges of T_F in seconds (default: " + str(defaults.t_f) + ")")
+    parser.add_argument("--window-size", type=parse_grid, nargs="+", default=[[defaults.window_size]], metavar="SAMPLES",
+                        help="values or ranges of WINDOW_SIZE (default: " + str(defaults.window_size) + ")")
+    parser.add_argument("--threshold", type=float, metavar="DRFU",
+                        help="dRFU / dt of the baseline subtracted trace the threshold minute is read at (default: half of each channel's peak)")
+    parser.add_argument("--seconds-per-sample", type=float, default=10, help="sampling interval of the runs (default: 10)")
+    parser.add_argument("--per-run", action="store_true",
+                        help="write a row for every run, channel and combination instead of the medians over the runs")
+    parser.add_argument("--output", default=OUTPUT_FILENAME, help="result table, .csv or .xlsx (default: " + OUTPUT_FILENAME + ")")
+    parser.add_argument("--plot", metavar="PNG", help="also plot the onset and baseline residual against the parameters")
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    starting_rows = grid_values(args.starting_row)
+    window_sizes = grid_values(args.window_size)
+    if any(row < 0 or row != int(row) for row in starting_rows) or any(size < 1 or size != int(size) for size in window_sizes):
+        parser.error("STARTING_ROW and WINDOW_SIZE must be whole numbers, WINDOW_SIZE at least 1")
+    grid = Grid([int(row) for row in starting_rows], grid_values(args.t0), grid_values(args.tf),
+                [int(size) for size in window_sizes], args.seconds_per_sample, args.threshold)
+
+    file_names, traces = load_traces(args.directory, args.store, args.workers, cache_from_args(args),
+                                     [TABLE_FILENAME, os.path.basename(args.output)])
+    if not traces:
+        parser.error("no runs found")
+    start = clock.perf_counter()
+    metrics = grid.sweep(traces)
+    table = per_run_table(grid, [os.path.basename(name) for name in file_names], metrics) if args.per_run else summary_table(grid, metrics)
+    print("Swept " + str(len(grid)) + " combinations over " + str(len(traces)) + " runs in " + str(round(clock.perf_counter() - start, 2)) + " s")
+
+    write_table(table, args.output)
+    if args.plot:
+        plot_sweep(grid, table if not args.per_run else summary_table(grid, metrics), args.plot)
+    print("Wrote " + args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Task: Stream run tables into the summary workbook in a single pass.
+#       The workbook is opened once in openpyxl's write-only mode and every table is appended as soon as it
+#       is ready, so writing N tables takes linear time and memory does not grow with the number of runs.
+#       The cell layout matches what DataFrame.to_excel produced: index in column A, header row on top.
+
+import math
+from datetime import datetime
+
+DATE_FORMAT = "YYYY-MM-DD HH:MM:SS"
+FIRST_SHEET = "Sheet1"
+
+def excel_value(value):
+    """ Returns value as openpyxl expects it, with blanks, NaN and NaT as empty cells. """
+    if value is None or value == "":
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if isinstance(value, datetime):
+        if value != value:      # NaT
+            return None
+        return value.to_pydatetime() if hasattr(value, "to_pydatetime") else value
+    if hasattr(value, "item"):
+        return value.item()     # numpy scalar
+    return value
+
+class TableWriter:
+    """ Write-only summary workbook that tables are appended to one at a time.
+        same_sheet=True stacks the tables NEW_ROW rows apart on one sheet, otherwise each table gets its own sheet. """
+
+    def __init__(self, file_name, same_sheet=True, new_row=6):
+        from openpyxl import Workbook
+        self.file_name = file_name
+        self.same_sheet = same_sheet
+        self.new_row = new_row
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None
+        self.rows_written = 0
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start_row(self):
+        """ Returns the 0-based row of the next table, matching the old startrow bookkeeping. """
+        if not self.same_sheet or self.count == 0:
+            return 0
+        return 1 + self.count * self.new_row
+
+    def write(self, table):
+        """ Append table below the previous one, or on a new sheet. """
+        if self.sheet is None or not self.same_sheet:
+            title = FIRST_SHEET if self.count == 0 else FIRST_SHEET + str(self.count)
+            self.sheet = self.workbook.create_sheet(title)
+            self.rows_written = 0
+
+        # Write-only sheets can only append, so pad with empty rows up to the table's start row
+        for _ in range(self.start_row() - self.rows_written):
+            self.sheet.append([])
+        self.sheet.append([None] + [str(name) for name in table.columns])
+        for index, row in enumerate(table.itertuples(index=False)):
+            self.sheet.append([index] + [self.cell(value) for value in row])
+
+        self.rows_written = self.start_row() + len(table) + 1
+        self.count += 1
+
+    def cell(self, value):
+        """ Returns a cell for value, giving dates the same format pandas used. """
+        value = excel_value(value)
+        if isinstance(value, datetime):
+            from openpyxl.cell import WriteOnlyCell
+            cell = WriteOnlyCell(self.sheet, value)
+            cell.number_format = DATE_FORMAT
+            return cell
+        return value
+
+    def close(self):
+        """ Save the workbook. Nothing is written when no table was added, like the old writers. """
+        if self.workbook is None:
+            return
+        if self.count:
+            self.workbook.save(self.file_name)
+        self.workbook = None
@@ -0,0 +1,215 @@
+# Task: Read every channel, and every channel's ratio to the reference channel, at a list of minutes.
+#       Runs may have any number of channels. The reference defaults to the last one, Ch 3 on the older
+#       three channel instruments.
+#       Runs are stacked into a (runs, samples, channels) block padded with NaN, the layout of the run store,
+#       so the readings of every run at every minute come out of one fancy index instead of a pandas lookup
+#       per cell. With --interpolate each minute is placed on the run's own time column with np.interp and
+#       every channel is read there in one weighted sum. A run that ends before a minute reads its last
+#       sample there, and is reported rather than left to fail or pass unnoticed.
+#       With derivative features (see wainamics/features.py) their rows follow the minutes in every table.
+
+import numpy as np
+from wainamics.features import FEATURE_LABELS
+
+DEFAULT_MINUTES = [0, 20, 40, 60]
+SECONDS_PER_MINUTE = 60
+
+# Rows the tables have always read off the exact minute: minute 0 skips the run's first reading
+# and minute 60 reads two rows early. They apply to those minutes in any list.
+LEGACY_ROW_OFFSETS = {0: 1, 60: -2}
+
+# Ratios are rounded to this many decimal places in the tables
+RATIO_DECIMALS = 4
+
+def timepoint_rows(minutes, seconds_per_sample):
+    """ Returns the sample row read at each minute: the row at that exact minute, moved by LEGACY_ROW_OFFSETS
+        for the minutes the tables have always read elsewhere. """
+    rows = np.rint(np.asarray(minutes, dtype=float) * SECONDS_PER_MINUTE / seconds_per_sample).astype(np.int64)
+    rows += np.array([LEGACY_ROW_OFFSETS.get(minute, 0) for minute in minutes], dtype=np.int64)
+    return np.maximum(rows, 0)
+
+def time_seconds(column, seconds_per_sample):
+    """ Returns the seconds since the first sample of a run's time column of HH:MM:SS text, times or durations.
+        Numbers, which may count samples rather than seconds, and columns that cannot be read or do not increase,
+        give samples seconds_per_sample apart. """
+    import pandas as pd
+    even = np.arange(len(column)) * float(seconds_per_sample)
+    values = pd.Series(column)
+    if len(values) == 0 or pd.api.types.is_numeric_dtype(values):
+        return even
+    try:
+        seconds = pd.to_timedelta(values.astype(str)).dt.total_seconds().to_numpy()
+    except (ValueError, TypeError):
+        return even
+    seconds = seconds - seconds[0]
+    if not np.isfinite(seconds).all() or (np.diff(seconds) <= 0).any():
+        return even
+    return seconds
+
+def extract_timepoints(block, lengths, minutes, seconds_per_sample, interpolate=False, times=None):
+    """ Returns (values, short). values[run, minute, channel] is the reading of every run at every minute and
+        short[run, minute] is True where the run ended before that minute, in which case its last sample is used.
+        interpolate reads the exact minute between samples instead of the table rows, on times, the seconds of
+        every sample of each run, or on samples seconds_per_sample apart when times is None. """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    last = np.maximum(lengths - 1, 0)[:, None]
+    runs = np.arange(len(block))[:, None]
+
+    if not interpolate:
+        rows = timepoint_rows(minutes, seconds_per_sample)[None, :]
+        return block[runs, np.minimum(rows, last)], rows > last
+
+    # Each minute's fractional sample on the time axis makes interpolating a weighted sum of the samples either side
+    seconds = np.asarray(minutes, dtype=float) * SECONDS_PER_MINUTE
+    if times is None:
+        position = (seconds / seconds_per_sample)[None, :]
+        short = position > last
+    else:
+        position = np.zeros((len(block), len(seconds)))
+        short = np.ones((len(block), len(seconds)), dtype=bool)
+        for i, time in enumerate(times):
+            time = np.asarray(time, dtype=float)[:lengths[i]]
+            if len(time):
+                position[i] = np.interp(seconds, time, np.arange(len(time)))
+                short[i] = seconds > time[-1]
+    position = np.minimum(position, last)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, last)
+    fraction = (position - lower)[:, :, None]
+    return block[runs, lower] * (1 - fraction) + block[runs, upper] * fraction, short
+
+def channel_ratios(values, reference=-1):
+    """ Returns (ratios, channels): every channel but the reference divided by the reference, and which channels those are. """
+    reference = reference % values.shape[-1]
+    channels = [i for i in range(values.shape[-1]) if i != reference]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = values[..., channels] / values[..., [reference]]
+    return np.round(ratios, RATIO_DECIMALS), channels
+
+def timepoint_table(date, file_name, minutes, values, ratios, ratio_channels, reference=-1, features=None):
+    """ Returns the table of one run: its date and file name, then a row per minute with every channel and ratio.
+        features is a (features, channels) array whose rows follow the minutes, labelled in the Minutes column. """
+    import pandas as pd
+    reference = reference % values.shape[-1]
+    if features is None:
+        features = np.empty((0, values.shape[-1]))
+    blank = [np.nan] * (len(minutes) + len(features) - 1)
+    no_ratios = np.full(len(features), np.nan)
+    data = {'Date Created': [date] + blank,
+            'File Name': [file_name] + blank,
+            'Minutes': list(minutes) + FEATURE_LABELS[:len(features)]}
+    for i in range(values.shape[-1]):
+        data['Ch ' + str(i + 1)] = np.concatenate([values[:, i], features[:, i]])
+    for j, i in enumerate(ratio_channels):
+        data['Ch' + str(i + 1) + ' / Ch' + str(reference + 1)] = np.concatenate([ratios[:, j], no_ratios])
+    table = pd.DataFrame(data)
+    table = table.fillna('')
+    return table
+
+def report_short_runs(file_names, minutes, short):
+    """ Print which runs ended before which minutes. """
+    for file_name, missing in zip(file_names, short):
+        if missing.any():
+            late = ", ".join(format_minute(minute) for minute, is_short in zip(minutes, missing) if is_short)
+            print(file_name + " ends before minute " + late + ", its last reading is used there")
+
+def format_minute(minute):
+    """ Returns minute without a trailing .0. """
+    return str(int(minute)) if minute == int(minute) else str(minute)
+
+def parse_minute(text):
+    """ argparse type for minutes: whole minutes stay integers so the tables show 20, not 20.0. """
+    minute = float(text)
+    if minute < 0:
+        raise ValueError(text)
+    return int(minute) if minute == int(minute) else minute
+
+def parse_channel(text):
+    """ argparse type for channel numbers, which count from 1. """
+    channel = int(text)
+    if channel < 1:
+        raise ValueError(text)
+    return channel
+
+class Timepoints:
+    """ Which minutes the tables read, at what sampling rate, whether between samples, and which channel
+        the ratios are taken against, counted from 1. reference=None uses each run's last channel.
+        features is a DerivativeFeatures whose rows are added to every table, or None. """
+
+    def __init__(self, minutes=DEFAULT_MINUTES, seconds_per_sample=10, interpolate=False, reference=None, features=None):
+        self.minutes = list(minutes)
+        self.seconds_per_sample = seconds_per_sample
+        self.interpolate = interpolate
+        self.reference = reference
+        self.features = features
+
+    def reference_index(self, channels):
+        """ Returns the index of the reference channel of a run with channels channels. """
+        if self.reference is None:
+            return channels - 1
+        if self.reference > channels:
+            raise ValueError("Reference channel " + str(self.reference) + " asked for, but the run has " + str(channels) + " channels")
+        return self.reference - 1
+
+    def block_tables(self, block, lengths, dates, file_names, channels=None, features=None, times=None):
+        """ Returns the table of every run of a (runs, samples, channels) block, all read in one pass.
+            channels gives each run's channel count when runs with fewer channels are padded with NaN,
+            features each run's feature rows when they are added, and times the seconds of each run's samples. """
+        values, short = extract_timepoints(block, lengths, self.minutes, self.seconds_per_sample, self.interpolate, times)
+        report_short_runs(file_names, self.minutes, short)
+        counts = np.full(len(block), block.shape[2]) if channels is None else np.asarray(channels)
+
+        # Runs with the same channel count share a reference and are divided together
+        tables = [None] * len(block)
+        for count in np.unique(counts):
+            rows = np.flatnonzero(counts == count)
+            reference = self.reference_index(int(count))
+            group = values[rows, :, :count]
+            ratios, ratio_channels = channel_ratios(group, reference)
+            for j, i in enumerate(rows):
+                tables[i] = timepoint_table(dates[i], file_names[i], self.minutes, group[j], ratios[j], ratio_channels, reference,
+                                            None if features is None else features[i])
+        return tables
+
+    def run_times(self, runs):
+        """ Returns the seconds of every sample of each run from its time column, or None unless interpolating. """
+        if not self.interpolate:
+            return None
+        return [time_seconds(run.optics.iloc[:, 0], self.seconds_per_sample) for run in runs]
+
+    def trace_features(self, traces):
+        """ Returns the feature rows of every (samples, channels) array in traces, or None without features. """
+        return None if self.features is None else self.features.block_features(traces)
+
+    def table(self, run, traces=None, features=None):
+        """ Returns the table of one run, from traces when its readings are already an array
+            and from features when its feature rows are already computed. """
+        if traces is None:
+            traces = run.traces()
+        if features is None and self.features is not None:
+            features = self.features.block_features([traces])[0]
+        return self.block_tables(traces[None], [len(traces)], [run.date], [run.file_name], None,
+                                 None if features is None else [features], self.run_times([run]))[0]
+
+    def new_row(self):
+        """ Returns how many rows apart the tables are written on one sheet. """
+        return len(self.minutes) + 2 + (0 if self.features is None else len(FEATURE_LABELS))
+
+    def parameters(self):
+        """ Returns the settings that change the tables, for the manifest. """
+        return {"minutes": self.minutes, "seconds_per_sample": self.seconds_per_sample, "interpolate": self.interpolate,
+                "rows": timepoint_rows(self.minutes, self.seconds_per_sample).tolist(), "reference": self.reference,
+                "features": None if self.features is None else self.features.parameters()}
+
+def add_timepoint_arguments(parser):
+    """ Add the options that choose the minutes of the tables. """
+    parser.add_argument("--minutes", type=parse_minute, nargs="+", default=DEFAULT_MINUTES, metavar="MINUTE",
+                        help="minutes to read every channel at (default: " + " ".join(str(minute) for minute in DEFAULT_MINUTES) + ")")
+    parser.add_argument("--interpolate", action="store_true",
+                        help="interpolate the readings at the exact minutes of each run's time column instead of reading the nearest table rows")
+    parser.add_argument("--reference", type=parse_channel, metavar="CHANNEL",
+                        help="channel the ratios are taken against, counted from 1 (default: the last channel of each run)")
+
+def timepoints_from_args(args, seconds_per_sample, features=None):
+    """ Returns the Timepoints asked for on the command line, adding the rows of features when it is given. """
+    return Timepoints(sorted(args.minutes), seconds_per_sample, args.interpolate, args.reference, features)
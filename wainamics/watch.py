@@ -0,0 +1,234 @@
+# Task: Keep processing runs as the instrument drops them into the current folder, until interrupted.
+#       Changes are picked up with Linux inotify, read through ctypes so nothing extra has to be installed,
+#       or by comparing folder listings every second elsewhere and on network shares where inotify misses
+#       writes made by other machines. A changed file waits until its size and modification time have held
+#       still for a couple of seconds, so half written workbooks are not parsed. Settled runs queue for a
+#       fixed size pool of worker processes, and the summary table is rewritten from the manifest at most
+#       every few seconds, so a rack flushing dozens of runs at once keeps every worker busy instead of
+#       waiting on a table rewrite per run.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import sys
+import time as clock
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from wainamics.loader import is_run_file
+from wainamics.batch import count_workers, report_failure, start_worker
+from wainamics.manifest import input_fingerprint
+
+# Seconds a file's size and modification time must hold still before it is processed
+SETTLE_SECONDS = 2.0
+
+# Seconds between folder listings when polling, and between checks while nothing is happening
+POLL_SECONDS = 1.0
+
+# The summary table is rewritten at most this often while runs keep finishing
+PUBLISH_SECONDS = 5.0
+
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifyEvents:
+    """ Names of the files changed in a folder, from Linux inotify. """
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed for " + directory)
+
+    def wait(self, timeout):
+        """ Returns the names of the files changed, waiting up to timeout seconds for the first change. """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        names = set()
+        if not ready:
+            return names
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        """ Stop watching. """
+        os.close(self.fd)
+
+class PollingEvents:
+    """ Names of the files changed in a folder, found by comparing listings. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = self.scan()
+
+    def scan(self):
+        """ Returns the size and modification time of every file in the folder. """
+        listing = {}
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue    # Removed while listing
+        return listing
+
+    def wait(self, timeout):
+        """ Returns the names of the files changed since the last call, after waiting timeout seconds. """
+        clock.sleep(timeout)
+        listing = self.scan()
+        names = {name for name, stat in listing.items() if self.seen.get(name) != stat}
+        self.seen = listing
+        return names
+
+    def close(self):
+        """ Nothing to release. """
+
+def ignore_interrupt():
+    """ Worker processes leave Ctrl+C to the watching process, which stops them, and release their figures on the way out. """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    start_worker()
+
+def watch_events(directory, polling=False):
+    """ Returns inotify events for directory where the platform has them, otherwise polled ones. """
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyEvents(directory)
+        except (OSError, AttributeError):
+            pass
+    return PollingEvents(directory)
+
+class Debouncer:
+    """ Holds changed files until their size and modification time have not changed for settle seconds. """
+
+    def __init__(self, settle=SETTLE_SECONDS):
+        self.settle = settle
+        self.pending = {}   # file name -> (fingerprint, when it was first seen)
+
+    def touch(self, file_name):
+        """ Note that file_name changed. """
+        try:
+            fingerprint = input_fingerprint(file_name)
+        except OSError:
+            self.pending.pop(file_name, None)   # Removed or renamed away
+            return
+        if file_name not in self.pending or self.pending[file_name][0] != fingerprint:
+            self.pending[file_name] = (fingerprint, clock.monotonic())
+
+    def ready(self):
+        """ Returns the files that have settled and stops holding them. """
+        now = clock.monotonic()
+        settled = []
+        for file_name in list(self.pending):
+            self.touch(file_name)
+            if file_name in self.pending and now - self.pending[file_name][1] >= self.settle:
+                settled.append(file_name)
+                del self.pending[file_name]
+        return sorted(settled)
+
+def publish_results(manifest, publish, skip):
+    """ Save the manifest and hand its runs to publish. Returns False when publishing failed, to retry later. """
+    manifest.prune([file_name for file_name in os.listdir(".") if is_run_file(file_name) and file_name not in skip])
+    manifest.save()
+    if publish is None:
+        return True
+    try:
+        publish(manifest)
+    except OSError as error:
+        # Most often the summary workbook is open in Excel
+        print("Could not update the summary: " + repr(error) + ", trying again later")
+        return False
+    return True
+
+def watch(worker, manifest, outputs, publish=None, workers=1, settle=SETTLE_SECONDS, polling=False, skip=()):
+    """ Process every run in the current folder that is new or changed, then every run that lands or changes,
+        until interrupted. Results are recorded in manifest and publish(manifest) is called after runs finish.
+        Files named in skip, such as the summary workbook, are never processed. """
+    events = watch_events(".", polling)
+    debouncer = Debouncer(settle)
+    workers = count_workers(workers, os.cpu_count() or 1)
+    queue = deque()
+    running = {}    # future -> (file name, fingerprint when submitted)
+    unpublished = False
+    last_publish = clock.monotonic()
+
+    def wanted(file_name):
+        return is_run_file(file_name) and file_name not in skip
+
+    for file_name in sorted(os.listdir(".")):
+        if wanted(file_name) and not manifest.is_current(file_name, outputs(file_name)):
+            debouncer.touch(file_name)
+    print("Watching " + os.getcwd() + " with " + type(events).__name__ + ", press Ctrl+C to stop")
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=ignore_interrupt) as pool:
+            while True:
+                timeout = 0.1 if running or debouncer.pending else POLL_SECONDS
+                for file_name in events.wait(timeout):
+                    if wanted(file_name):
+                        debouncer.touch(file_name)
+                for file_name in debouncer.ready():
+                    if file_name not in queue:
+                        queue.append(file_name)
+
+                # Only as many runs as there are workers are handed to the pool, the rest wait in the queue
+                while queue and len(running) < workers:
+                    file_name = queue.popleft()
+                    try:
+                        fingerprint = input_fingerprint(file_name)
+                    except OSError:
+                        continue
+                    running[pool.submit(worker, file_name)] = (file_name, fingerprint)
+
+                for future in [future for future in running if future.done()]:
+                    file_name, fingerprint = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        report_failure(file_name, error)
+                        continue
+                    manifest.record(file_name, outputs(file_name), result if hasattr(result, "itertuples") else None, fingerprint)
+                    unpublished = True
+                    print("Processed " + file_name)
+
+                idle = not running and not queue
+                if unpublished and (idle or clock.monotonic() - last_publish >= PUBLISH_SECONDS):
+                    unpublished = not publish_results(manifest, publish, skip)
+                    last_publish = clock.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        events.close()
+        if unpublished:
+            publish_results(manifest, publish, skip)
+
+def add_watch_arguments(parser):
+    """ Add the options that keep a script watching the folder for new runs. """
+    group = parser.add_argument_group("watching")
+    group.add_argument("--watch", action="store_true",
+                       help="keep running and process every run that lands in or changes in the folder, until Ctrl+C")
+    group.add_argument("--settle", type=float, default=SETTLE_SECONDS,
+                       help="seconds a file must stop changing before it is processed (default: " + str(SETTLE_SECONDS) + ")")
+    group.add_argument("--poll", action="store_true",
+                       help="compare folder listings every second instead of using inotify, for network shares")